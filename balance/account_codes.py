@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+
+class AccountCodes:
+    """
+    Class to map the accounts of the balance calculation to dense int32
+    codes, and the days to int32 day numbers, so the movements, results and
+    states flow through the calculation as compact numeric columns.
+
+    The codes are assigned in the order in which the accounts are first
+    encoded and are kept for the whole run, so the chunks of a stream, the
+    state of the previous run and the results share them. Only one object
+    per account is kept, and the accounts and dates are mapped back when the
+    results and the state are written.
+    """
+
+    def __init__(self):
+        self._accounts = pd.Index([], dtype=object)
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def encode(self, accounts):
+        """
+        Maps a column of accounts to their codes, assigning new codes to the
+        accounts not seen yet.
+
+        Parameters:
+            accounts (array-like): The accounts.
+
+        Returns:
+            ndarray: The codes (int32).
+        """
+        codes, uniques = pd.factorize(np.asarray(accounts))
+        positions = self._accounts.get_indexer(uniques)
+        new = positions < 0
+        if new.any():
+            positions[new] = np.arange(len(self._accounts),
+                                       len(self._accounts) + new.sum())
+            self._accounts = self._accounts.append(
+                pd.Index(uniques[new], dtype=object))
+        return positions.astype('int32')[codes]
+
+    def decode(self, codes):
+        """
+        Maps a column of codes back to their accounts.
+
+        Parameters:
+            codes (array-like): The codes.
+
+        Returns:
+            ndarray: The accounts.
+        """
+        return self._accounts.to_numpy()[np.asarray(codes)]
+
+    @staticmethod
+    def day_numbers(dates):
+        """
+        Converts a column of dates into the number of days since the epoch.
+
+        Parameters:
+            dates (array-like): The dates.
+
+        Returns:
+            ndarray: The day numbers (int32).
+        """
+        return pd.to_datetime(pd.Series(dates)).to_numpy().astype(
+            'datetime64[D]').astype('int32')
+
+    @staticmethod
+    def dates(day_numbers):
+        """
+        Converts a column of day numbers back into dates.
+
+        Parameters:
+            day_numbers (array-like): The number of days since the epoch.
+
+        Returns:
+            ndarray: The dates, as datetime.date objects.
+        """
+        return np.asarray(day_numbers, dtype='int64').astype(
+            'datetime64[D]').astype(object)
+
+    def encode_movements(self, df_daily: DataFrame):
+        """
+        Converts daily movements, as returned by
+        InvestmentReader.read_daily_movements, into their compact form:
+        'account_id' as codes, 'action_timestamp' as day numbers and
+        'action_month' as int8.
+
+        Parameters:
+            df_daily (DataFrame): The daily movements.
+
+        Returns:
+            DataFrame: The compact daily movements.
+        """
+        return df_daily.assign(
+            account_id=self.encode(df_daily['account_id']),
+            action_timestamp=self.day_numbers(df_daily['action_timestamp']),
+            action_month=df_daily['action_month'].to_numpy(dtype='int8'))
+
+    def decode_results(self, df_result: DataFrame):
+        """
+        Maps the accounts and days of compact results back, with
+        'action_timestamp' as datetime64 values.
+
+        Parameters:
+            df_result (DataFrame): Results of InvestmentBalance in the
+                compact form.
+
+        Returns:
+            DataFrame: The results with the accounts and dates.
+        """
+        return df_result.assign(
+            account_id=self.decode(df_result['account_id']),
+            action_timestamp=df_result['action_timestamp'].to_numpy(
+                dtype='int64').astype('datetime64[D]').astype(
+                'datetime64[ns]'))
+
+    def encode_state(self, df_state: DataFrame):
+        """
+        Converts a state, as returned by BalanceCheckpoint.load, into the
+        compact form, indexed by code and with 'last_date' as day numbers.
+
+        Parameters:
+            df_state (DataFrame): The state, or None.
+
+        Returns:
+            DataFrame: The compact state, or None.
+        """
+        if df_state is None:
+            return None
+        return df_state.assign(
+            last_date=self.day_numbers(df_state['last_date'])).set_axis(
+            pd.Index(self.encode(df_state.index), name='account_id'))
+
+    def decode_state(self, df_state: DataFrame):
+        """
+        Maps the accounts and the last dates of a compact state back, as
+        expected by BalanceCheckpoint.save.
+
+        Parameters:
+            df_state (DataFrame): The compact state.
+
+        Returns:
+            DataFrame: The state indexed by 'account_id'.
+        """
+        return df_state.assign(
+            last_date=self.dates(df_state['last_date'])).set_axis(
+            pd.Index(self.decode(df_state.index), name='account_id'))
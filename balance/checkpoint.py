@@ -0,0 +1,98 @@
+import datetime
+
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy import inspect
+
+from connections.connection_postgresql import ConnectionPostgres
+
+
+class BalanceCheckpoint:
+    """
+    Class with methods to persist the state of the investment accounts
+    between runs of the balance calculation.
+
+    The state holds, for each account, the last calculated day with its
+    balance and income, so a new run only needs the investments completed
+    after the checkpoint.
+    """
+
+    TABLE_NAME = 'investment_balance_state'
+
+    @classmethod
+    def load(cls, connection: ConnectionPostgres):
+        """
+        Reads the state of the accounts from the database.
+
+        Parameters:
+            connection (ConnectionPostgres): The database connection.
+
+        Returns:
+            DataFrame: The state indexed by 'account_id', as returned by
+                InvestmentBalance.last_state, or None if no state was saved
+                yet.
+        """
+        if not inspect(connection.engine).has_table(cls.TABLE_NAME):
+            return None
+
+        df_state = pd.read_sql_table(cls.TABLE_NAME, con=connection.engine,
+                                     index_col='account_id')
+        if df_state.empty:
+            return None
+        df_state['last_date'] = pd.to_datetime(df_state['last_date']).dt.date
+        return df_state
+
+    @classmethod
+    def save(cls, connection: ConnectionPostgres, df_state: DataFrame,
+             transaction=None):
+        """
+        Replaces the state of the accounts in the database in a single
+        transaction, its own or the given one, such as the transaction that
+        loads the results of the run, so both are committed together.
+
+        Parameters:
+            connection (ConnectionPostgres): The database connection.
+            df_state (DataFrame): The state of all the accounts.
+            transaction (Connection): Optional SQLAlchemy connection of an
+                open transaction where the state is saved.
+
+        Returns:
+            None
+        """
+        if transaction is None:
+            with connection.engine.begin() as transaction:
+                return cls.save(connection, df_state, transaction)
+
+        df_state.to_sql(cls.TABLE_NAME, con=transaction, if_exists='replace',
+                        index=True, index_label='account_id')
+
+    @staticmethod
+    def merge(df_state: DataFrame, df_updates: DataFrame):
+        """
+        Replaces the state of the updated accounts, keeping the accounts
+        without new movements.
+
+        Parameters:
+            df_state (DataFrame): The previous state, or None.
+            df_updates (DataFrame): The state of the recalculated accounts.
+
+        Returns:
+            DataFrame: The merged state.
+        """
+        if df_state is None:
+            return df_updates
+        return pd.concat(
+            [df_state[~df_state.index.isin(df_updates.index)], df_updates])
+
+    @staticmethod
+    def next_date(df_state: DataFrame):
+        """
+        Returns the first day that was not calculated yet.
+
+        Parameters:
+            df_state (DataFrame): The state of the accounts.
+
+        Returns:
+            datetime.date: The day after the last calculated day.
+        """
+        return df_state['last_date'].max() + datetime.timedelta(days=1)
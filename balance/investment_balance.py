@@ -0,0 +1,374 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from pandas.api.types import is_integer_dtype
+
+from balance.account_codes import AccountCodes
+
+
+class InvestmentBalance:
+    """
+    Class with static methods to calculate the daily balance and income of
+    the investment accounts.
+
+    The calculation is done for all the accounts at once: the daily
+    movements are grouped and sorted a single time and the compounding state
+    of every account is kept in NumPy arrays, advancing one day of movement
+    per step for all the accounts that still have movements.
+    """
+
+    # Daily interest rate applied over the balance
+    DAILY_RATE = 0.0001
+    # Daily interest rate applied over the income
+    INCOME_RATE = 0.01 / 100
+
+    @classmethod
+    def daily_movements(cls, df: DataFrame):
+        """
+        Groups the completed investments by account and day, pivoting the
+        amounts into deposit and withdrawal columns.
+
+        The grouping works on int32 account codes, int32 day numbers and int8
+        codes of the categorical 'type', and the accounts and days are mapped
+        back to the representation of `df` afterwards, so it may hold the
+        compact columns of AccountCodes or the accounts and dates themselves.
+
+        Parameters:
+            df (DataFrame): The completed investments with the columns
+                'account_id', 'type', 'amount', 'action_timestamp' (date or
+                day number) and 'action_month'.
+
+        Returns:
+            DataFrame: One row per account and day with the columns
+                'account_id', 'action_timestamp', 'action_month', 'deposit'
+                and 'withdrawal'. The accounts keep the order in which they
+                first appear in `df` and the days are sorted inside each
+                account.
+        """
+        account_order, accounts = pd.factorize(df['account_id'])
+        day_number = cls._day_number(df['action_timestamp']).astype('int32')
+        types = df['type'].astype('category')
+        # 0 for deposits, 1 for withdrawals and 2 for other types, whose days
+        # are kept without amounts
+        type_code = np.select(
+            [types == 'investment_transfer_in',
+             types == 'investment_transfer_out'], [0, 1], 2).astype('int8')
+
+        df_daily = DataFrame({
+            'account_order': account_order.astype('int32'),
+            'day_number': day_number,
+            'action_month': df['action_month'].to_numpy(),
+            'type_code': type_code,
+            'amount': df['amount'].to_numpy(dtype='float64'),
+        }).groupby(['account_order', 'day_number', 'action_month',
+                    'type_code'])['amount'].sum().unstack(
+            'type_code', fill_value=0.0).reindex(
+            columns=[0, 1], fill_value=0.0).reset_index()
+
+        if is_integer_dtype(df['action_timestamp']):
+            action_timestamp = df_daily['day_number'].to_numpy()
+        else:
+            action_timestamp = AccountCodes.dates(df_daily['day_number'])
+
+        return DataFrame({
+            'account_id': accounts.take(df_daily['account_order']),
+            'action_timestamp': action_timestamp,
+            'action_month': df_daily['action_month'].to_numpy(),
+            'deposit': df_daily[0].to_numpy(dtype='float64'),
+            'withdrawal': df_daily[1].to_numpy(dtype='float64'),
+        })
+
+    @classmethod
+    def calculate_daily(cls, df_daily: DataFrame, state: DataFrame = None):
+        """
+        Calculates the balance and the income of each account day.
+
+        The first day of an account has the net deposit compounded by one day.
+        The following days compound the previous balance by the number of days
+        since the previous movement, then apply the deposit and the
+        withdrawal. When the withdrawal would make the balance negative it is
+        ignored and the income of the day is 0.
+
+        Accounts present in `state` are carried forward from their last
+        calculated day instead of starting over.
+
+        Parameters:
+            df_daily (DataFrame): The daily movements, as returned by
+                `daily_movements`, with the days of each account contiguous
+                and sorted.
+            state (DataFrame): Optional state of previously calculated
+                accounts, as returned by `last_state`.
+
+        Returns:
+            DataFrame: `df_daily` with the 'balance' and 'income' columns
+                added.
+        """
+        df_daily = df_daily.copy()
+        total = len(df_daily)
+        if total == 0:
+            df_daily['balance'] = pd.Series(dtype='float64')
+            df_daily['income'] = pd.Series(dtype='float64')
+            return df_daily
+
+        deposit = df_daily['deposit'].to_numpy(dtype='float64')
+        withdrawal = df_daily['withdrawal'].to_numpy(dtype='float64')
+        day_number = cls._day_number(df_daily['action_timestamp'])
+
+        accounts = df_daily['account_id'].to_numpy()
+        new_account = np.ones(total, dtype=bool)
+        new_account[1:] = accounts[1:] != accounts[:-1]
+        starts = np.flatnonzero(new_account)
+        lengths = np.diff(np.append(starts, total))
+
+        days = np.zeros(total, dtype='int64')
+        days[1:] = np.diff(day_number)
+
+        # The accounts are visited from the longest to the shortest, so the
+        # accounts that still have movements on a given step are always a
+        # prefix
+        by_length = np.argsort(-lengths, kind='stable')
+        starts = starts[by_length]
+        lengths = lengths[by_length]
+        active = np.searchsorted(-lengths, -np.arange(lengths[0]),
+                                 side='left')
+
+        balance = np.empty(total, dtype='float64')
+        income = np.empty(total, dtype='float64')
+
+        first_net = deposit[starts] - withdrawal[starts]
+        balance[starts] = first_net * (1 + cls.DAILY_RATE * 1)
+        income[starts] = first_net * cls.INCOME_RATE
+
+        if state is not None and not state.empty:
+            df_state = state.reindex(accounts[starts])
+            carried = df_state['balance'].notna().to_numpy()
+            df_state = df_state[carried]
+            rows = starts[carried]
+
+            first_net[carried] = df_state['first_net'].to_numpy()
+            balance[rows], income[rows] = cls._compound(
+                df_state['balance'].to_numpy(),
+                df_state['income'].to_numpy(), first_net[carried],
+                deposit[rows], withdrawal[rows],
+                day_number[rows] - cls._day_number(df_state['last_date']))
+
+        for step in range(1, lengths[0]):
+            count = active[step]
+            rows = starts[:count] + step
+
+            balance[rows], income[rows] = cls._compound(
+                balance[rows - 1], income[rows - 1], first_net[:count],
+                deposit[rows], withdrawal[rows], days[rows])
+
+        df_daily['balance'] = balance
+        df_daily['income'] = income
+        return df_daily
+
+    @classmethod
+    def _compound(cls, balance, income, first_net, deposit, withdrawal, days):
+        """
+        Advances the balance and the income of a set of accounts to their next
+        day of movement.
+
+        Returns:
+            tuple: The new balance and income arrays.
+        """
+        compounded = balance * (1 + cls.DAILY_RATE * days)
+        calculate = compounded + deposit - withdrawal
+        # If the calculated balance is negative, the withdrawal is ignored
+        negative = calculate < 0
+
+        return (np.where(negative, compounded + deposit, calculate),
+                np.where(negative, 0.0,
+                         (first_net + income) * (cls.INCOME_RATE * days)))
+
+    @staticmethod
+    def _day_number(dates):
+        """
+        Converts a column of dates into the number of days since the epoch.
+        Columns of day numbers are returned as they are.
+        """
+        if is_integer_dtype(dates):
+            return np.asarray(dates, dtype='int64')
+        return AccountCodes.day_numbers(dates).astype('int64')
+
+    @staticmethod
+    def last_state(df_result: DataFrame, state: DataFrame = None):
+        """
+        Extracts the state of each account after its last calculated day, so
+        a later calculation can carry the account forward.
+
+        Parameters:
+            df_result (DataFrame): The results, as returned by `calculate`.
+            state (DataFrame): The state used to calculate `df_result`, if
+                any.
+
+        Returns:
+            DataFrame: One row per account, indexed by 'account_id', with the
+                columns 'last_date', 'balance', 'income' and 'first_net'.
+        """
+        grouped = df_result.groupby('account_id', sort=False)
+        first = grouped[['deposit', 'withdrawal']].first()
+
+        df_state = grouped[['action_timestamp', 'balance', 'income']].last()
+        df_state.rename(columns={'action_timestamp': 'last_date'},
+                        inplace=True)
+        df_state['first_net'] = first['deposit'] - first['withdrawal']
+
+        if state is not None and not state.empty:
+            carried = state['first_net'].reindex(df_state.index)
+            df_state['first_net'] = carried.where(carried.notna(),
+                                                  df_state['first_net'])
+        return df_state
+
+    @classmethod
+    def calculate(cls, df: DataFrame, state: DataFrame = None):
+        """
+        Calculates the daily balance and income of every account present in
+        the completed investments.
+
+        Parameters:
+            df (DataFrame): The completed investments, as described in
+                `daily_movements`.
+            state (DataFrame): Optional state of previously calculated
+                accounts, as returned by `last_state`.
+
+        Returns:
+            DataFrame: One row per account and day with the columns
+                'account_id', 'action_timestamp', 'action_month', 'deposit',
+                'withdrawal', 'balance' and 'income'.
+        """
+        return cls.calculate_daily(cls.daily_movements(df), state=state)
+
+    @classmethod
+    def iter_calculate(cls, df: DataFrame, state: DataFrame = None,
+                       batch_size: int = 10000):
+        """
+        Calculates the daily balance and income of the accounts in batches,
+        so the results can be consumed without keeping all of them in memory.
+
+        Parameters:
+            df (DataFrame): The completed investments, as described in
+                `daily_movements`.
+            state (DataFrame): Optional state of previously calculated
+                accounts, as returned by `last_state`.
+            batch_size (int): The number of accounts of each batch.
+
+        Yields:
+            DataFrame: The results of a batch of accounts, as returned by
+                `calculate`, in the same order.
+        """
+        yield from cls.iter_calculate_parallel(
+            cls.daily_movements(df), workers=1, state=state,
+            batch_size=batch_size)
+
+    @classmethod
+    def iter_calculate_chunks(cls, chunks, state: DataFrame = None):
+        """
+        Calculates the daily balance and income of daily movements read in
+        chunks, such as the ones returned by
+        InvestmentReader.read_daily_movements.
+
+        The rows of the last account of a chunk are held back until the next
+        chunk, since the account may continue there, so only one chunk is
+        kept in memory at a time.
+
+        Parameters:
+            chunks (iterable): DataFrames of daily movements, as returned by
+                `daily_movements`, with the days of each account contiguous
+                and sorted across the chunks.
+            state (DataFrame): Optional state of previously calculated
+                accounts, as returned by `last_state`.
+
+        Yields:
+            DataFrame: The results of each chunk, as returned by
+                `calculate_daily`, in the same order.
+        """
+        df_carry = None
+        for df_chunk in chunks:
+            if df_chunk.empty:
+                continue
+            if df_carry is not None:
+                df_chunk = pd.concat([df_carry, df_chunk], ignore_index=True)
+
+            accounts = df_chunk['account_id'].to_numpy()
+            other_accounts = np.flatnonzero(accounts != accounts[-1])
+            boundary = other_accounts[-1] + 1 if len(other_accounts) else 0
+
+            df_carry = df_chunk.iloc[boundary:]
+            if boundary:
+                yield cls.calculate_daily(df_chunk.iloc[:boundary],
+                                          state=state)
+
+        if df_carry is not None:
+            yield cls.calculate_daily(df_carry, state=state)
+
+    @classmethod
+    def iter_calculate_parallel(cls, df_daily: DataFrame, workers: int,
+                                state: DataFrame = None,
+                                batch_size: int = 10000):
+        """
+        Calculates the daily balance and income of the accounts across a pool
+        of processes.
+
+        The accounts are hash-partitioned into one shard per worker, each
+        shard is calculated independently and the results are merged back
+        into the order of `df_daily`, so the output does not depend on the
+        number of workers.
+
+        Parameters:
+            df_daily (DataFrame): The daily movements, as described in
+                `calculate_daily`.
+            workers (int): The number of processes.
+            state (DataFrame): Optional state of previously calculated
+                accounts, as returned by `last_state`.
+            batch_size (int): The number of accounts of each batch.
+
+        Yields:
+            DataFrame: The results of a batch of accounts, as returned by
+                `calculate_daily`, in the same order.
+        """
+        if workers <= 1:
+            for start, end in cls._account_batches(df_daily, batch_size):
+                yield cls.calculate_daily(df_daily.iloc[start:end],
+                                          state=state)
+            return
+
+        accounts = pd.Index(pd.unique(df_daily['account_id']))
+        shard = pd.util.hash_array(df_daily['account_id'].to_numpy()) % \
+            workers
+        shards = [df_daily[shard == number] for number in range(workers)]
+        shards = [df_shard for df_shard in shards if not df_shard.empty]
+        states = [None if state is None else
+                  state[state.index.isin(df_shard['account_id'])]
+                  for df_shard in shards]
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(cls.calculate_daily, shards, states))
+
+        if not results:
+            return
+
+        df_result = pd.concat(results, ignore_index=True)
+        order = np.argsort(accounts.get_indexer(df_result['account_id']),
+                           kind='stable')
+        df_result = df_result.take(order).reset_index(drop=True)
+
+        for start, end in cls._account_batches(df_result, batch_size):
+            yield df_result.iloc[start:end]
+
+    @staticmethod
+    def _account_batches(df_daily: DataFrame, batch_size: int):
+        """
+        Splits the rows of a frame with contiguous accounts into ranges of
+        `batch_size` accounts.
+
+        Returns:
+            zip: The (start, end) positions of each batch.
+        """
+        accounts = df_daily['account_id'].to_numpy()
+        starts = np.flatnonzero(np.append(True, accounts[1:] != accounts[:-1]))
+        bounds = np.append(starts[::batch_size], len(df_daily))
+        return zip(bounds[:-1], bounds[1:])
@@ -0,0 +1,230 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy import text
+
+from balance.account_codes import AccountCodes
+from balance.investment_balance import InvestmentBalance
+from connections.connection_postgresql import ConnectionPostgres
+from process_data.parquet_staging import ParquetStaging
+
+
+class InvestmentReader:
+    """
+    Class to read the daily investment movements of the accounts from the
+    database.
+
+    The deposits and withdrawals are summed per account and day by
+    PostgreSQL, so only the aggregated rows are transferred, and they are
+    streamed through a server-side cursor in chunks, or read as partitions
+    of accounts fetched concurrently over pooled connections. They can also
+    be read from the Parquet staging layer written by the ingestion, without
+    touching the database.
+    """
+
+    QUERY = """
+    select
+        account_id,
+        action_timestamp,
+        action_month,
+        deposit,
+        withdrawal
+    from (
+        select
+            i.account_id,
+            dt.action_timestamp::date as action_timestamp,
+            dm.action_month,
+            sum(case when i.type = 'investment_transfer_in'
+                then i.amount else 0 end) as deposit,
+            sum(case when i.type = 'investment_transfer_out'
+                then i.amount else 0 end) as withdrawal
+        from investments i
+        join d_time dt on dt.time_id = i.investment_completed_at
+        join d_month dm on dm.month_id = dt.month_id
+        where i.status = 'completed' {filter}
+        group by i.account_id, dt.action_timestamp::date, dm.action_month
+    ) as daily_movements
+    order by
+        min(action_timestamp) over (partition by account_id),
+        account_id,
+        action_timestamp
+    """
+
+    @classmethod
+    def read_daily_movements(cls, connection: ConnectionPostgres,
+                             since=None, chunksize: int = 100000,
+                             codes: AccountCodes = None):
+        """
+        Reads the daily deposits and withdrawals of the completed investments.
+
+        The accounts are ordered by their first day of movement, then by
+        'account_id', and the days of each account are contiguous and sorted,
+        as expected by InvestmentBalance.calculate_daily.
+
+        Parameters:
+            connection (ConnectionPostgres): The database connection.
+            since (datetime.date): Optional first day to be read.
+            chunksize (int): The number of rows of each chunk.
+            codes (AccountCodes): Optional codes of the accounts. When given
+                each chunk is converted into the compact form of
+                AccountCodes.encode_movements as soon as it is read.
+
+        Yields:
+            DataFrame: Chunks with the columns 'account_id',
+                'action_timestamp', 'action_month', 'deposit' and
+                'withdrawal'.
+        """
+        query = cls.QUERY.format(
+            filter='' if since is None else
+            'and dt.action_timestamp >= :since')
+
+        with connection.engine.connect().execution_options(
+                stream_results=True) as stream:
+            for df_chunk in pd.read_sql(
+                    text(query), con=stream,
+                    params=None if since is None else {'since': since},
+                    chunksize=chunksize):
+                yield df_chunk if codes is None else \
+                    codes.encode_movements(df_chunk)
+
+    @classmethod
+    def read_partitioned_movements(cls, connection: ConnectionPostgres,
+                                   partitions: int, workers: int = None,
+                                   since=None, codes: AccountCodes = None):
+        """
+        Reads the daily deposits and withdrawals of the completed investments
+        as partitions of accounts, split by a hash of 'account_id', fetched
+        by a pool of threads, each one over its own pooled connection.
+
+        The partitions are yielded in their order as soon as they arrive,
+        while the following ones are still being fetched, so the calculation
+        of a partition overlaps with the extraction of the next ones. At most
+        `workers` partitions are fetched ahead of the one being consumed.
+        The accounts of a partition are ordered as in `read_daily_movements`,
+        and every account is in a single partition, so the rows read do not
+        depend on the number of partitions, nor their order on the number of
+        workers. Their order does depend on the number of partitions, as the
+        accounts are grouped by partition first.
+
+        Parameters:
+            connection (ConnectionPostgres): The database connection.
+            partitions (int): The number of partitions.
+            workers (int): The number of concurrent queries, by default the
+                smaller of `partitions` and the pool size.
+            since (datetime.date): Optional first day to be read.
+            codes (AccountCodes): Optional codes of the accounts. When given
+                each partition is converted into the compact form of
+                AccountCodes.encode_movements in the consuming thread.
+
+        Yields:
+            DataFrame: The daily movements of each partition, as returned by
+                `read_daily_movements`.
+        """
+        if workers is None:
+            workers = min(partitions, ConnectionPostgres.POOL_SIZE)
+        query = text(cls.QUERY.format(filter=' '.join(
+            ['and (hashtext(i.account_id::text) & 2147483647) % :partitions '
+             '= :partition'] +
+            ([] if since is None else ['and dt.action_timestamp >= :since']))))
+
+        def read_partition(partition):
+            params = {'partitions': partitions, 'partition': partition}
+            if since is not None:
+                params['since'] = since
+            with connection.engine.connect() as conn:
+                return pd.read_sql(query, con=conn, params=params)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque(executor.submit(read_partition, partition)
+                            for partition in range(min(workers, partitions)))
+            next_partition = len(pending)
+            while pending:
+                df_partition = pending.popleft().result()
+                if next_partition < partitions:
+                    pending.append(executor.submit(read_partition,
+                                                   next_partition))
+                    next_partition += 1
+                if df_partition.empty:
+                    continue
+                yield df_partition if codes is None else \
+                    codes.encode_movements(df_partition)
+
+    @staticmethod
+    def read_parquet_movements(path: str = ParquetStaging.STAGING_DIR,
+                               since=None, codes: AccountCodes = None):
+        """
+        Reads the daily deposits and withdrawals of the completed investments
+        from the Parquet staging layer, in the same order as
+        `read_daily_movements`.
+
+        Only the completed investments and, with `since`, the month
+        partitions from its month on are read, and only the columns used by
+        the calculation. The days and months are resolved through the index
+        of 'd_time' instead of joining the dimensions, directly into day
+        numbers, and the rows are ordered through the first day of each
+        account, so the accounts are only compared once.
+
+        Parameters:
+            path (str): The root directory of the staging layer.
+            since (datetime.date): Optional first day to be read.
+            codes (AccountCodes): Optional codes of the accounts. When given
+                the movements are returned in the compact form of
+                AccountCodes.encode_movements.
+
+        Yields:
+            DataFrame: The daily movements, as returned by
+                `read_daily_movements`, in a single chunk.
+        """
+        staging = ParquetStaging(path)
+        filters = [('status', '==', 'completed')]
+        if since is not None:
+            filters.append(('month', '>=', since.strftime('%Y-%m')))
+
+        df = staging.read('investments', filters=filters,
+                          columns=['account_id', 'type', 'amount',
+                                   'investment_completed_at'])
+        time_index = staging.time_index()
+        positions, found = time_index.positions(
+            df['investment_completed_at'])
+        day_number = time_index.days[positions]
+        if since is not None:
+            found &= day_number >= AccountCodes.day_numbers([since])[0]
+        if not found.any():
+            return
+
+        account_order, accounts = pd.factorize(df['account_id'][found])
+        day_number = day_number[found]
+
+        # Ordering the accounts by their first day, then by 'account_id'
+        first_day = pd.Series(day_number).groupby(account_order).min()
+        rank = np.empty(len(accounts), dtype='int32')
+        rank[DataFrame({'first_day': first_day.to_numpy(),
+                        'account_id': accounts}).sort_values(
+            by=['first_day', 'account_id']).index] = np.arange(len(accounts))
+        account_rank = rank[account_order]
+        order = np.lexsort((day_number, account_rank))
+
+        df_daily = InvestmentBalance.daily_movements(DataFrame({
+            'account_id': account_rank[order],
+            'type': df['type'].array[found][order],
+            'amount': df['amount'].to_numpy()[found][order],
+            'action_timestamp': day_number[order],
+            'action_month': time_index.months[positions[found]][order],
+        }))
+
+        ranked_accounts = np.empty(len(accounts), dtype=object)
+        ranked_accounts[rank] = np.asarray(accounts)
+        ranked_accounts = ranked_accounts[df_daily['account_id']]
+        if codes is not None:
+            df_daily['account_id'] = codes.encode(ranked_accounts)
+            yield df_daily
+            return
+
+        df_daily['account_id'] = ranked_accounts
+        df_daily['action_timestamp'] = AccountCodes.dates(
+            df_daily['action_timestamp'])
+        df_daily['action_month'] = df_daily['action_month'].astype('int64')
+        yield df_daily
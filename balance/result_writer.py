@@ -0,0 +1,434 @@
+import gzip
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy.dialects import postgresql
+
+from balance.account_codes import AccountCodes
+from connections.connection_postgresql import ConnectionPostgres
+
+try:
+    import pyarrow
+    from pyarrow import parquet as pyarrow_parquet
+except ImportError:
+    pyarrow = None
+
+
+class ResultWriter:
+    """
+    Class to stream the calculated investment balances to a csv, compressed
+    csv or Parquet report, and optionally to a database table.
+
+    Each batch of results is formatted and handed to a pool of threads as
+    soon as it is written, so the files are written while the next batches
+    are calculated and only a few batches are kept in memory at a time. The
+    report can be partitioned by month, one file per month, and the files
+    of different months are written in parallel, while the batches of each
+    file keep their order.
+
+    The table is loaded with COPY FROM STDIN when the database is PostgreSQL
+    through psycopg2, in a single transaction. The files are written under
+    hidden temporary names, the ones appended to starting as a copy of the
+    report, and nothing replaces the report or is committed to the table
+    until `commit` is called, or the writer is closed without an error.
+    `commit` can save the state of the calculation in the same transaction
+    as the table, and the files are only renamed over the report after it,
+    so a run that fails before never adds its days to the report.
+
+    Attributes:
+        path (str): The path of the report. Partitioned and Parquet reports
+            are directories.
+        append (bool): Whether the rows are appended to an existing report
+            and table instead of replacing them.
+        rows (int): The number of rows written so far.
+        codes (AccountCodes): Optional codes of the accounts, to map back the
+            results calculated in the compact form of AccountCodes.
+        output_format (str): The format of the report, one of `FORMATS`.
+        partition_by_month (bool): Whether the report is split into one file
+            per month.
+        workers (int): The number of threads writing the report and the
+            table.
+        connection (ConnectionPostgres): Optional database connection where
+            the results are loaded.
+        table_name (str): The name of the table of the results.
+    """
+
+    COLUMNS = {'action_timestamp': 'Day', 'action_month': 'Month',
+               'account_id': 'Account ID', 'deposit': 'Deposit',
+               'withdrawal': 'Withdrawal', 'income': 'End of Day Income',
+               'balance': 'Account Daily Balance'}
+
+    # File extension of each format of the report
+    FORMATS = {'csv': '.csv', 'csv.gz': '.csv.gz', 'parquet': '.parquet'}
+
+    TABLE_NAME = 'investment_daily_balance'
+
+    def __init__(self, path: str = 'investments.csv', append: bool = False,
+                 codes: AccountCodes = None, output_format: str = 'csv',
+                 partition_by_month: bool = False, workers: int = 1,
+                 connection: ConnectionPostgres = None,
+                 table_name: str = TABLE_NAME):
+        if output_format not in self.FORMATS:
+            raise ValueError(f'Unknown report format: {output_format}')
+        if output_format == 'parquet' and pyarrow is None:
+            raise ImportError('pyarrow is required by the Parquet report')
+        self.path = path
+        self.append = append
+        self.codes = codes
+        self.output_format = output_format
+        self.partition_by_month = partition_by_month
+        self.workers = workers
+        self.connection = connection
+        self.table_name = table_name
+        self.rows = 0
+        self._loaded = False
+        self._executor = None
+        self._table_executor = None
+        self._pending = {}
+        self._files = {}
+        self._conn = None
+        self._transaction = None
+        self._temporary = {}
+        self._committed = False
+
+    def __enter__(self):
+        if self.partition_by_month or self.output_format == 'parquet':
+            os.makedirs(self.path, exist_ok=True)
+        if self.connection is not None:
+            # A single thread owns the connection of the table
+            self._table_executor = ThreadPoolExecutor(max_workers=1)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self.workers))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and not self._committed:
+                self.commit()
+        finally:
+            if not self._committed:
+                self._discard()
+
+    def commit(self, save=None):
+        """
+        Waits for the pending writes and completes the report and the table.
+        The load of the table is committed, with the state saved by `save`
+        in the same transaction, and the temporary files are then renamed
+        over the report. A partitioned or Parquet report that is not
+        appended to has its previous files removed first.
+
+        Parameters:
+            save (callable): Optional function saving the state of the
+                calculation, called with the SQLAlchemy connection of the
+                transaction of the table, or with None when no table is
+                loaded, such as BalanceCheckpoint.save.
+
+        Returns:
+            None
+        """
+        self._flush()
+        if self._table_executor is not None:
+            self._table_executor.submit(self._close_table, False,
+                                        save).result()
+        elif save is not None:
+            save(None)
+
+        if not self.append and os.path.isdir(self.path):
+            self.remove_report(self.path)
+        for temporary_file, path in self._temporary.items():
+            os.replace(temporary_file, path)
+        self._temporary = {}
+        self._committed = True
+        self._shutdown()
+
+    def _flush(self):
+        """
+        Waits for the pending writes and closes the files.
+        """
+        try:
+            for future in self._pending.values():
+                future.result()
+        finally:
+            self._pending = {}
+            for file_write in self._files.values():
+                file_write.close()
+            self._files = {}
+
+    def _discard(self):
+        """
+        Rolls back the load of the table and removes the temporary files,
+        leaving the report and the table as they were.
+        """
+        try:
+            self._flush()
+        finally:
+            if self._table_executor is not None:
+                self._table_executor.submit(self._close_table, True).result()
+            for temporary_file in self._temporary:
+                if os.path.exists(temporary_file):
+                    os.remove(temporary_file)
+            self._temporary = {}
+            self._shutdown()
+
+    def _shutdown(self):
+        """
+        Shuts down the threads of the files and of the table.
+        """
+        self._executor.shutdown()
+        if self._table_executor is not None:
+            self._table_executor.shutdown()
+            self._table_executor = None
+
+    @staticmethod
+    def temporary_path(path: str):
+        """
+        Returns the hidden path where a file of the report is written before
+        it is renamed over `path`, so the readers of the report never open
+        it.
+        """
+        directory, name = os.path.split(path)
+        return os.path.join(directory, f'.{name}.{os.getpid()}.tmp')
+
+    @classmethod
+    def remove_report(cls, path: str):
+        """
+        Removes the files that a writer creates in the directory of a
+        partitioned or Parquet report: the 'Month=' files and directories
+        and the 'part-*.parquet' files. Any other file is left in place, so
+        a report written into a shared directory never removes it.
+
+        Parameters:
+            path (str): The directory of the report.
+
+        Returns:
+            None
+        """
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            if os.path.isdir(entry):
+                if name.startswith('Month='):
+                    cls.remove_report(entry)
+                    if not os.listdir(entry):
+                        os.rmdir(entry)
+            elif name.startswith('Month=') and name.endswith(
+                    tuple(cls.FORMATS.values())) or \
+                    name.startswith('part-') and name.endswith('.parquet'):
+                os.remove(entry)
+
+    @staticmethod
+    def round_values(values, decimals: int = 2):
+        """
+        Rounds a column of floats as the built-in round, vectorized.
+
+        NumPy rounds the scaled values, which differs from the built-in round
+        for values that are within the error of the scaling from a tie, so
+        only those values are rounded again with the built-in round.
+
+        Parameters:
+            values (Series): The values.
+            decimals (int): The number of decimal places.
+
+        Returns:
+            ndarray: The rounded values.
+        """
+        values = np.asarray(values, dtype='float64')
+        rounded = np.round(values, decimals)
+        scaled = np.abs(values * 10 ** decimals)
+        ties = np.flatnonzero(
+            np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+        rounded[ties] = [round(value, decimals)
+                         for value in values[ties].tolist()]
+        return rounded
+
+    @classmethod
+    def prepare(cls, df_result: DataFrame, codes: AccountCodes = None):
+        """
+        Maps the accounts and days of a batch back, when it is in the compact
+        form, and rounds the 'balance' and 'income' columns to 2 decimal
+        places.
+
+        Parameters:
+            df_result (DataFrame): A batch returned by the InvestmentBalance
+                class.
+            codes (AccountCodes): The codes of the accounts, when the batch
+                is in the compact form.
+
+        Returns:
+            DataFrame: The batch with the columns of `df_result`.
+        """
+        df_result = df_result.copy() if codes is None else \
+            codes.decode_results(df_result)
+        df_result['balance'] = cls.round_values(df_result['balance'])
+        df_result['income'] = cls.round_values(df_result['income'])
+        return df_result
+
+    @classmethod
+    def format(cls, df_result: DataFrame, codes: AccountCodes = None):
+        """
+        Formats a batch of results into the columns of the report.
+
+        The 'action_timestamp' column is reduced to the day, the 'balance'
+        and 'income' columns are rounded to 2 decimal places and the columns
+        are renamed and reordered to 'Day', 'Month', 'Account ID', 'Deposit',
+        'Withdrawal', 'End of Day Income' and 'Account Daily Balance'.
+
+        Parameters:
+            df_result (DataFrame): A batch returned by the InvestmentBalance
+                class.
+            codes (AccountCodes): The codes of the accounts, when the batch
+                is in the compact form.
+
+        Returns:
+            DataFrame: The formatted batch.
+        """
+        return cls._report(cls.prepare(df_result, codes))
+
+    @classmethod
+    def _report(cls, df_result: DataFrame):
+        """
+        Renames and reorders the columns of a prepared batch.
+        """
+        df_result['action_timestamp'] = pd.to_datetime(
+            df_result['action_timestamp']).dt.day
+        return df_result.rename(columns=cls.COLUMNS)[
+            list(cls.COLUMNS.values())]
+
+    def write(self, df_result: DataFrame):
+        """
+        Formats a batch of results and hands it to the threads that append it
+        to the report, and to the table when there is one. The header of each
+        csv file is written only with its first batch.
+
+        Parameters:
+            df_result (DataFrame): A batch returned by the InvestmentBalance
+                class.
+
+        Returns:
+            None
+        """
+        df_result = self.prepare(df_result, self.codes)
+        if self._table_executor is not None:
+            self._submit(None, self._load, df_result.copy())
+
+        df_report = self._report(df_result)
+        if self.partition_by_month:
+            for month, df_month in df_report.groupby('Month', sort=True):
+                self._submit(f'Month={month}', self._write_file,
+                             f'Month={month}', df_month)
+        else:
+            self._submit('', self._write_file, '', df_report)
+        self.rows += len(df_report)
+
+    def _submit(self, target, function, *args):
+        """
+        Runs a write in the pool after the previous write of the same target,
+        such as a file, so the batches of each target keep their order. The
+        writes of the table, whose target is None, run in its own thread.
+        """
+        previous = self._pending.get(target)
+        if previous is not None:
+            previous.result()
+        executor = self._executor if target is not None else \
+            self._table_executor
+        self._pending[target] = executor.submit(function, *args)
+
+    def _write_file(self, name: str, df_report: DataFrame):
+        """
+        Appends a formatted batch to the file of a partition of the report.
+        """
+        if self.output_format == 'parquet':
+            return self._write_parquet(name, df_report)
+
+        file_write = self._files.get(name)
+        if file_write is None:
+            path = os.path.join(self.path, name + self.FORMATS[self.output_format]) \
+                if name else self.path
+            header = not (self.append and os.path.exists(path) and
+                          os.path.getsize(path) > 0)
+            temporary_file = self.temporary_path(path)
+            if not header:
+                # Concatenated gzip members are read as a single file
+                shutil.copyfile(path, temporary_file)
+            mode = 'w' if header else 'a'
+            if self.output_format == 'csv.gz':
+                file_write = gzip.open(temporary_file, mode + 't',
+                                       compresslevel=6, newline='')
+            else:
+                file_write = open(temporary_file, mode, newline='')
+            self._temporary[temporary_file] = path
+            self._files[name] = file_write
+        else:
+            header = False
+        df_report.to_csv(file_write, header=header, index=False)
+
+    def _write_parquet(self, name: str, df_report: DataFrame):
+        """
+        Appends a formatted batch as a row group of the Parquet file of a
+        partition of the report. Every run adds new files to the report. The
+        files of the month partitions leave out the month, which is read
+        from their directory.
+        """
+        if name:
+            df_report = df_report.drop(columns='Month')
+        table = pyarrow.Table.from_pandas(
+            df_report.assign(**{'Account ID': df_report['Account ID'].astype(
+                str)}), preserve_index=False)
+        file_write = self._files.get(name)
+        if file_write is None:
+            directory = os.path.join(self.path, name)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'part-{uuid.uuid4().hex}.parquet')
+            temporary_file = self.temporary_path(path)
+            file_write = pyarrow_parquet.ParquetWriter(temporary_file,
+                                                       table.schema)
+            self._temporary[temporary_file] = path
+            self._files[name] = file_write
+        file_write.write_table(table.cast(file_write.schema))
+
+    def _load(self, df_result: DataFrame):
+        """
+        Appends a prepared batch to the table, replacing the table with the
+        first batch when the writer does not append.
+        """
+        df_result['account_id'] = df_result['account_id'].astype(str)
+        df_result['action_timestamp'] = pd.to_datetime(
+            df_result['action_timestamp']).dt.date
+        if self._conn is None:
+            self._conn = self.connection.engine.connect()
+            self._transaction = self._conn.begin()
+        if_exists = 'append' if self.append or self._loaded else 'replace'
+        self._loaded = True
+
+        options = {}
+        if self.connection.engine.dialect.name == 'postgresql':
+            options['dtype'] = {'account_id': postgresql.UUID}
+        if self.connection.engine.dialect.driver == 'psycopg2':
+            options['method'] = ConnectionPostgres.copy_insert
+        df_result.to_sql(self.table_name, con=self._conn,
+                         if_exists=if_exists, index=False, **options)
+
+    def _close_table(self, failed: bool, save=None):
+        """
+        Commits the load of the table, with the state saved by `save` in the
+        same transaction, or rolls it back when the writer failed, and
+        closes its connection.
+        """
+        if self._conn is None:
+            if not failed and save is not None:
+                save(None)
+            return
+        try:
+            if failed:
+                self._transaction.rollback()
+            else:
+                if save is not None:
+                    save(self._conn)
+                self._transaction.commit()
+        finally:
+            # Closing the connection rolls back a transaction not committed
+            self._conn.close()
+            self._conn = None
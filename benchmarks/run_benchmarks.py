@@ -0,0 +1,304 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from sqlalchemy import text
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import calculate_investiments
+from benchmarks.synthetic_data import SyntheticTables
+from connections.connection_postgresql import ConnectionPostgres
+from process_data.read_and_process_postgresql import \
+    ProcessDataSetsPostgresql
+
+
+class Benchmark:
+    """
+    Class to benchmark the ingestion steps and the investment balance
+    calculation over a synthetic `Tables` directory.
+
+    Every stage runs in a new process, so its wall time and peak resident
+    memory are measured in isolation, and the rows it produced are counted
+    to report its throughput. The results are saved as json, with the
+    commit and the scale of the run, and can be compared with a previous
+    result to spot regressions.
+
+    Attributes:
+        directory (str): The working directory, with the `Tables` directory.
+        database (str): The URI of the database, which must be empty. The
+            default SQLite file is recreated on every run.
+        parquet_dir (str): Optional directory of the Parquet staging layer.
+    """
+
+    # Destination table of each ingestion step
+    STEP_TABLES = {
+        'read_and_process_country': 'country',
+        'read_and_process_state': 'state',
+        'read_and_process_city': 'city',
+        'read_and_process_accounts': 'accounts',
+        'read_and_process_customers': 'customers',
+        'read_and_process_dimension_year': 'd_year',
+        'read_and_process_dimension_month': 'd_month',
+        'read_and_process_dimension_week': 'd_week',
+        'read_and_process_dimension_weekday': 'd_weekday',
+        'read_and_process_dimension_time': 'd_time',
+        'read_and_process_investiments': 'investments',
+        'read_and_process_pix_movements': 'pix_movements',
+        'read_and_process_transfer_ins': 'transfer_ins',
+        'read_and_process_transfer_out': 'transfer_outs',
+    }
+
+    # Output file of the balance calculation, inside `directory`
+    BALANCE_FILE = 'investments.csv'
+
+    def __init__(self, directory: str, database: str = None,
+                 parquet_dir: str = None):
+        self.directory = os.path.abspath(directory)
+        self.database = database or \
+            f'sqlite:///{os.path.join(self.directory, "benchmark.db")}'
+        self.parquet_dir = parquet_dir
+        # The balance query is written for PostgreSQL, so on other databases
+        # the calculation reads from the Parquet staging layer
+        if not self.database.startswith('postgresql') and \
+                self.parquet_dir is None:
+            self.parquet_dir = 'staging'
+
+    def prepare(self, generator: SyntheticTables, schema_file: str = None):
+        """
+        Generates the `Tables` directory and prepares the database.
+
+        Parameters:
+            generator (SyntheticTables): The generator of the tables.
+            schema_file (str): Optional DDL file, such as sql.sql, executed
+                before the ingestion.
+
+        Returns:
+            dict: The number of rows generated per table.
+        """
+        tables = os.path.join(self.directory, 'Tables')
+        for path in [tables, os.path.join(self.directory, 'staging')]:
+            shutil.rmtree(path, ignore_errors=True)
+        if self.database.startswith('sqlite:///'):
+            database_file = self.database[len('sqlite:///'):]
+            if os.path.exists(database_file):
+                os.remove(database_file)
+        os.makedirs(self.directory, exist_ok=True)
+
+        rows = generator.write(tables)
+
+        if schema_file is not None:
+            with open(schema_file) as file_read:
+                statements = [statement for statement in
+                              file_read.read().split(';')
+                              if statement.strip()]
+            with ConnectionPostgres.connect(
+                    self.database).engine.begin() as connection:
+                for statement in statements:
+                    connection.execute(text(statement))
+        ProcessDataSetsPostgresql.create_manifest(self.database)
+        return rows
+
+    def run(self):
+        """
+        Runs every ingestion step, in the order of
+        ProcessDataSetsPostgresql.STEPS, then the balance calculation.
+
+        Returns:
+            list: One dict per stage with its 'stage', 'rows', 'wall_time'
+                in seconds, 'rows_per_second' and 'peak_rss_mb'.
+        """
+        stages = []
+        context = multiprocessing.get_context('spawn')
+        for step, table_name in self.STEP_TABLES.items():
+            wall_time, peak_rss = self._run_stage(
+                context, ProcessDataSetsPostgresql.run_step,
+                self.database, step, parquet_dir=self.parquet_dir)
+            stages.append(self._stage(step, self._count(table_name),
+                                      wall_time, peak_rss))
+
+        wall_time, peak_rss = self._run_stage(
+            context, calculate_investiments.main, self.database,
+            full_rebuild=True,
+            parquet_dir=None if self.database.startswith('postgresql')
+            else self.parquet_dir)
+        with open(os.path.join(self.directory, self.BALANCE_FILE)) as file:
+            rows = sum(1 for _ in file) - 1
+        stages.append(self._stage('calculate_investiments', rows, wall_time,
+                                  peak_rss))
+        return stages
+
+    def _run_stage(self, context, function, *args, **kwargs):
+        """
+        Runs a stage in a new process.
+
+        Returns:
+            tuple: The wall time and the peak RSS of the stage.
+        """
+        with ProcessPoolExecutor(max_workers=1,
+                                 mp_context=context) as executor:
+            return executor.submit(_measure, self.directory, function, args,
+                                   kwargs).result()
+
+    def _count(self, table_name: str):
+        with ConnectionPostgres.connect(
+                self.database).engine.connect() as connection:
+            return connection.execute(
+                text(f'SELECT count(*) FROM "{table_name}"')).scalar()
+
+    @staticmethod
+    def _stage(stage: str, rows: int, wall_time: float, peak_rss: float):
+        return {'stage': stage, 'rows': rows,
+                'wall_time': round(wall_time, 4),
+                'rows_per_second': round(rows / wall_time, 1)
+                if wall_time else None,
+                'peak_rss_mb': peak_rss}
+
+    @staticmethod
+    def report(stages: list, baseline: dict = None):
+        """
+        Prints the stages as a table, with the ratio of the wall time to the
+        one of a baseline result when given.
+
+        Parameters:
+            stages (list): The stages, as returned by `run`.
+            baseline (dict): Optional previous result, as saved by `save`.
+
+        Returns:
+            DataFrame: The printed table.
+        """
+        df = pd.DataFrame(stages).set_index('stage')
+        if baseline is not None:
+            df_baseline = pd.DataFrame(baseline['stages']).set_index('stage')
+            df['baseline_wall_time'] = df_baseline['wall_time']
+            df['ratio'] = (df['wall_time'] /
+                           df['baseline_wall_time']).round(2)
+        print(df.to_string())
+        return df
+
+    @staticmethod
+    def save(path: str, stages: list, scale: dict):
+        """
+        Saves the stages into a json file, with the commit, the versions and
+        the scale of the run.
+
+        Parameters:
+            path (str): The path of the json file.
+            stages (list): The stages, as returned by `run`.
+            scale (dict): The parameters of the generator.
+
+        Returns:
+            None
+        """
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as file_write:
+            json.dump({'commit': commit,
+                       'created_at': datetime.datetime.now().isoformat(),
+                       'python': platform.python_version(),
+                       'pandas': pd.__version__,
+                       'scale': scale,
+                       'stages': stages}, file_write, indent=2)
+
+
+def _measure(directory: str, function, args: tuple, kwargs: dict):
+    """
+    Runs a stage inside `directory`, silencing its output.
+
+    Returns:
+        tuple: The wall time in seconds and the peak RSS of the process in
+            megabytes, or None where the resource module is not available.
+    """
+    os.chdir(directory)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        peak_rss /= 1024 * 1024 if sys.platform == 'darwin' else 1024
+        peak_rss = round(peak_rss, 1)
+    return wall_time, peak_rss
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the ingestion and the balance calculation '
+                    'over synthetic data. Run it from the root of the '
+                    'repository with python -m benchmarks.run_benchmarks.')
+    parser.add_argument('--directory', default=os.path.join('.cache',
+                                                            'benchmark'),
+                        help='Working directory of the synthetic tables.')
+    parser.add_argument('--database', default=None,
+                        help='URI of an empty database. Defaults to a '
+                             'SQLite file in the working directory.')
+    parser.add_argument('--schema-file', default=None,
+                        help='DDL executed before the ingestion, such as '
+                             'sql.sql on PostgreSQL.')
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--transfers', type=int, default=20,
+                        help='Transfers in and out per account.')
+    parser.add_argument('--pix', type=int, default=20,
+                        help='Pix movements per account.')
+    parser.add_argument('--investments', type=int, default=20,
+                        help='Investment transactions per account.')
+    parser.add_argument('--days', type=int, default=366)
+    parser.add_argument('--duplicate-rate', type=float, default=0.01)
+    parser.add_argument('--none-rate', type=float, default=0.05)
+    parser.add_argument('--transfer-format', default='csv',
+                        choices=['csv', 'xlsx', 'both'])
+    parser.add_argument('--files', type=int, default=1,
+                        help='Files per transfer, pix and investment table.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='Json file of the results. Defaults to '
+                             'benchmarks/results/<timestamp>.json.')
+    parser.add_argument('--baseline', default=None,
+                        help='Previous json result to compare with.')
+    args = parser.parse_args()
+
+    scale = {'accounts': args.accounts, 'transfers': args.transfers,
+             'pix': args.pix, 'investments': args.investments,
+             'days': args.days, 'duplicate_rate': args.duplicate_rate,
+             'none_rate': args.none_rate,
+             'transfer_format': args.transfer_format, 'files': args.files,
+             'seed': args.seed}
+
+    benchmark = Benchmark(args.directory, database=args.database)
+    benchmark.prepare(SyntheticTables(**scale), schema_file=args.schema_file)
+    stages = benchmark.run()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as file_read:
+            baseline = json.load(file_read)
+    Benchmark.report(stages, baseline)
+
+    output = args.output or os.path.join(
+        'benchmarks', 'results',
+        f'{datetime.datetime.now():%Y%m%d-%H%M%S}.json')
+    Benchmark.save(output, stages, scale)
+    print(f'Results saved in {output}')
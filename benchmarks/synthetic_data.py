@@ -0,0 +1,260 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class SyntheticTables:
+    """
+    Class to generate a synthetic `Tables` directory with the same files,
+    columns and formats read by ProcessDataSetsPostgresql, at a configurable
+    scale.
+
+    The transfers, the pix movements and the investments are generated per
+    account, a share of their rows is duplicated and a share of their
+    movements is left incomplete, with the 'None' sentinel as completion time.
+
+    Attributes:
+        accounts (int): The number of accounts and customers.
+        transfers (int): The transfers in and out per account.
+        pix (int): The pix movements per account.
+        investments (int): The investment transactions per account.
+        days (int): The number of days of 'd_time', starting on 2020-01-01.
+        duplicate_rate (float): The share of transfer and pix rows repeated.
+        none_rate (float): The share of movements without completion time.
+        transfer_format (str): The format of the transfer and pix files,
+            'csv', 'xlsx' or 'both'.
+        files (int): The number of files of each transfer and pix table.
+        seed (int): The seed of the random generator.
+    """
+
+    # Number of 'd_time' rows per day
+    HOURS = 24
+
+    def __init__(self, accounts: int = 1000, transfers: int = 20,
+                 pix: int = 20, investments: int = 20, days: int = 366,
+                 duplicate_rate: float = 0.01, none_rate: float = 0.05,
+                 transfer_format: str = 'csv', files: int = 1,
+                 seed: int = 0):
+        self.accounts = accounts
+        self.transfers = transfers
+        self.pix = pix
+        self.investments = investments
+        self.days = days
+        self.duplicate_rate = duplicate_rate
+        self.none_rate = none_rate
+        self.transfer_format = transfer_format
+        self.files = files
+        self.random = np.random.default_rng(seed)
+
+    def write(self, directory: str):
+        """
+        Writes every table into `directory`, one subdirectory per table.
+
+        Parameters:
+            directory (str): The `Tables` directory to be created.
+
+        Returns:
+            dict: The number of rows generated per table.
+        """
+        rows = {}
+        for table_name, df in self.dimensions().items():
+            self._write_csv(df, directory, table_name)
+            rows[table_name] = len(df)
+
+        for table_name, df in [('country', self.country()),
+                               ('state', self.state()),
+                               ('city', self.city()),
+                               ('customers', self.customers()),
+                               ('accounts', self.accounts_table())]:
+            self._write_csv(df, directory, table_name)
+            rows[table_name] = len(df)
+
+        for table_name, df in [
+                ('transfer_ins', self.transfer_table(self.transfers)),
+                ('transfer_outs', self.transfer_table(self.transfers)),
+                ('pix_movements', self.pix_table())]:
+            self._write_split(df, directory, table_name)
+            rows[table_name] = len(df)
+
+        rows['investments'] = self._write_investments(directory)
+        return rows
+
+    def dimensions(self):
+        """
+        Generates the time dimension tables, with one 'd_time' row per hour.
+        """
+        timestamps = pd.date_range('2020-01-01', periods=self.days * self.HOURS,
+                                   freq='H')
+        years = np.unique(timestamps.year)
+        d_time = pd.DataFrame({
+            'time_id': np.arange(1, len(timestamps) + 1),
+            'action_timestamp': timestamps.strftime('%Y-%m-%d %H:%M:%S'),
+            'week_id': timestamps.isocalendar().week.to_numpy(),
+            'month_id': timestamps.month,
+            'year_id': np.searchsorted(years, timestamps.year) + 1,
+            'weekday_id': timestamps.weekday + 1})
+        return {
+            'd_year': pd.DataFrame({'year_id': np.arange(1, len(years) + 1),
+                                    'action_year': years}),
+            'd_month': pd.DataFrame({'month_id': np.arange(1, 13),
+                                     'action_month': np.arange(1, 13)}),
+            'd_week': pd.DataFrame({'week_id': np.arange(1, 54),
+                                    'action_week': np.arange(1, 54)}),
+            'd_weekday': pd.DataFrame({
+                'weekday_id': np.arange(1, 8),
+                'action_weekday': ['Monday', 'Tuesday', 'Wednesday',
+                                   'Thursday', 'Friday', 'Saturday',
+                                   'Sunday']}),
+            'd_time': d_time,
+        }
+
+    @staticmethod
+    def country():
+        return pd.DataFrame({'country_id': [1], 'country': ['Brasil']})
+
+    @staticmethod
+    def state():
+        return pd.DataFrame({'state_id': np.arange(1, 28),
+                             'state': [f'State {i}' for i in range(1, 28)],
+                             'country_id': 1})
+
+    def city(self):
+        cities = np.arange(1, 101)
+        return pd.DataFrame({'city_id': cities,
+                             'city': [f'City {i}' for i in cities],
+                             'state_id': (cities - 1) % 27 + 1})
+
+    def customers(self):
+        customers = np.arange(1, self.accounts + 1)
+        return pd.DataFrame({
+            'customer_id': customers,
+            'first_name': 'First',
+            'last_name': 'Last',
+            'customer_city': self.random.integers(1, 101, self.accounts),
+            'country_name': 'Brasil',
+            'cpf': [f'{cpf:011d}' for cpf in self.random.integers(
+                0, 10 ** 11, self.accounts)]})
+
+    def accounts_table(self):
+        accounts = np.arange(1, self.accounts + 1)
+        return pd.DataFrame({
+            'account_id': accounts,
+            'customer_id': accounts,
+            'created_at': '2019-12-01 00:00:00',
+            'status': 'active',
+            'account_branch': self.random.integers(1, 10, self.accounts),
+            'account_check_digit': self.random.integers(0, 10, self.accounts),
+            'account_number': accounts + 100000})
+
+    def _movements(self, per_account: int):
+        """
+        Generates the columns shared by the movement tables.
+
+        Returns:
+            tuple: The ids, accounts, amounts, requested and completed time
+                keys, as text with 'None' for the incomplete movements, and
+                statuses.
+        """
+        total = self.accounts * per_account
+        ids = self.random.choice(10 ** 12, size=total, replace=False)
+        accounts = np.repeat(np.arange(1, self.accounts + 1), per_account)
+        amounts = np.round(self.random.uniform(1, 1000, total), 2)
+        last_time = self.days * self.HOURS
+        requested = self.random.integers(1, last_time, total)
+        completed = np.minimum(requested + self.random.integers(0, 3, total),
+                               last_time).astype(str).astype(object)
+        incomplete = self.random.random(total) < self.none_rate
+        completed[incomplete] = 'None'
+        status = np.where(incomplete, 'failed', 'completed')
+        return ids, accounts, amounts, requested, completed, status
+
+    def _duplicate(self, df: pd.DataFrame):
+        """
+        Appends copies of a share of the rows, shuffling the result.
+        """
+        copies = df.sample(frac=self.duplicate_rate,
+                           random_state=self.random.integers(2 ** 31))
+        df = pd.concat([df, copies], ignore_index=True)
+        return df.sample(frac=1, random_state=self.random.integers(2 ** 31))
+
+    def transfer_table(self, per_account: int):
+        ids, accounts, amounts, requested, completed, status = \
+            self._movements(per_account)
+        return self._duplicate(pd.DataFrame({
+            'id': ids, 'account_id': accounts, 'amount': amounts,
+            'transaction_requested_at': requested,
+            'transaction_completed_at': completed, 'status': status}))
+
+    def pix_table(self):
+        ids, accounts, amounts, requested, completed, status = \
+            self._movements(self.pix)
+        return self._duplicate(pd.DataFrame({
+            'id': ids, 'account_id': accounts,
+            'in_or_out': self.random.choice(['pix_in', 'pix_out'], len(ids)),
+            'pix_amount': amounts, 'pix_requested_at': requested,
+            'pix_completed_at': completed, 'status': status}))
+
+    def _write_investments(self, directory: str):
+        """
+        Writes the investments as a json array of accounts with their
+        transactions, split into `self.files` files.
+
+        Returns:
+            int: The number of transactions.
+        """
+        ids, accounts, amounts, requested, completed, status = \
+            self._movements(self.investments)
+        types = self.random.choice(
+            ['investment_transfer_in', 'investment_transfer_out'], len(ids))
+
+        data = []
+        for account in range(self.accounts):
+            rows = slice(account * self.investments,
+                         (account + 1) * self.investments)
+            data.append({'account_id': str(account + 1), 'transactions': [
+                {'transaction_id': str(transaction_id), 'type': type_,
+                 'amount': float(amount),
+                 'investment_requested_at': int(requested_at),
+                 'investment_completed_at': completed_at if
+                 completed_at == 'None' else int(completed_at),
+                 'investment_completed_at_timestamp': 'None',
+                 'status': status_}
+                for transaction_id, type_, amount, requested_at,
+                completed_at, status_ in zip(
+                    ids[rows], types[rows], amounts[rows], requested[rows],
+                    completed[rows], status[rows])]})
+
+        path = os.path.join(directory, 'investments')
+        os.makedirs(path, exist_ok=True)
+        for number, part in enumerate(np.array_split(np.arange(len(data)),
+                                                     self.files)):
+            with open(os.path.join(path, f'investments_{number}.txt'),
+                      'w') as file_write:
+                json.dump([data[account] for account in part], file_write)
+        return len(ids)
+
+    @staticmethod
+    def _write_csv(df: pd.DataFrame, directory: str, table_name: str):
+        path = os.path.join(directory, table_name)
+        os.makedirs(path, exist_ok=True)
+        df.to_csv(os.path.join(path, f'{table_name}.csv'), index=False)
+
+    def _write_split(self, df: pd.DataFrame, directory: str,
+                     table_name: str):
+        """
+        Writes a movement table into `self.files` files, as csv, xlsx or
+        alternating between both.
+        """
+        path = os.path.join(directory, table_name)
+        os.makedirs(path, exist_ok=True)
+        for number, part in enumerate(np.array_split(df, self.files)):
+            extension = self.transfer_format
+            if extension == 'both':
+                extension = 'csv' if number % 2 == 0 else 'xlsx'
+            file = os.path.join(path, f'{table_name}_{number}.{extension}')
+            if extension == 'xlsx':
+                part.to_excel(file, index=False)
+            else:
+                part.to_csv(file, index=False)
@@ -1,159 +1,149 @@
 # Importing necessary libraries
 
-import numpy as np
+import argparse
 import pandas as pd
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Importing custom ConnectionPostgres class for database connection
+# Importing custom classes for database connection and balance calculation
 from connections.connection_postgresql import ConnectionPostgres
+from balance.investment_balance import InvestmentBalance
+from balance.result_writer import ResultWriter
+from balance.checkpoint import BalanceCheckpoint
+from balance.investment_reader import InvestmentReader
+from balance.account_codes import AccountCodes
 
 # Disabling the SettingWithCopyWarning
 pd.options.mode.chained_assignment = None
 
-# Establishing connection to the PostgreSQL database
-connection = ConnectionPostgres.connect(
-    os.getenv('DATABASE'))
-
-# Query to retrieve the necessary data from the database
-query = """select * from  investments i 
-left join  d_time dt on dt.time_id = i.investment_completed_at 
-left join d_month dm on dt.month_id = dm.month_id 
-left join d_year dy on dt.year_id = dy.year_id 
-where i.status = 'completed' order by dt.action_timestamp ;"""
-
-# Reading data from the database into a pandas DataFrame
-df = pd.read_sql(query,
-                 con=connection.engine)
-
-# Selecting the relevant columns for processing
-df = df[['account_id', 'type', 'amount', 'status', 'action_timestamp',
-         'action_month']]
-
-# Converting the action_timestamp column to a datetime type
-# and extracting the date
-df['action_timestamp'] = pd.to_datetime(df['action_timestamp'])
-df['action_timestamp'] = df['action_timestamp'].dt.date
-
-# In the data set there are only data from 2020-01-01 to 2020-12-31
-# I chose not to apply a filter directly.
-print(f'Start date: {df.action_timestamp.min()}')
-print(f'End date: {df.action_timestamp.max()}')
-
-# Getting the unique account IDs present in the DataFrame
-account_ids = df['account_id'].unique()
-# Looping through the unique account_id values
-for account_id in account_ids:
-    # Creating a copy of the DataFrame for the current account_id
-
-    df_temp = df[df['account_id'] == account_id].copy()
-
-    # Grouping the data by account_id, action_timestamp, and type, summing
-    # the amount column, and reshaping the data into a pivot table
-    df_temp = df_temp.groupby(
-        ['account_id', 'action_timestamp', 'action_month', 'type'])[
-        'amount'].sum().reset_index().pivot_table(
-        index=['account_id', 'action_timestamp', 'action_month'],
-        columns='type',
-        values='amount').reset_index()
-
-    # Replace missing values with 0
-    df_temp.replace(np.nan, 0, inplace=True)
-    # Rename columns to make code more readable
-    df_temp.rename(columns={
-        'investment_transfer_in': 'deposit',
-        'investment_transfer_out': 'withdrawal'}, inplace=True)
-    # Check for missing columns and add them with value 0 if not present
-    if 'withdrawal' not in df_temp.columns:
-        df_temp['withdrawal'] = 0
-    if 'deposit' not in df_temp.columns:
-        df_temp['deposit'] = 0
-    # Sort the dataframe by action_timestamp
-    df_temp.sort_values(by=['action_timestamp'], inplace=True)
-    # Add a new column called 'balance' to the dataframe with NaN values
-    df_temp['balance'] = np.nan
-    # Assign the first value of the 'balance' column as the first
-    # deposit value multiplied by 1 + 0.0001 * 1
-    df_temp['balance'][0] = (df_temp['deposit'][0] - df_temp['withdrawal'][
-        0]) * (1 + 0.0001 * 1)
-
-    df_temp['income'] = np.nan
-    df_temp['income'][0] = (df_temp['deposit'][0] - df_temp['withdrawal'][
-        0]) * (0.01 / 100)
-
-    # loop through each record in df_temp
-    for i in range(1, len(df_temp)):
-        # retrieve the previous balance
-        balance = df_temp['balance'][i - 1]
-        # retrieve the deposit amount
-
-        deposit = df_temp['deposit'][i]
-        # retrieve the withdrawal amount
-
-        withdrawal = df_temp['withdrawal'][i]
-        # calculate the number of days between transactions
-
-        days = (df_temp['action_timestamp'][i] - df_temp['action_timestamp'][
-            i - 1]).days
-        # calculate the current balance based on previous balance, deposit,
-        # withdrawal, and number of days
-
-        calculate = balance * (1 + 0.0001 * days) + deposit - withdrawal
-        # if the calculated balance is negative, set the current balance
-        # to the previous balance plus deposit
-
-        if calculate < 0:
-            df_temp['balance'][i] = df_temp['balance'][i - 1] * (
-                    1 + 0.0001 * days) + deposit
-            df_temp['income'][i] = 0
-        else:
-            df_temp['balance'][i] = calculate
-            df_temp['income'][i] = ((df_temp['deposit'][0] -
-                                     df_temp['withdrawal'][0]) + (
-                                        df_temp['income'][i - 1])) * (
-                                           0.01 / 100 * days)
-    # check if df_result exists in the local scope
-    if 'df_result' not in locals():
-        # if not, assign df_temp to df_result
-
-        df_result = df_temp
+
+def main(uri_connection_postgresql, workers=1, full_rebuild=False,
+         parquet_dir=None, partitions=1, output_format='csv', output=None,
+         partition_by_month=False, writer_workers=1, load_table=None):
+    # Establishing connection to the PostgreSQL database
+    connection = ConnectionPostgres.connect(uri_connection_postgresql)
+
+    # Loading the state of the accounts saved by the previous run. Without a
+    # state, or when a full rebuild is requested, every account is
+    # calculated from its first investment
+    state = None if full_rebuild else BalanceCheckpoint.load(connection)
+    since = None if state is None else BalanceCheckpoint.next_date(state)
+
+    # The accounts and days are carried as int32 codes and day numbers
+    # through the calculation, and mapped back only when the results and the
+    # state are written
+    codes = AccountCodes()
+    state = codes.encode_state(state)
+
+    # Reading the deposits and withdrawals of each account and day, summed by
+    # the database and streamed in chunks, or fetched concurrently as
+    # partitions of accounts that are calculated while the next ones are
+    # fetched, or read from the Parquet staging layer when one is given, only
+    # with the investments completed after the checkpoint when there is one
+    if parquet_dir is not None:
+        chunks = InvestmentReader.read_parquet_movements(parquet_dir,
+                                                         since=since,
+                                                         codes=codes)
+    elif partitions > 1:
+        chunks = InvestmentReader.read_partitioned_movements(
+            connection, partitions, since=since, codes=codes)
+    else:
+        chunks = InvestmentReader.read_daily_movements(connection,
+                                                       since=since,
+                                                       codes=codes)
+
+    # With a single worker each chunk is calculated as soon as it arrives.
+    # With more than one worker the chunks are gathered and the accounts are
+    # split across a process pool, and the output is the same as with a
+    # single worker.
+    if workers > 1:
+        chunks = list(chunks)
+        results = [] if not chunks else \
+            InvestmentBalance.iter_calculate_parallel(
+                pd.concat(chunks, ignore_index=True), workers=workers,
+                state=state)
     else:
-        # if it exists, concatenate df_temp with df_result
-
-        df_result = pd.concat([df_result, df_temp])
-
-# Convert the action_timestamp column to datetime format and extract only the
-# day from it, then assign it back to the 'action_timestamp'
-# column in the 'df_result' dataframe.
-df_result['action_timestamp'] = pd.to_datetime(df['action_timestamp']).dt.day
-
-# Rounding the values in the 'balance' and 'income' columns to 2 decimal places
-df_result.balance = df_result.balance.apply(lambda x: round(x, 2))
-df_result.income = df_result.income.apply(lambda x: round(x, 2))
-
-# This code block renames the columns of the df_result DataFrame.
-# The original column names are mapped to new names in a dictionary passed
-# to the rename method. Then, the resulting DataFrame is
-# reordered to only include the columns in the
-# specified order in the list ['Day', 'Month', 'Account ID',
-# 'Deposit', 'Withdrawal', 'End of Day Income', 'Account Daily Balance'].
-df_result = (
-    df_result.rename(
-        columns={'action_timestamp': 'Day', 'action_month': 'Month',
-                 'deposit': 'Deposit', 'withdrawal': 'Withdrawal',
-                 'income': 'End of Day Income',
-                 'balance': 'Account Daily Balance',
-                 'account_id': 'Account ID'
-                 })[
-        ['Day', 'Month', 'Account ID', 'Deposit', 'Withdrawal',
-         'End of Day Income',
-         'Account Daily Balance']]
-)
-# Save result dataframe to a csv file
-# The resulting file will be named as "investments.csv" and will be
-# stored in the same directory as this script
-# The "index" parameter is set to False to not include the
-# index column in the csv file
-df_result.to_csv('investments.csv', index=False)
+        results = InvestmentBalance.iter_calculate_chunks(chunks, state=state)
+
+    # Streaming each batch of results to the report, by default the
+    # "investments.csv" file in the same directory as this script, as soon as
+    # it is calculated, optionally split by month and loaded into a table.
+    # Incremental runs append the new days to the existing report and table.
+    # The state of the accounts for the next run is saved in the transaction
+    # of the table, and the report is only replaced once it is committed, so
+    # a failed run neither adds its days nor moves the checkpoint
+    updates = []
+    if output is None:
+        output = 'investments' if partition_by_month else \
+            'investments' + ResultWriter.FORMATS[output_format]
+    with ResultWriter(
+            output,
+            append=state is not None, codes=codes,
+            output_format=output_format,
+            partition_by_month=partition_by_month, workers=writer_workers,
+            connection=None if load_table is None else connection,
+            table_name=load_table or ResultWriter.TABLE_NAME) as writer:
+        for df_result in results:
+            writer.write(df_result)
+            updates.append(InvestmentBalance.last_state(df_result, state))
+
+        if updates:
+            df_updates = pd.concat(updates)
+            df_state = codes.decode_state(BalanceCheckpoint.merge(
+                state, df_updates))
+            writer.commit(lambda transaction: BalanceCheckpoint.save(
+                connection, df_state, transaction))
+
+    if not updates:
+        print(f'No completed investments since {since}')
+        return
+
+    print(f'Rows written: {writer.rows}')
+    print(f'End date: {codes.dates([df_updates.last_date.max()])[0]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Calculates the daily balance and income of the '
+                    'investment accounts.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used in the calculation.')
+    parser.add_argument('--full-rebuild', action='store_true',
+                        help='Ignores the saved state and recalculates '
+                             'every account from its first investment.')
+    parser.add_argument('--source', choices=['postgresql', 'parquet'],
+                        default='postgresql',
+                        help='Reads the investments from the database or '
+                             'from the Parquet staging layer.')
+    parser.add_argument('--parquet-dir', default='staging',
+                        help='Root directory of the Parquet staging layer.')
+    parser.add_argument('--partitions', type=int, default=1,
+                        help='Number of partitions of accounts fetched '
+                             'concurrently from the database. The rows of '
+                             'the report are the same for any number of '
+                             'partitions, but their order changes with it.')
+    parser.add_argument('--output-format', choices=['csv', 'csv.gz',
+                                                    'parquet'],
+                        default='csv', help='Format of the report.')
+    parser.add_argument('--output', default=None,
+                        help='Path of the report, by default investments '
+                             'with the extension of the format, or the '
+                             'investments directory when partitioned.')
+    parser.add_argument('--partition-by-month', action='store_true',
+                        help='Writes one file of the report per month.')
+    parser.add_argument('--writer-workers', type=int, default=1,
+                        help='Number of threads writing the report.')
+    parser.add_argument('--load-table', nargs='?', default=None,
+                        const=ResultWriter.TABLE_NAME,
+                        help='Also loads the results into a table, by '
+                             'default investment_daily_balance.')
+    args = parser.parse_args()
+
+    main(os.getenv('DATABASE'), workers=args.workers,
+         full_rebuild=args.full_rebuild,
+         parquet_dir=args.parquet_dir if args.source == 'parquet' else None,
+         partitions=args.partitions, output_format=args.output_format,
+         output=args.output, partition_by_month=args.partition_by_month,
+         writer_workers=args.writer_workers, load_table=args.load_table)
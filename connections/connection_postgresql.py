@@ -1,4 +1,11 @@
-from sqlalchemy import create_engine
+import csv
+import io
+import os
+import threading
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 
 
@@ -6,6 +13,11 @@ class ConnectionPostgres:
     """
     Class to create and manage a connection to a PostgreSQL database using SQLAlchemy.
 
+    The engines are shared: every connection to the same URI in a process
+    reuses one engine and its connection pool, from threads as well. A
+    process created by fork gets fresh pools for the inherited engines, so
+    it never uses the connections of its parent.
+
     Attributes:
         database_uri (str): The database URI used for connection.
         engine (SQLAlchemy engine object): The SQLAlchemy engine used for connection.
@@ -13,18 +25,31 @@ class ConnectionPostgres:
 
     """
 
+    # Default configuration of the pools of PostgreSQL engines
+    POOL_SIZE = 5
+    MAX_OVERFLOW = 10
+    POOL_TIMEOUT = 30
+    POOL_RECYCLE = 1800
+    # Statement timeout, in milliseconds, or None for the server default
+    STATEMENT_TIMEOUT = None
+
+    _engines = {}
+    _lock = threading.Lock()
+
     def __init__(self):
         self.database_uri = None
         self.engine = None
         self.session = None
 
     @classmethod
-    def connect(cls, connection):
+    def connect(cls, connection, **engine_options):
         """
         Connects to the PostgreSQL database using SQLAlchemy.
 
         Args:
             connection (str): The URI to the database.
+            engine_options: Options of `get_engine`, used only if the engine
+                of the URI was not created yet.
 
         Returns:
             connection_database (ConnectionPostgres): An instance of the class, with a connected session to the database.
@@ -32,10 +57,145 @@ class ConnectionPostgres:
         """
         connection_database = cls()
         connection_database.database_uri = connection
-        connection_database.engine = create_engine(
-            connection_database.database_uri, echo=False, pool_recycle=1800
-        )
+        connection_database.engine = cls.get_engine(connection,
+                                                    **engine_options)
         Session = sessionmaker(bind=connection_database.engine)
         connection_database.session = Session()
 
         return connection_database
+
+    @classmethod
+    def get_engine(cls, connection, pool_size: int = None,
+                   max_overflow: int = None, statement_timeout: int = None):
+        """
+        Returns the shared engine of a database URI, creating it on the first
+        call.
+
+        PostgreSQL engines get a connection pool of `pool_size` connections
+        plus `max_overflow` temporary ones, psycopg2's batch helpers for
+        executemany (execute_values for inserts and execute_batch for the
+        other statements) and an optional statement timeout. Other databases
+        keep the defaults of SQLAlchemy.
+
+        Args:
+            connection (str): The URI to the database.
+            pool_size (int): The number of pooled connections. Defaults to
+                `POOL_SIZE`.
+            max_overflow (int): The number of connections allowed beyond the
+                pool. Defaults to `MAX_OVERFLOW`.
+            statement_timeout (int): The statement timeout in milliseconds.
+                Defaults to `STATEMENT_TIMEOUT`.
+
+        Returns:
+            engine (SQLAlchemy engine object): The engine of the URI.
+        """
+        with cls._lock:
+            engine = cls._engines.get(connection)
+            if engine is not None:
+                return engine
+
+            url = make_url(connection)
+            options = {'echo': False, 'pool_recycle': cls.POOL_RECYCLE}
+            if url.get_backend_name() == 'postgresql':
+                options.update(
+                    pool_size=cls.POOL_SIZE if pool_size is None
+                    else pool_size,
+                    max_overflow=cls.MAX_OVERFLOW if max_overflow is None
+                    else max_overflow,
+                    pool_timeout=cls.POOL_TIMEOUT,
+                    pool_pre_ping=True)
+                if url.get_driver_name() == 'psycopg2':
+                    options['executemany_mode'] = 'values_plus_batch'
+
+                timeout = cls.STATEMENT_TIMEOUT if statement_timeout is None \
+                    else statement_timeout
+                if timeout is not None:
+                    options['connect_args'] = {
+                        'options': f'-c statement_timeout={int(timeout)}'}
+
+            engine = create_engine(connection, **options)
+            cls._engines[connection] = engine
+            return engine
+
+    @classmethod
+    def _after_fork(cls):
+        """
+        Replaces the pools of the engines inherited by a forked process,
+        without closing the connections, which still belong to the parent.
+        """
+        cls._lock = threading.Lock()
+        for engine in cls._engines.values():
+            engine.dispose(close=False)
+
+    @staticmethod
+    def upsert(table, conn, keys, data_iter):
+        """
+        Inserts rows into a table with INSERT ... ON CONFLICT DO UPDATE on its
+        primary key, to be used as the `method` of DataFrame.to_sql, so the
+        rows whose keys are already in the table replace them.
+
+        Args:
+            table (pandas.io.sql.SQLTable): The destination table.
+            conn (SQLAlchemy connection object): The connection used by
+                DataFrame.to_sql.
+            keys (list): The column names.
+            data_iter (iterable): The rows of the chunk.
+
+        Returns:
+            int: The number of inserted or updated rows.
+        """
+        if conn.dialect.name == 'postgresql':
+            insert = postgresql.insert
+        elif conn.dialect.name == 'sqlite':
+            insert = sqlite.insert
+        else:
+            raise NotImplementedError(
+                f'ON CONFLICT is not supported by {conn.dialect.name}')
+
+        rows = [dict(zip(keys, row)) for row in data_iter]
+        if not rows:
+            return 0
+        primary_key = inspect(conn).get_pk_constraint(
+            table.name, schema=table.schema)['constrained_columns']
+        statement = insert(table.table)
+        statement = statement.on_conflict_do_update(
+            index_elements=primary_key,
+            set_={key: statement.excluded[key] for key in keys
+                  if key not in primary_key})
+        return conn.execute(statement, rows).rowcount
+
+    @staticmethod
+    def copy_insert(table, conn, keys, data_iter):
+        """
+        Inserts rows into a table with PostgreSQL COPY FROM STDIN, to be used
+        as the `method` of DataFrame.to_sql.
+
+        The rows are serialized as csv into an in-memory buffer, one buffer
+        per chunk of DataFrame.to_sql.
+
+        Args:
+            table (pandas.io.sql.SQLTable): The destination table.
+            conn (SQLAlchemy connection object): The connection used by
+                DataFrame.to_sql.
+            keys (list): The column names.
+            data_iter (iterable): The rows of the chunk.
+
+        Returns:
+            int: The number of inserted rows.
+        """
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(data_iter)
+        buffer.seek(0)
+
+        columns = ', '.join(f'"{key}"' for key in keys)
+        table_name = f'"{table.name}"' if not table.schema else \
+            f'"{table.schema}"."{table.name}"'
+
+        with conn.connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {table_name} ({columns}) FROM STDIN WITH CSV', buffer)
+            return cursor.rowcount
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=ConnectionPostgres._after_fork)
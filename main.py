@@ -1,15 +1,86 @@
 from process_data.read_and_process_postgresql import \
     ProcessDataSetsPostgresql
+import argparse
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
-def main(uri_connection_postgresql):
+def main(uri_connection_postgresql, workers=1, streaming=False,
+         excel_workers=1, use_manifest=True, parquet_dir=None,
+         metrics_format=None, metrics_file=None, profile_dir=None,
+         trace_memory=False, monthly_balance=False, check_integrity=True,
+         quarantine_dir='quarantine', rebuild_monthly_balance=False):
     ProcessDataSetsPostgresql.run_all_ingestions(
-        connection=uri_connection_postgresql)
+        connection=uri_connection_postgresql, workers=workers,
+        streaming=streaming, excel_workers=excel_workers,
+        use_manifest=use_manifest, parquet_dir=parquet_dir,
+        metrics_format=metrics_format, metrics_file=metrics_file,
+        profile_dir=profile_dir, trace_memory=trace_memory,
+        monthly_balance=monthly_balance, check_integrity=check_integrity,
+        quarantine_dir=quarantine_dir,
+        rebuild_monthly_balance=rebuild_monthly_balance)
 
 
 if __name__ == '__main__':
-    main(os.getenv('DATABASE'))
+    parser = argparse.ArgumentParser(
+        description='Loads the tables of the Tables directory into the '
+                    'database.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of tables loaded concurrently.')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Loads the transfer and pix files in chunks '
+                             'through staging tables.')
+    parser.add_argument('--excel-workers', type=int, default=1,
+                        help='Number of processes used to parse the Excel '
+                             'files of a table.')
+    parser.add_argument('--ignore-manifest', action='store_true',
+                        help='Loads every file, including the ones already '
+                             'recorded in the ingestion manifest.')
+    parser.add_argument('--parquet-dir', nargs='?', const='staging',
+                        default=None,
+                        help='Also writes the cleaned tables as Parquet, '
+                             'partitioned by month, into this directory '
+                             '(default: staging).')
+    parser.add_argument('--metrics', choices=['jsonl', 'prometheus'],
+                        default=None,
+                        help='Measures each step and its phases and writes '
+                             'the metrics in this format.')
+    parser.add_argument('--metrics-file', default=None,
+                        help='File of the metrics. Defaults to the standard '
+                             'output.')
+    parser.add_argument('--profile-dir', default=None,
+                        help='Writes the cProfile statistics of each step '
+                             'into this directory.')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Traces the Python allocations of each step '
+                             'with tracemalloc.')
+    parser.add_argument('--monthly-balance', action='store_true',
+                        help='Maintains the account_monthly_balance table '
+                             'of monthly_balance.sql, refreshing the accounts '
+                             'and months of the loaded movements. Requires '
+                             'PostgreSQL.')
+    parser.add_argument('--rebuild-monthly-balance', action='store_true',
+                        help='Recomputes the account_monthly_balance table '
+                             'for every account instead of only the loaded '
+                             'movements. Implies --monthly-balance.')
+    parser.add_argument('--skip-integrity-check', action='store_true',
+                        help='Loads the rows without checking their foreign '
+                             'keys first.')
+    parser.add_argument('--quarantine-dir', default='quarantine',
+                        help='Directory of the csv files of the rows whose '
+                             'foreign keys are not in their parent tables.')
+    args = parser.parse_args()
+
+    main(os.getenv('DATABASE'), workers=args.workers,
+         streaming=args.streaming, excel_workers=args.excel_workers,
+         use_manifest=not args.ignore_manifest,
+         parquet_dir=args.parquet_dir, metrics_format=args.metrics,
+         metrics_file=args.metrics_file, profile_dir=args.profile_dir,
+         trace_memory=args.trace_memory,
+         monthly_balance=args.monthly_balance or
+         args.rebuild_monthly_balance,
+         check_integrity=not args.skip_integrity_check,
+         quarantine_dir=args.quarantine_dir,
+         rebuild_monthly_balance=args.rebuild_monthly_balance)
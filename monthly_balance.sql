@@ -0,0 +1,38 @@
+-- Monthly running balance of the accounts, maintained by the ingestion with
+-- `python main.py --monthly-balance` instead of recomputed by
+-- query_calculate_balance.sql. The balance of an account in a month is a
+-- primary key read of "account_monthly_balance" by "account_id", "year" and
+-- "month"
+
+CREATE TABLE IF NOT EXISTS "account_monthly_balance" (
+  "account_id" uuid,
+  "year" int,
+  "month" int,
+  "net_amount" float,
+  "balance" float,
+  PRIMARY KEY ("account_id", "year", "month")
+);
+
+-- Accounts and time keys of the loaded movements not refreshed yet
+CREATE TABLE IF NOT EXISTS "account_monthly_balance_pending" (
+  "account_id" uuid NOT NULL,
+  "time_id" int NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS "transfer_ins_account_id_status_idx" ON "transfer_ins" ("account_id", "status");
+
+CREATE INDEX IF NOT EXISTS "transfer_outs_account_id_status_idx" ON "transfer_outs" ("account_id", "status");
+
+CREATE INDEX IF NOT EXISTS "pix_movements_account_id_status_idx" ON "pix_movements" ("account_id", "status");
+
+CREATE INDEX IF NOT EXISTS "transfer_ins_transaction_requested_at_idx" ON "transfer_ins" ("transaction_requested_at");
+
+CREATE INDEX IF NOT EXISTS "transfer_ins_transaction_completed_at_idx" ON "transfer_ins" ("transaction_completed_at");
+
+CREATE INDEX IF NOT EXISTS "transfer_outs_transaction_requested_at_idx" ON "transfer_outs" ("transaction_requested_at");
+
+CREATE INDEX IF NOT EXISTS "transfer_outs_transaction_completed_at_idx" ON "transfer_outs" ("transaction_completed_at");
+
+CREATE INDEX IF NOT EXISTS "pix_movements_pix_requested_at_idx" ON "pix_movements" ("pix_requested_at");
+
+CREATE INDEX IF NOT EXISTS "pix_movements_pix_completed_at_idx" ON "pix_movements" ("pix_completed_at");
@@ -0,0 +1,142 @@
+import json
+import os
+
+import pandas as pd
+
+from process_data.schemas import TableSchema
+from utils.instrumentation import Instrumentation
+from utils.utils import Utils
+
+
+class InvestmentJsonReader:
+    """
+    Class to read the investment json files incrementally.
+
+    The files hold a top-level array of accounts, each one with its
+    'account_id' and the array of its 'transactions'. Instead of loading the
+    whole file and normalizing it, the accounts are decoded one at a time
+    from a buffer of bounded size and their transactions are gathered into
+    typed column batches, so the memory depends on the batch size and not
+    on the size of the file.
+    """
+
+    # Columns of the batches, in the order of the 'investments' table.
+    # 'investment_completed_at_timestamp' is not read
+    TRANSACTION_COLUMNS = ('transaction_id', 'type', 'amount',
+                           'investment_requested_at',
+                           'investment_completed_at', 'status')
+
+    # Number of characters read from the file at a time
+    BUFFER_SIZE = 1024 * 1024
+
+    @classmethod
+    def iter_accounts(cls, file: str, buffer_size: int = BUFFER_SIZE):
+        """
+        Decodes the accounts of a json file one at a time.
+
+        Parameters:
+            file (str): The path of the file.
+            buffer_size (int): The number of characters read at a time.
+
+        Yields:
+            dict: The accounts, with their 'account_id' and 'transactions'.
+        """
+        decoder = json.JSONDecoder()
+        with open(file) as file_read:
+            buffer = ''
+            while not buffer.strip():
+                data = file_read.read(buffer_size)
+                if not data:
+                    break
+                buffer += data
+            buffer = buffer.lstrip()
+            if not buffer.startswith('['):
+                raise ValueError(f'{file}: expected a json array')
+            position = 1
+            end_of_file = False
+
+            while True:
+                # Skipping the separators between the accounts
+                while position < len(buffer) and buffer[position] in \
+                        ' \t\r\n,':
+                    position += 1
+                if position < len(buffer) and buffer[position] == ']':
+                    return
+
+                try:
+                    account, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if end_of_file:
+                        raise
+                    # The account continues in the next part of the file
+                    data = file_read.read(buffer_size)
+                    end_of_file = not data
+                    buffer = buffer[position:] + data
+                    position = 0
+                    continue
+                yield account
+
+    @classmethod
+    def iter_batches(cls, file: str, batch_size: int = 100000):
+        """
+        Reads the transactions of a json file in batches, with the dtypes of
+        the 'investments' schema. The 'None' values are read as missing
+        values and the 'transaction_id' and 'account_id' columns are
+        converted to UUID version 4.
+
+        Parameters:
+            file (str): The path of the file.
+            batch_size (int): The approximate number of transactions of each
+                batch. The transactions of an account are never split.
+
+        Yields:
+            DataFrame: The batches of transactions.
+        """
+        accounts = cls.iter_accounts(file)
+        bytes_read = os.path.getsize(file)
+        while True:
+            with Instrumentation.phase('read',
+                                       bytes_read=bytes_read) as phase:
+                columns, account_ids = cls._collect(accounts, batch_size)
+                phase['rows'] = len(account_ids)
+            bytes_read = None
+            if not account_ids:
+                return
+            yield cls._batch(columns, account_ids)
+
+    @classmethod
+    def _collect(cls, accounts, batch_size: int):
+        """
+        Gathers the transactions of the next accounts into column lists,
+        until there are at least `batch_size` transactions or no accounts
+        left.
+
+        Returns:
+            tuple: The column lists and the 'account_id' of each transaction.
+        """
+        columns = {column: [] for column in cls.TRANSACTION_COLUMNS}
+        account_ids = []
+        for account in accounts:
+            transactions = account['transactions']
+            account_ids.extend([account['account_id']] * len(transactions))
+            for column, values in columns.items():
+                values.extend([transaction.get(column)
+                               for transaction in transactions])
+            if len(account_ids) >= batch_size:
+                break
+        return columns, account_ids
+
+    @staticmethod
+    def _batch(columns: dict, account_ids: list):
+        """
+        Builds a typed batch from the column lists of the transactions.
+        """
+        df = pd.DataFrame(columns)
+        df.insert(1, 'account_id', account_ids)
+        df = Utils.convert_none_values(df)
+        TableSchema.apply(df, 'investments')
+        df['transaction_id'] = Utils.convert_int_series_to_uuid_version_4(
+            df['transaction_id'])
+        df['account_id'] = Utils.convert_int_series_to_uuid_version_4(
+            df['account_id'])
+        return df
@@ -0,0 +1,252 @@
+import os
+
+from pandas import DataFrame
+from sqlalchemy import text
+
+from connections.connection_postgresql import ConnectionPostgres
+
+
+class MonthlyBalance:
+    """
+    Class to maintain the 'account_monthly_balance' table, the materialized
+    result of query_calculate_balance.sql, declared in monthly_balance.sql.
+
+    The loads of transfers and pix movements record the accounts and time
+    keys of their completed rows in a pending table, in the same transaction
+    as the rows. A refresh then recomputes the net amount of only the
+    touched months of the touched accounts, with index scans by
+    'account_id' and 'status', and the running balance of those accounts
+    from their first touched month on. The movements are summed with UNION
+    ALL, since their ids are already unique. This class requires PostgreSQL.
+    """
+
+    TABLE_NAME = 'account_monthly_balance'
+    PENDING_TABLE = 'account_monthly_balance_pending'
+
+    # DDL of the tables and of the supporting indexes
+    SQL_FILE = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'monthly_balance.sql')
+
+    # Time key that places the movements of each table in a month, as in
+    # query_calculate_balance.sql
+    TIME_KEYS = {
+        'transfer_ins': 'transaction_requested_at',
+        'transfer_outs': 'transaction_requested_at',
+        'pix_movements': 'pix_completed_at',
+    }
+
+    # Months touched by the pending rows, which are consumed
+    TOUCHED_STATEMENTS = (
+        """
+        CREATE TEMPORARY TABLE touched_months (
+            account_id uuid, "year" int, "month" int) ON COMMIT DROP
+        """,
+        """
+        WITH touched AS (
+            DELETE FROM account_monthly_balance_pending
+            RETURNING account_id, time_id
+        )
+        INSERT INTO touched_months
+        SELECT DISTINCT
+            touched.account_id,
+            extract(year from dt.action_timestamp)::int,
+            extract(month from dt.action_timestamp)::int
+        FROM touched
+        JOIN d_time dt ON dt.time_id = touched.time_id
+        """,
+        """
+        DELETE FROM account_monthly_balance b
+        USING touched_months m
+        WHERE b.account_id = m.account_id
+            AND b."year" = m."year"
+            AND b."month" = m."month"
+        """,
+    )
+
+    # Net amount of the touched months
+    NET_AMOUNT_STATEMENT = """
+        INSERT INTO account_monthly_balance (
+            account_id, "year", "month", net_amount)
+        SELECT
+            movements.account_id,
+            movements."year",
+            movements."month",
+            sum(movements.amount)
+        FROM (
+            SELECT
+                ti.account_id,
+                extract(year from dt.action_timestamp)::int AS "year",
+                extract(month from dt.action_timestamp)::int AS "month",
+                ti.amount
+            FROM transfer_ins ti
+            JOIN d_time dt ON dt.time_id = ti.transaction_requested_at
+            WHERE ti.status = 'completed'
+                AND ti.account_id IN (SELECT account_id FROM touched_months)
+            UNION ALL
+            SELECT
+                tout.account_id,
+                extract(year from dt.action_timestamp)::int,
+                extract(month from dt.action_timestamp)::int,
+                -tout.amount
+            FROM transfer_outs tout
+            JOIN d_time dt ON dt.time_id = tout.transaction_requested_at
+            WHERE tout.status = 'completed'
+                AND tout.account_id IN (SELECT account_id FROM touched_months)
+            UNION ALL
+            SELECT
+                p.account_id,
+                extract(year from dt.action_timestamp)::int,
+                extract(month from dt.action_timestamp)::int,
+                CASE WHEN p.in_or_out = 'pix_in'
+                    THEN p.pix_amount ELSE -p.pix_amount END
+            FROM pix_movements p
+            JOIN d_time dt ON dt.time_id = p.pix_completed_at
+            WHERE p.status = 'completed'
+                AND p.account_id IN (SELECT account_id FROM touched_months)
+        ) AS movements
+        JOIN touched_months m
+            ON m.account_id = movements.account_id
+            AND m."year" = movements."year"
+            AND m."month" = movements."month"
+        GROUP BY movements.account_id, movements."year", movements."month"
+    """
+
+    # Running balance of the touched accounts from their first touched month
+    RUNNING_BALANCE_STATEMENT = """
+        UPDATE account_monthly_balance b
+        SET balance = running.balance
+        FROM (
+            SELECT
+                account_id,
+                "year",
+                "month",
+                sum(net_amount) OVER (
+                    PARTITION BY account_id ORDER BY "year", "month"
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                ) AS balance
+            FROM account_monthly_balance
+            WHERE account_id IN (SELECT account_id FROM touched_months)
+        ) AS running
+        JOIN (
+            SELECT account_id, min("year" * 100 + "month") AS first_month
+            FROM touched_months
+            GROUP BY account_id
+        ) AS first_touched ON first_touched.account_id = running.account_id
+        WHERE b.account_id = running.account_id
+            AND b."year" = running."year"
+            AND b."month" = running."month"
+            AND running."year" * 100 + running."month" >=
+                first_touched.first_month
+    """
+
+    # Marks every account with completed movements as pending
+    REBUILD_STATEMENT = """
+        INSERT INTO account_monthly_balance_pending (account_id, time_id)
+        SELECT account_id, transaction_requested_at FROM transfer_ins
+        WHERE status = 'completed' AND transaction_requested_at IS NOT NULL
+        UNION
+        SELECT account_id, transaction_requested_at FROM transfer_outs
+        WHERE status = 'completed' AND transaction_requested_at IS NOT NULL
+        UNION
+        SELECT account_id, pix_completed_at FROM pix_movements
+        WHERE status = 'completed' AND pix_completed_at IS NOT NULL
+    """
+
+    @classmethod
+    def create(cls, connection: str):
+        """
+        Creates the tables and the indexes of monthly_balance.sql, if they do
+        not exist yet. The tables of sql.sql must already exist.
+
+        Parameters:
+            connection (str): The URI to the database.
+
+        Returns:
+            None
+        """
+        with open(cls.SQL_FILE) as file_read:
+            statements = [statement for statement in
+                          file_read.read().split(';') if statement.strip()]
+
+        with ConnectionPostgres.connect(connection).engine.begin() as conn:
+            for statement in statements:
+                conn.execute(text(statement))
+
+    @classmethod
+    def record(cls, connection, df: DataFrame, table_name: str):
+        """
+        Records the accounts and time keys of the completed rows of a loaded
+        dataframe as pending, inside the transaction of the load.
+
+        Parameters:
+            connection (Connection): The SQLAlchemy connection of the load
+                transaction.
+            df (DataFrame): The loaded rows.
+            table_name (str): The name of the table. Tables that are not part
+                of the balance are ignored.
+
+        Returns:
+            None
+        """
+        column = cls.TIME_KEYS.get(table_name)
+        if column is None:
+            return
+
+        df_touched = df.loc[df['status'] == 'completed',
+                            ['account_id', column]].dropna().drop_duplicates()
+        df_touched.rename(columns={column: 'time_id'}).to_sql(
+            cls.PENDING_TABLE, con=connection, if_exists='append',
+            index=False)
+
+    @classmethod
+    def record_table(cls, connection, source: str, table_name: str):
+        """
+        Records the accounts and time keys of the completed rows of a table,
+        such as a staging table, as pending.
+
+        Parameters:
+            connection (Connection): The SQLAlchemy connection of the load
+                transaction.
+            source (str): The quoted name of the table with the rows.
+            table_name (str): The name of the destination table.
+
+        Returns:
+            None
+        """
+        column = cls.TIME_KEYS.get(table_name)
+        if column is None:
+            return
+
+        connection.execute(text(
+            f'INSERT INTO "{cls.PENDING_TABLE}" (account_id, time_id) '
+            f'SELECT DISTINCT account_id, "{column}" FROM {source} '
+            f'WHERE status = \'completed\' AND "{column}" IS NOT NULL'))
+
+    @classmethod
+    def refresh(cls, connection: str, rebuild: bool = False):
+        """
+        Recomputes the balance of the pending accounts and months, in a
+        single transaction. Every account is recomputed when the table is
+        still empty, so it is filled the first time even if the movements
+        were loaded before it was maintained.
+
+        Parameters:
+            connection (str): The URI to the database.
+            rebuild (bool): Whether every account is recomputed, even if the
+                table is already filled.
+
+        Returns:
+            int: The number of refreshed account months.
+        """
+        with ConnectionPostgres.connect(connection).engine.begin() as conn:
+            if not rebuild:
+                rebuild = conn.execute(text(
+                    f'SELECT NOT EXISTS (SELECT 1 FROM "{cls.TABLE_NAME}")'
+                )).scalar()
+            if rebuild:
+                conn.execute(text(cls.REBUILD_STATEMENT))
+            for statement in cls.TOUCHED_STATEMENTS:
+                conn.execute(text(statement))
+            refreshed = conn.execute(text(cls.NET_AMOUNT_STATEMENT)).rowcount
+            conn.execute(text(cls.RUNNING_BALANCE_STATEMENT))
+        return refreshed
@@ -0,0 +1,209 @@
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from process_data.time_index import DTimeIndex
+from utils.instrumentation import Instrumentation
+
+try:
+    import pyarrow
+    from pyarrow import compute as pyarrow_compute
+    from pyarrow import parquet as pyarrow_parquet
+except ImportError:
+    pyarrow = None
+
+
+class ParquetStaging:
+    """
+    Class to keep a columnar copy of the cleaned tables as Parquet files,
+    one directory per table, and to read them back with predicate pushdown
+    and column projection.
+
+    The tables with a completion time key are partitioned by the month of
+    that key, resolved through the index of 'd_time', into 'month=YYYY-MM'
+    directories, so a read limited to some months only opens their files.
+    The rows without the key, or whose key is not in 'd_time', go into the
+    'month=0000-00' partition, which sorts before every month. The date of
+    the key is stored as well, in a column named after it such as
+    'investment_completed_date', so the readers of the staging layer do not
+    need to join 'd_time'. The categorical columns are stored as plain
+    strings, so the files of a table can always be read together.
+    Every write adds new files to the table, in the same way rows are
+    appended to the database tables.
+
+    Attributes:
+        path (str): The root directory of the staging layer.
+        connection (ConnectionPostgres): Optional database connection, used
+            to resolve the months when 'd_time' is not staged yet.
+        time_index (DTimeIndex): Optional index of 'd_time', otherwise loaded
+            when it is first needed.
+    """
+
+    # Default root directory of the staging layer
+    STAGING_DIR = 'staging'
+
+    # Partition of the rows whose month is not known
+    MISSING_MONTH = '0000-00'
+
+    # Time key whose month partitions each table
+    PARTITION_COLUMNS = {
+        'investments': 'investment_completed_at',
+        'pix_movements': 'pix_completed_at',
+        'transfer_ins': 'transaction_completed_at',
+        'transfer_outs': 'transaction_completed_at',
+    }
+
+    def __init__(self, path: str = STAGING_DIR, connection=None,
+                 time_index: DTimeIndex = None):
+        if pyarrow is None:
+            raise ImportError('pyarrow is required by the Parquet staging '
+                              'layer')
+        self.path = path
+        self.connection = connection
+        self._time_index = time_index
+
+    def table_path(self, table_name: str):
+        """
+        Returns the directory of a table.
+        """
+        return os.path.join(self.path, table_name)
+
+    def exists(self, table_name: str):
+        """
+        Returns whether a table was already staged.
+        """
+        return os.path.isdir(self.table_path(table_name))
+
+    def time_index(self):
+        """
+        Returns the index of 'd_time' that resolves the months, loaded from
+        the file saved by its ingestion, or else built from the staged
+        'd_time' or from the database.
+
+        Returns:
+            DTimeIndex: The index.
+        """
+        if self._time_index is None:
+            self._time_index = DTimeIndex.load()
+        if self._time_index is None:
+            if self.exists('d_time') or self.connection is None:
+                self._time_index = DTimeIndex.from_frame(self.read(
+                    'd_time', columns=['time_id', 'action_timestamp']))
+            else:
+                self._time_index = DTimeIndex.from_database(self.connection)
+        return self._time_index
+
+    def set_time_index(self, time_index: DTimeIndex):
+        """
+        Replaces the index of 'd_time', such as after 'd_time' is loaded
+        again.
+
+        Parameters:
+            time_index (DTimeIndex): The index.
+
+        Returns:
+            None
+        """
+        self._time_index = time_index
+
+    def write(self, df: DataFrame, table_name: str):
+        """
+        Appends a cleaned dataframe to the files of a table, partitioned by
+        month and with the date of the key when the table has a completion
+        time key.
+
+        Parameters:
+            df (DataFrame): The dataframe, as ingested into the database.
+            table_name (str): The name of the table.
+
+        Returns:
+            None
+        """
+        with Instrumentation.phase('parquet', rows=len(df)):
+            df = df.astype({column: object for column, dtype in
+                            df.dtypes.items() if dtype == 'category'})
+            partition_cols = None
+            column = self.PARTITION_COLUMNS.get(table_name)
+            if column is not None:
+                time_index = self.time_index()
+                months = time_index.month_keys(df[column])
+                df = df.assign(**{
+                    self.date_column(column):
+                        time_index.lookup(df[column])['date'].to_numpy(),
+                    'month': np.where(pd.isna(months), self.MISSING_MONTH,
+                                      months)})
+                partition_cols = ['month']
+
+            pyarrow_parquet.write_to_dataset(
+                pyarrow.Table.from_pandas(df, preserve_index=False),
+                self.table_path(table_name),
+                partition_cols=partition_cols,
+                basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet')
+
+    def remove(self, table_name: str, column: str, keys):
+        """
+        Removes the rows of some keys from the files of a table, such as
+        before the rows that replace them are written. Only the files with
+        any of the keys are rewritten, each one atomically.
+
+        Parameters:
+            table_name (str): The name of the table.
+            column (str): The column of the keys.
+            keys (array-like): The keys.
+
+        Returns:
+            None
+        """
+        if not self.exists(table_name) or not len(keys):
+            return
+
+        value_set = pyarrow.array(pd.unique(np.asarray(keys)))
+        with Instrumentation.phase('parquet'):
+            for directory, _, files in os.walk(self.table_path(table_name)):
+                for name in files:
+                    if not name.endswith('.parquet'):
+                        continue
+                    path = os.path.join(directory, name)
+                    table = pyarrow_parquet.ParquetFile(path).read()
+                    removed = pyarrow_compute.is_in(table[column],
+                                                    value_set=value_set)
+                    if not pyarrow_compute.any(removed).as_py():
+                        continue
+                    table = table.filter(pyarrow_compute.invert(removed))
+                    if table.num_rows == 0:
+                        os.remove(path)
+                        continue
+                    # Hidden, so a read of the table never opens it
+                    temporary_file = os.path.join(
+                        directory, f'.{name}.{os.getpid()}.tmp')
+                    pyarrow_parquet.write_table(table, temporary_file)
+                    os.replace(temporary_file, path)
+
+    @staticmethod
+    def date_column(column: str):
+        """
+        Returns the name of the column with the date of a time key, such as
+        'investment_completed_date' for 'investment_completed_at'.
+        """
+        return column.replace('_completed_at', '_completed_date')
+
+    def read(self, table_name: str, columns: list = None,
+             filters: list = None):
+        """
+        Reads a table, opening only the partitions and columns needed.
+
+        Parameters:
+            table_name (str): The name of the table.
+            columns (list): Optional columns to be read.
+            filters (list): Optional filters in the format of
+                pandas.read_parquet, such as [('month', '>=', '2022-01')],
+                applied to the partitions and to the row groups.
+
+        Returns:
+            DataFrame: The rows of the table.
+        """
+        return pd.read_parquet(self.table_path(table_name), columns=columns,
+                               filters=filters)
@@ -1,37 +1,108 @@
-import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
+import numpy as np
 import pandas as pd
 import glob
+import hashlib
+import os
+from datetime import datetime
 
 from pandas import DataFrame
+from sqlalchemy import Integer, bindparam, inspect, text
 
 from connections.connection_postgresql import ConnectionPostgres
+from process_data.investment_json import InvestmentJsonReader
+from process_data.monthly_balance import MonthlyBalance
+from process_data.parquet_staging import ParquetStaging
+from process_data.referential_integrity import ReferentialIntegrity
+from process_data.schemas import TableSchema
+from process_data.time_index import DTimeIndex
+from utils.instrumentation import Instrumentation
 from utils.utils import Utils
-import json
 
 
 class ProcessDataSetsPostgresql:
-    def __init__(self, connection: str):
+    # Tables loaded with COPY FROM STDIN by default
+    COPY_TABLES = ('pix_movements', 'transfer_ins', 'transfer_outs')
+
+    # Steps of run_all_ingestions and the steps they depend on, following the
+    # foreign keys declared in sql.sql
+    STEPS = {
+        'read_and_process_country': (),
+        'read_and_process_state': ('read_and_process_country',),
+        'read_and_process_city': ('read_and_process_state',),
+        'read_and_process_accounts': (),
+        'read_and_process_customers': ('read_and_process_city',
+                                       'read_and_process_accounts'),
+        'read_and_process_dimension_year': (),
+        'read_and_process_dimension_month': (),
+        'read_and_process_dimension_week': (),
+        'read_and_process_dimension_weekday': (),
+        'read_and_process_dimension_time': (
+            'read_and_process_dimension_year',
+            'read_and_process_dimension_month',
+            'read_and_process_dimension_week',
+            'read_and_process_dimension_weekday'),
+        'read_and_process_investiments': ('read_and_process_accounts',
+                                          'read_and_process_dimension_time'),
+        'read_and_process_pix_movements': ('read_and_process_accounts',
+                                           'read_and_process_dimension_time'),
+        'read_and_process_transfer_ins': ('read_and_process_accounts',
+                                          'read_and_process_dimension_time'),
+        'read_and_process_transfer_out': ('read_and_process_accounts',
+                                          'read_and_process_dimension_time'),
+    }
+
+    # Schema of the staging tables used by the streaming mode
+    STAGING_SCHEMA = 'staging'
+
+    # Table with the files already ingested
+    MANIFEST_TABLE = 'ingestion_manifest'
+
+    # Number of keys looked up in the destination table per query
+    KEY_BATCH = 10000
+
+    def __init__(self, connection: str, copy_tables=COPY_TABLES,
+                 chunksize: int = 100000, streaming: bool = False,
+                 excel_workers: int = 1, use_manifest: bool = True,
+                 parquet_dir: str = None, monthly_balance: bool = False,
+                 check_integrity: bool = True,
+                 quarantine_dir: str = ReferentialIntegrity.QUARANTINE_DIR):
         self.connection = ConnectionPostgres.connect(connection)
-        self.files_account = glob.glob("Tables/accounts/*.csv")
-        self.files_customers = glob.glob("Tables/customers/*.csv")
-        self.files_city = glob.glob("Tables/city/*.csv")
-        self.files_state = glob.glob("Tables/state/*.csv")
-        self.files_country = glob.glob("Tables/country/*.csv")
-        self.files_d_year = glob.glob("Tables/d_year/*.csv")
-        self.files_d_month = glob.glob("Tables/d_month/*.csv")
-        self.files_d_week = glob.glob("Tables/d_week/*.csv")
-        self.files_d_weekday = glob.glob("Tables/d_weekday/*.csv")
-        self.files_d_time = glob.glob("Tables/d_time/*.csv")
-        self.files_investiments = glob.glob("Tables/investments/*.txt")
-        self.files_pix_moviments = glob.glob("Tables/pix_movements/*")
-        self.files_transfer_ins = glob.glob("Tables/transfer_ins/*")
-        self.files_transfer_out = glob.glob("Tables/transfer_outs/*")
+        self.monthly_balance = monthly_balance
+        self.integrity = None if not check_integrity else \
+            ReferentialIntegrity(self.connection, quarantine_dir)
+        self.parquet_staging = None if parquet_dir is None else \
+            ParquetStaging(parquet_dir, connection=self.connection)
+        self.copy_tables = set(copy_tables)
+        self.chunksize = chunksize
+        self.streaming = streaming
+        self.excel_workers = excel_workers
+        self.use_manifest = use_manifest
+        self.file_hashes = {}
+        self.registered_files = {}
+        self.changed_files = {}
+        self.primary_keys = {}
+        with Instrumentation.phase('glob'):
+            self.files_account = glob.glob("Tables/accounts/*.csv")
+            self.files_customers = glob.glob("Tables/customers/*.csv")
+            self.files_city = glob.glob("Tables/city/*.csv")
+            self.files_state = glob.glob("Tables/state/*.csv")
+            self.files_country = glob.glob("Tables/country/*.csv")
+            self.files_d_year = glob.glob("Tables/d_year/*.csv")
+            self.files_d_month = glob.glob("Tables/d_month/*.csv")
+            self.files_d_week = glob.glob("Tables/d_week/*.csv")
+            self.files_d_weekday = glob.glob("Tables/d_weekday/*.csv")
+            self.files_d_time = glob.glob("Tables/d_time/*.csv")
+            self.files_investiments = glob.glob("Tables/investments/*.txt")
+            self.files_pix_moviments = glob.glob("Tables/pix_movements/*")
+            self.files_transfer_ins = glob.glob("Tables/transfer_ins/*")
+            self.files_transfer_out = glob.glob("Tables/transfer_outs/*")
 
     def read_and_process_accounts(self):
         """
         This function reads a set of account csv files and processes the data before ingestion.
-        The data is processed by converting the "account_id" and "customer_id" columns from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
+        The data is processed by converting the "account_id" and "customer_id" columns from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
         The processed data is then ingested into a table named "accounts".
 
         Parameters:
@@ -40,20 +111,21 @@ class ProcessDataSetsPostgresql:
         Returns:
         None
         """
-        for file in self.files_account:
-            df = pd.read_csv(file)
-            df["account_id"] = df["account_id"].apply(
-                Utils.convert_int_to_uuid_version_4)
-            df["customer_id"] = df["customer_id"].apply(
-                Utils.convert_int_to_uuid_version_4)
+        for file in self.pending_files(self.files_account, 'accounts'):
+            df = TableSchema.read_csv(file, 'accounts')
+            self.register_file(file, 'accounts', len(df))
+            df["account_id"] = Utils.convert_int_series_to_uuid_version_4(
+                df["account_id"])
+            df["customer_id"] = Utils.convert_int_series_to_uuid_version_4(
+                df["customer_id"])
             self.ingestion(df=df, table_name='accounts')
 
     def read_and_process_customers(self):
         """
         This function reads a set of customer csv files and processes the data before ingestion.
-        The data is processed by converting the "customer_id" column from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
-        The "customer_city" column is also converted from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
-        The "cpf" column is converted from its original format to a string.
+        The data is processed by converting the "customer_id" column from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
+        The "customer_city" column is also converted from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
+        The "cpf" column is read as a string, as declared in the TableSchema class.
         The processed data is then ingested into a table named "customers".
 
         Parameters:
@@ -62,20 +134,20 @@ class ProcessDataSetsPostgresql:
         Returns:
         None
         """
-        for file in self.files_customers:
-            df = pd.read_csv(file)
-            df["customer_id"] = df["customer_id"].apply(
-                Utils.convert_int_to_uuid_version_4)
-            df['customer_city'] = df['customer_city'].apply(
-                Utils.convert_int_to_uuid_version_4)
-            df['cpf'] = df['cpf'].apply(lambda x: str(x))
+        for file in self.pending_files(self.files_customers, 'customers'):
+            df = TableSchema.read_csv(file, 'customers')
+            self.register_file(file, 'customers', len(df))
+            df["customer_id"] = Utils.convert_int_series_to_uuid_version_4(
+                df["customer_id"])
+            df['customer_city'] = Utils.convert_int_series_to_uuid_version_4(
+                df['customer_city'])
             self.ingestion(df=df, table_name='customers')
 
     def read_and_process_city(self):
         """
         This function reads a set of city csv files and processes the data before ingestion.
-        The data is processed by converting the "city_id" column from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
-        The "state_id" column is also converted from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
+        The data is processed by converting the "city_id" column from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
+        The "state_id" column is also converted from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
         The processed data is then ingested into a table named "city".
 
         Parameters:
@@ -83,20 +155,21 @@ class ProcessDataSetsPostgresql:
 
         :return:
         """
-        for file in self.files_city:
-            df = pd.read_csv(file)
-            df["city_id"] = df["city_id"].apply(
-                Utils.convert_int_to_uuid_version_4)
-            df["state_id"] = df["state_id"].apply(
-                Utils.convert_int_to_uuid_version_4)
+        for file in self.pending_files(self.files_city, 'city'):
+            df = TableSchema.read_csv(file, 'city')
+            self.register_file(file, 'city', len(df))
+            df["city_id"] = Utils.convert_int_series_to_uuid_version_4(
+                df["city_id"])
+            df["state_id"] = Utils.convert_int_series_to_uuid_version_4(
+                df["state_id"])
             self.ingestion(df=df, table_name='city')
 
     def read_and_process_states(self):
         """
         This function reads a set of state csv files and processes the data before ingestion.
         The data is processed by concatenating all the dataframes obtained from reading each file.
-        The "state_id" column is then converted from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
-        The "country_id" column is also converted from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
+        The "state_id" column is then converted from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
+        The "country_id" column is also converted from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
         The processed data is then ingested into a table named "states".
 
         Parameters:
@@ -106,21 +179,24 @@ class ProcessDataSetsPostgresql:
         None
         """
         list_df = []
-        for file in self.files_state:
-            df = pd.read_csv(file)
+        for file in self.pending_files(self.files_state, 'states'):
+            df = TableSchema.read_csv(file, 'state')
+            self.register_file(file, 'states', len(df))
             list_df.append(df)
-
-        df = pd.concat(list_df)
-        df["state_id"] = df["state_id"].apply(
-            Utils.convert_int_to_uuid_version_4)
-        df["country_id"] = df["country_id"].apply(
-            Utils.convert_int_to_uuid_version_4)
+        if not list_df:
+            return
+
+        df = pd.concat(list_df, ignore_index=True)
+        df["state_id"] = Utils.convert_int_series_to_uuid_version_4(
+            df["state_id"])
+        df["country_id"] = Utils.convert_int_series_to_uuid_version_4(
+            df["country_id"])
         self.ingestion(df=df, table_name='states')
 
     def read_and_process_country(self):
         """
         This function reads a set of country csv files, concatenates them into a single DataFrame, and processes the data before ingestion.
-        The data is processed by converting the "country_id" column from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
+        The data is processed by converting the "country_id" column from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
         The processed data is then ingested into a table named "country".
 
         Parameters:
@@ -130,19 +206,22 @@ class ProcessDataSetsPostgresql:
         None
         """
         list_df = []
-        for file in self.files_country:
-            df = pd.read_csv(file)
+        for file in self.pending_files(self.files_country, 'country'):
+            df = TableSchema.read_csv(file, 'country')
+            self.register_file(file, 'country', len(df))
             list_df.append(df)
+        if not list_df:
+            return
 
-        df = pd.concat(list_df)
-        df["country_id"] = df["country_id"].apply(
-            Utils.convert_int_to_uuid_version_4)
+        df = pd.concat(list_df, ignore_index=True)
+        df["country_id"] = Utils.convert_int_series_to_uuid_version_4(
+            df["country_id"])
         self.ingestion(df=df, table_name='country')
 
     def read_and_process_state(self):
         """
         This function reads a set of state csv files, concatenates them into a single DataFrame, and processes the data before ingestion.
-        The data is processed by converting the "state_id" and "country_id" columns from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
+        The data is processed by converting the "state_id" and "country_id" columns from integers to UUID version 4 using the Utils.convert_int_series_to_uuid_version_4 function.
         The processed data is then ingested into a table named "state".
 
         Parameters:
@@ -152,15 +231,18 @@ class ProcessDataSetsPostgresql:
         None
         """
         list_df = []
-        for file in self.files_state:
-            df = pd.read_csv(file)
+        for file in self.pending_files(self.files_state, 'state'):
+            df = TableSchema.read_csv(file, 'state')
+            self.register_file(file, 'state', len(df))
             list_df.append(df)
-
-        df = pd.concat(list_df)
-        df["state_id"] = df["state_id"].apply(
-            Utils.convert_int_to_uuid_version_4)
-        df["country_id"] = df["country_id"].apply(
-            Utils.convert_int_to_uuid_version_4)
+        if not list_df:
+            return
+
+        df = pd.concat(list_df, ignore_index=True)
+        df["state_id"] = Utils.convert_int_series_to_uuid_version_4(
+            df["state_id"])
+        df["country_id"] = Utils.convert_int_series_to_uuid_version_4(
+            df["country_id"])
         self.ingestion(df=df, table_name='state')
 
     def read_and_process_dimension_year(self):
@@ -176,11 +258,14 @@ class ProcessDataSetsPostgresql:
         None
         """
         list_df = []
-        for file in self.files_d_year:
-            df = pd.read_csv(file)
+        for file in self.pending_files(self.files_d_year, 'd_year'):
+            df = TableSchema.read_csv(file, 'd_year')
+            self.register_file(file, 'd_year', len(df))
             list_df.append(df)
+        if not list_df:
+            return
 
-        df = pd.concat(list_df)
+        df = pd.concat(list_df, ignore_index=True)
         self.ingestion(df=df, table_name='d_year')
 
     def read_and_process_dimension_month(self):
@@ -196,11 +281,14 @@ class ProcessDataSetsPostgresql:
         None
         """
         list_df = []
-        for file in self.files_d_month:
-            df = pd.read_csv(file)
+        for file in self.pending_files(self.files_d_month, 'd_month'):
+            df = TableSchema.read_csv(file, 'd_month')
+            self.register_file(file, 'd_month', len(df))
             list_df.append(df)
+        if not list_df:
+            return
 
-        df = pd.concat(list_df)
+        df = pd.concat(list_df, ignore_index=True)
         self.ingestion(df=df, table_name='d_month')
 
     def read_and_process_dimension_week(self):
@@ -216,11 +304,14 @@ class ProcessDataSetsPostgresql:
         None
         """
         list_df = []
-        for file in self.files_d_week:
-            df = pd.read_csv(file)
+        for file in self.pending_files(self.files_d_week, 'd_week'):
+            df = TableSchema.read_csv(file, 'd_week')
+            self.register_file(file, 'd_week', len(df))
             list_df.append(df)
+        if not list_df:
+            return
 
-        df = pd.concat(list_df)
+        df = pd.concat(list_df, ignore_index=True)
         self.ingestion(df=df, table_name='d_week')
 
     def read_and_process_dimension_weekday(self):
@@ -236,11 +327,14 @@ class ProcessDataSetsPostgresql:
         None
         """
         list_df = []
-        for file in self.files_d_weekday:
-            df = pd.read_csv(file)
+        for file in self.pending_files(self.files_d_weekday, 'd_weekday'):
+            df = TableSchema.read_csv(file, 'd_weekday')
+            self.register_file(file, 'd_weekday', len(df))
             list_df.append(df)
+        if not list_df:
+            return
 
-        df = pd.concat(list_df)
+        df = pd.concat(list_df, ignore_index=True)
         self.ingestion(df=df, table_name='d_weekday')
 
     def read_and_process_dimension_time(self):
@@ -248,6 +342,8 @@ class ProcessDataSetsPostgresql:
         This function reads a set of dimension time csv files and processes the data before ingestion.
         The data is processed by concatenating all the dataframes obtained from reading each file.
         The processed data is then ingested into a table named "d_time".
+        The index of the whole "d_time" table is then saved with the DTimeIndex class, so the other steps and the
+        balance calculation resolve the time keys without joining the dimension.
 
         Parameters:
         None
@@ -256,22 +352,34 @@ class ProcessDataSetsPostgresql:
         None
         """
         list_df = []
-        for file in self.files_d_time:
-            df = pd.read_csv(file)
+        for file in self.pending_files(self.files_d_time, 'd_time'):
+            df = TableSchema.read_csv(file, 'd_time')
+            self.register_file(file, 'd_time', len(df))
             list_df.append(df)
+        if not list_df:
+            return
 
-        df = pd.concat(list_df)
+        df = pd.concat(list_df, ignore_index=True)
         self.ingestion(df=df, table_name='d_time')
+        with Instrumentation.phase('time_index'):
+            time_index = DTimeIndex.from_database(self.connection)
+            time_index.save()
+        if self.parquet_staging is not None:
+            self.parquet_staging.set_time_index(time_index)
 
     def read_and_process_investiments(self):
         """
-        This function reads a set of investment json files and processes the data before ingestion.
-        The data is processed by concatenating all the dataframes obtained from reading and normalizing each file.
-        The 'None' values are then converted using the Utils.convert_none_values function.
-        The "transaction_id" column is then converted from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
-        The "account_id" column is also converted from integers to UUID version 4 using the Utils.convert_int_to_uuid_version_4 function.
-        The "investment_completed_at_timestamp" column is then dropped.
-        The processed data is then ingested into a table named "investments".
+        This function reads a set of investment json files and ingests them into a table named "investments".
+        The files are parsed incrementally with the InvestmentJsonReader class, which walks the accounts and their
+        transactions and emits typed batches of `self.chunksize` transactions, with the 'None' values read as missing
+        values, the "transaction_id" and "account_id" columns already converted from integers to UUID version 4 and
+        the "investment_completed_at_timestamp" column skipped, so the memory used does not depend on the size of
+        the files.
+        The batches are loaded as they are parsed, all of them in a single transaction together with the record of
+        the files in the manifest table. With `self.integrity` the orphan transactions of each batch are quarantined
+        before it is loaded. With a Parquet staging layer the rows appended or replaced by each batch are kept in memory
+        and written to it only once the transaction is committed, so the staging layer never gets the rows of a
+        failed load, nor the rows skipped as already loaded.
 
         Parameters:
         None
@@ -279,32 +387,40 @@ class ProcessDataSetsPostgresql:
         Returns:
         None
         """
-        list_df = []
-        for file in self.files_investiments:
-            with open(file) as file_read:
-                data = json.load(file_read)
-
-            df = pd.json_normalize(data, 'transactions', ['account_id'])
-            list_df.append(df)
-        df = pd.concat(list_df)
-
-        df = Utils.convert_none_values(df)
-        df["transaction_id"] = df["transaction_id"].apply(
-            lambda x: Utils.convert_int_to_uuid_version_4(int(x)))
-        df["account_id"] = df["account_id"].apply(
-            lambda x: Utils.convert_int_to_uuid_version_4(int(x)))
-        df.drop(columns=['investment_completed_at_timestamp'],
-                inplace=True)
-
-        self.ingestion(df=df, table_name='investments')
+        files = self.pending_files(self.files_investiments, 'investments')
+        if not files:
+            return
+
+        loaded = []
+        with self.connection.engine.begin() as connection:
+            for file in files:
+                rows = 0
+                for df in InvestmentJsonReader.iter_batches(
+                        file, batch_size=self.chunksize):
+                    rows += len(df)
+                    if self.integrity is not None:
+                        df = self.integrity.validate(df, 'investments')
+                    df_loaded = self.load(
+                        df=df, table_name='investments',
+                        connection=connection,
+                        changed=file in self.changed_files.get(
+                            'investments', ()))
+                    if self.parquet_staging is not None:
+                        loaded.append(df_loaded)
+                self.register_file(file, 'investments', rows)
+            self.record_files(connection, 'investments')
+
+        for df_appended, df_replaced in loaded:
+            self.stage_rows('investments', df_appended, df_replaced)
 
     def read_and_process_pix_movements(self):
         """
         Reads and processes data from files in `self.files_pix_moviments` into a single Pandas dataframe and ingests the data into the 'pix_movements' table.
-        The function first reads data from each file in `self.files_pix_moviments` and appends the data to a list of Pandas dataframes `list_df`. The data is either read as an Excel (.xlsx) or a CSV file.
-        The data from each file is then concatenated into a single Pandas dataframe `df`. The data is processed to convert `None` values to a suitable data type.
-        The data in the columns 'id' and 'account_id' are converted from integers to UUID version 4 using the `Utils.convert_int_to_uuid_version_4` function. The columns 'pix_amount', 'pix_requested_at', and 'pix_completed_at' are converted from their current data type to `float`, `int`, and `int` or `None`, respectively. The columns 'status' and 'in_or_out' are converted to the `str` data type.
-        The data is then sorted by all columns and duplicates are dropped, keeping the last record. The processed data is then ingested into the 'pix_movements' table using the `self.ingestion` method.
+        The function first reads data from each file in `self.files_pix_moviments` into a dictionary of Pandas dataframes `frames` with the TableSchema.read_files function. The data is either read as an Excel (.xlsx) or a CSV file, with the Excel files parsed in parallel and cached.
+        The 'None' values are recognized as missing values while parsing. The data from each file is then concatenated into a single Pandas dataframe `df`.
+        The data in the columns 'id' and 'account_id' are converted from integers to UUID version 4 using the `Utils.convert_int_series_to_uuid_version_4` function. The other columns are read with the dtypes declared in the TableSchema class: 'pix_amount' as `float`, 'pix_requested_at' and 'pix_completed_at' as nullable `Int64` and 'status' and 'in_or_out' as categoricals.
+        The duplicated rows are then dropped, keeping the last record, using the `self.transform_data_transfer` function. The processed data is then ingested into the 'pix_movements' table using the `self.ingestion` method.
+        In streaming mode the files are processed in chunks through the `self.streaming_ingestion` method instead.
 
         Parameters:
         None
@@ -312,40 +428,29 @@ class ProcessDataSetsPostgresql:
         Returns:
         None
          """
-        list_df = []
-        for file in self.files_pix_moviments:
-
-            name, ext = os.path.splitext(file)
-            if ext == '.xlsx':
-                df = pd.read_excel(file)
-                list_df.append(df)
-            if ext == '.csv':
-                df = pd.read_csv(file)
-                list_df.append(df)
-
-        df = pd.concat(list_df)
-        df = Utils.convert_none_values(df)
-
-        df["id"] = df["id"].apply(
-            lambda x: Utils.convert_int_to_uuid_version_4(int(x)))
-        df["account_id"] = df["account_id"].apply(
-            lambda x: Utils.convert_int_to_uuid_version_4(int(x)))
-        df['pix_amount'] = df['pix_amount'].apply(lambda x: float(x))
-        df['pix_requested_at'] = df['pix_requested_at'].apply(lambda x: int(x))
-        df['pix_completed_at'] = df['pix_completed_at'].apply(
-            lambda x: int(x) if x is not None else None)
-        df['status'] = df['status'].apply(lambda x: str(x))
-        df['in_or_out'] = df['in_or_out'].apply(lambda x: str(x))
-        df.sort_values(by=list(df.columns), inplace=True)
-        df.drop_duplicates(subset=list(df.columns), keep='last', inplace=True)
+        files = self.pending_files(self.files_pix_moviments, 'pix_movements')
+        if self.streaming:
+            self.streaming_ingestion(files=files, table_name='pix_movements')
+            return
+
+        frames = TableSchema.read_files(files, 'pix_movements',
+                                        workers=self.excel_workers)
+        for file, df in frames.items():
+            self.register_file(file, 'pix_movements', len(df))
+        if not frames:
+            return
+
+        df = pd.concat(frames.values(), ignore_index=True)
+        self.transform_data_transfer(df=df, table_name='pix_movements')
         self.ingestion(df=df, table_name='pix_movements')
 
     def read_and_process_transfer_ins(self):
         """
         This function reads and processes the data from the files stored in the `self.files_transfer_ins` list.
-        The files are either in .xlsx or .csv format, and the function concatenates all the data frames into one data frame.
-        The data is then cleaned using the `Utils.convert_none_values` function, and then transformed using the `self.transform_data_transfer` function.
+        The files are either in .xlsx or .csv format, read with the TableSchema.read_files function, which parses the Excel files in parallel and caches them, with the 'None' values recognized as missing values while parsing, and the function concatenates all the data frames into one data frame.
+        The data is then transformed using the `self.transform_data_transfer` function.
         Finally, the processed data is ingested into the 'transfer_ins' table using the `self.ingestion` function.
+        In streaming mode the files are processed in chunks through the `self.streaming_ingestion` method instead.
 
         Parameters:
         None
@@ -353,26 +458,30 @@ class ProcessDataSetsPostgresql:
         Returns:
         None
         """
-        list_df = []
-        for file in self.files_transfer_ins:
-            name, ext = os.path.splitext(file)
-            if ext == '.xlsx':
-                df = pd.read_excel(file)
-                list_df.append(df)
-            if ext == '.csv':
-                df = pd.read_csv(file)
-                list_df.append(df)
-        df = pd.concat(list_df)
-        df = Utils.convert_none_values(df)
-        self.transform_data_transfer(df=df)
+        files = self.pending_files(self.files_transfer_ins, 'transfer_ins')
+        if self.streaming:
+            self.streaming_ingestion(files=files, table_name='transfer_ins')
+            return
+
+        frames = TableSchema.read_files(files, 'transfer_ins',
+                                        workers=self.excel_workers)
+        for file, df in frames.items():
+            self.register_file(file, 'transfer_ins', len(df))
+        if not frames:
+            return
+
+        df = pd.concat(frames.values(), ignore_index=True)
+        self.transform_data_transfer(df=df, table_name='transfer_ins')
         self.ingestion(df=df, table_name='transfer_ins')
 
     def read_and_process_transfer_out(self):
         """
         Reads and processes all the transfer out files stored in the `files_transfer_out` attribute of the class.
-        The function first concatenates all the dataframes into a single one, then processes them using the
-        `convert_none_values` method of the Utils class, then passes the resulting dataframe to the `transform_data_transfer`
+        The function first reads the files with the TableSchema.read_files function, which parses the Excel files
+        in parallel and caches them, and concatenates all the dataframes into a single one, with the 'None' values recognized as missing
+        values while parsing, then passes the resulting dataframe to the `transform_data_transfer`
         method. Finally, the resulting dataframe is ingested into the 'transfer_outs' table.
+        In streaming mode the files are processed in chunks through the `self.streaming_ingestion` method instead.
 
         Parameters:
         None
@@ -380,81 +489,783 @@ class ProcessDataSetsPostgresql:
         Returns:
         None
         """
-        list_df = []
-        for file in self.files_transfer_out:
-            name, ext = os.path.splitext(file)
-            if ext == '.xlsx':
-                df = pd.read_excel(file)
-                list_df.append(df)
-            if ext == '.csv':
-                df = pd.read_csv(file)
-                list_df.append(df)
-        df = pd.concat(list_df)
-        df = Utils.convert_none_values(df)
-        self.transform_data_transfer(df=df)
+        files = self.pending_files(self.files_transfer_out, 'transfer_outs')
+        if self.streaming:
+            self.streaming_ingestion(files=files, table_name='transfer_outs')
+            return
+
+        frames = TableSchema.read_files(files, 'transfer_outs',
+                                        workers=self.excel_workers)
+        for file, df in frames.items():
+            self.register_file(file, 'transfer_outs', len(df))
+        if not frames:
+            return
+
+        df = pd.concat(frames.values(), ignore_index=True)
+        self.transform_data_transfer(df=df, table_name='transfer_outs')
         self.ingestion(df=df, table_name='transfer_outs')
 
     @staticmethod
-    def transform_data_transfer(df):
+    def transform_data_transfer(df, table_name: str = None):
         """
         Transform data of a given dataframe (df) into a specific format.
 
         This method receives a dataframe (df), and it applies some transformations on it.
-        The transformations include converting "id" and "account_id" columns into UUID v4, converting
-        "amount" column into float, converting "transaction_requested_at" and "transaction_completed_at" columns
-        into float and int respectively. Finally, the method sorts the dataframe by its columns and drops duplicates.
+        The transformations include converting "id" and "account_id" columns into UUID v4. The other columns
+        are expected to be read with the dtypes declared in the TableSchema class. Finally, the method drops the
+        duplicated rows, keeping the last one, with the hash-based Utils.drop_duplicate_rows function, and
+        reports how many rows were dropped.
 
         Args:
         df: pandas.DataFrame
             The dataframe to be transformed.
+        table_name: str
+            The name of the table, used in the report. Without it nothing is reported.
 
         Returns:
         pandas.DataFrame
             The transformed dataframe.
         """
-        df["id"] = df["id"].apply(
-            lambda x: Utils.convert_int_to_uuid_version_4(int(x)))
-        df["account_id"] = df["account_id"].apply(
-            lambda x: Utils.convert_int_to_uuid_version_4(int(x)))
-        df['amount'] = df['amount'].apply(lambda x: float(x))
-        df['transaction_requested_at'] = df['transaction_requested_at'].apply(
-            lambda x: float(x))
-        df['transaction_completed_at'] = df['transaction_completed_at'].apply(
-            lambda x: int(x) if x is not None else None)
-        df.sort_values(by=list(df.columns), inplace=True)
-        df.drop_duplicates(subset=list(df.columns), keep='last', inplace=True)
+        df["id"] = Utils.convert_int_series_to_uuid_version_4(
+            df["id"])
+        df["account_id"] = Utils.convert_int_series_to_uuid_version_4(
+            df["account_id"])
+        dropped = Utils.drop_duplicate_rows(df)
+        if table_name is not None:
+            print(f'{table_name}: {dropped} duplicated rows dropped')
         return df
 
-    def ingestion(self, df: DataFrame, table_name: str):
+    @classmethod
+    def create_manifest(cls, connection: str):
+        """
+        Creates the manifest table, which records each ingested file with its
+        path, content hash, row count, destination table and load time, if it
+        does not exist yet.
+
+        Parameters:
+            connection (str): The URI to the database.
+
+        Returns:
+            None
+        """
+        with ConnectionPostgres.connect(connection).engine.begin() as conn:
+            conn.execute(text(
+                f'CREATE TABLE IF NOT EXISTS "{cls.MANIFEST_TABLE}" ('
+                f'file_path varchar(1024), '
+                f'content_hash char(64), '
+                f'row_count bigint, '
+                f'table_name varchar(128), '
+                f'loaded_at timestamp)'))
+
+    @staticmethod
+    def hash_file(file: str):
+        """
+        Calculates the SHA-256 hash of the content of a file.
+
+        Parameters:
+            file (str): The path of the file.
+
+        Returns:
+            str: The hexadecimal digest.
+        """
+        digest = hashlib.sha256()
+        with open(file, 'rb') as file_read:
+            for block in iter(lambda: file_read.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def pending_files(self, files: list, table_name: str):
+        """
+        Filters out the files whose current content was already ingested into
+        a table, according to the manifest table.
+
+        The files ingested before with a different content are kept in
+        `self.changed_files`, so their rows replace the rows loaded from
+        their previous version.
+
+        Parameters:
+            files (list): The files of the table.
+            table_name (str): The name of the table.
+
+        Returns:
+            list: The new or changed files, or all the files when the manifest
+                is not used.
+        """
+        if not self.use_manifest:
+            return files
+
+        with self.connection.engine.connect() as connection:
+            loaded = set(connection.execute(text(
+                f'SELECT file_path, content_hash FROM "{self.MANIFEST_TABLE}" '
+                f'WHERE table_name = :table_name'),
+                {'table_name': table_name}).fetchall())
+
+        with Instrumentation.phase('hash', bytes_read=sum(
+                os.path.getsize(file) for file in files)):
+            for file in files:
+                self.file_hashes[file] = self.hash_file(file)
+
+        ingested = {file for file, _ in loaded}
+        pending = []
+        for file in files:
+            if (file, self.file_hashes[file]) in loaded:
+                print(f'{table_name}: {file} already ingested, skipping')
+                continue
+            if file in ingested:
+                print(f'{table_name}: {file} changed since it was ingested, '
+                      f'replacing its rows')
+                self.changed_files.setdefault(table_name, set()).add(file)
+            pending.append(file)
+        return pending
+
+    def register_file(self, file: str, table_name: str, row_count: int):
+        """
+        Registers a file read for a table, to be recorded in the manifest
+        table in the same transaction as the next load of the table.
+
+        Parameters:
+            file (str): The path of the file.
+            table_name (str): The name of the table.
+            row_count (int): The number of rows read from the file.
+
+        Returns:
+            None
+        """
+        if self.use_manifest:
+            self.registered_files.setdefault(table_name, []).append(
+                (file, row_count))
+
+    def record_files(self, connection, table_name: str):
+        """
+        Records the files registered for a table in the manifest table.
+
+        Parameters:
+            connection (Connection): The SQLAlchemy connection of the load
+                transaction.
+            table_name (str): The name of the table.
+
+        Returns:
+            None
+        """
+        files = self.registered_files.pop(table_name, [])
+        self.changed_files.pop(table_name, None)
+        if not files:
+            return
+
+        loaded_at = datetime.now()
+        connection.execute(text(
+            f'INSERT INTO "{self.MANIFEST_TABLE}" (file_path, content_hash, '
+            f'row_count, table_name, loaded_at) VALUES (:file_path, '
+            f':content_hash, :row_count, :table_name, :loaded_at)'), [
+            {'file_path': file, 'content_hash': self.file_hashes[file],
+             'row_count': int(row_count), 'table_name': table_name,
+             'loaded_at': loaded_at} for file, row_count in files])
+
+    def streaming_ingestion(self, files: list, table_name: str):
+        """
+        Ingests a set of transfer or pix files in chunks of `self.chunksize`
+        rows, keeping the memory bounded regardless of the size of the files.
+
+        Each chunk is transformed with the `self.transform_data_transfer`
+        function and loaded into a staging table with the same columns as the
+        destination table, plus the 'changed_file' flag of the rows of files
+        changed since they were ingested. Duplicates across chunks and files
+        are then removed by the database when the staging table is moved into
+        the destination table. The rows whose keys are already loaded are
+        skipped with ON CONFLICT DO NOTHING, unless they come from changed
+        files, which replace them with ON CONFLICT DO UPDATE. This mode
+        requires PostgreSQL.
+
+        With a Parquet staging layer the rows moved into the destination
+        table are also kept in a second staging table, read back in chunks
+        once the move is committed and written to it, so it gets the same
+        rows as the database. With `self.integrity` the orphan rows of each
+        chunk are quarantined before it is loaded.
+
+        :param files: The files to be ingested.
+        :param table_name: The name of the destination table.
+
+        Returns
+        None
+        """
+        staging_table = f'"{self.STAGING_SCHEMA}"."{table_name}"'
+        moved_table = None if self.parquet_staging is None else \
+            f'"{self.STAGING_SCHEMA}"."{table_name}_moved"'
+        with self.connection.engine.begin() as connection:
+            connection.execute(text(
+                f'CREATE SCHEMA IF NOT EXISTS "{self.STAGING_SCHEMA}"'))
+            connection.execute(text(f'DROP TABLE IF EXISTS {staging_table}'))
+            connection.execute(text(
+                f'CREATE UNLOGGED TABLE {staging_table} '
+                f'(LIKE "{table_name}" INCLUDING DEFAULTS)'))
+            connection.execute(text(
+                f'ALTER TABLE {staging_table} ADD COLUMN changed_file boolean'))
+            if moved_table is not None:
+                connection.execute(text(
+                    f'DROP TABLE IF EXISTS {moved_table}'))
+                connection.execute(text(
+                    f'CREATE UNLOGGED TABLE {moved_table} '
+                    f'(LIKE {staging_table})'))
+
+        dropped = 0
+        changed_files = self.changed_files.get(table_name, set())
+        for file in files:
+            file_rows = 0
+            for df in TableSchema.read_file_chunks(file, table_name,
+                                                   chunksize=self.chunksize):
+                file_rows += len(df)
+                dropped += len(df)
+                df = self.transform_data_transfer(df=df.copy())
+                dropped -= len(df)
+                if self.integrity is not None:
+                    df = self.integrity.validate(df, table_name)
+                df = df.assign(changed_file=file in changed_files)
+                self.ingestion(df=df, table_name=table_name,
+                               schema=self.STAGING_SCHEMA)
+            self.register_file(file, table_name, file_rows)
+
+        with self.connection.engine.begin() as connection:
+            self.move_staging_table(connection, staging_table, table_name,
+                                    moved_table, dropped)
+            if self.monthly_balance:
+                MonthlyBalance.record_table(connection, staging_table,
+                                            table_name)
+            self.record_files(connection, table_name)
+
+        if moved_table is not None:
+            self.stage_moved_rows(moved_table, table_name)
+        with self.connection.engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE {staging_table}'))
+            if moved_table is not None:
+                connection.execute(text(f'DROP TABLE {moved_table}'))
+
+    def move_staging_table(self, connection, staging_table: str,
+                           table_name: str, moved_table: str = None,
+                           dropped: int = 0):
+        """
+        Moves the distinct rows of a staging table of the streaming mode into
+        the destination table. The rows of changed files are moved first,
+        replacing the rows with their keys, and then the other rows, skipping
+        the keys already loaded. With `moved_table` the rows actually
+        inserted or replaced are also copied into it, through RETURNING.
+
+        As in the batch mode, the duplicated rows, the rows with repeated
+        keys, the rows skipped because their keys are already loaded and the
+        replaced rows are reported separately. The orphan rows were already
+        quarantined, and reported, before the chunks were staged.
+
+        :param connection: The SQLAlchemy connection of the transaction.
+        :param staging_table: The qualified name of the staging table.
+        :param table_name: The name of the destination table.
+        :param moved_table: The qualified name of the table of the moved
+            rows, if any.
+        :param dropped: The number of duplicated rows already dropped from
+            the chunks before they were staged.
+
+        Returns
+        int: The number of inserted or replaced rows.
+        """
+        columns = [column['name'] for column in
+                   inspect(connection).get_columns(table_name)]
+        names = ', '.join(f'"{column}"' for column in columns)
+
+        def move(select: str, conflict: str = '', changed: str = 'false'):
+            statement = f'INSERT INTO "{table_name}" ({names}) {select}' \
+                        f'{conflict}'
+            if moved_table is not None:
+                statement = f'WITH moved AS ({statement} RETURNING ' \
+                            f'{names}) INSERT INTO {moved_table} ' \
+                            f'({names}, changed_file) SELECT {names}, ' \
+                            f'{changed} FROM moved'
+            return connection.execute(text(statement)).rowcount
+
+        key = self.primary_key(connection, table_name)
+        if key is None:
+            staged = connection.execute(text(
+                f'SELECT count(*) FROM {staging_table}')).scalar()
+            inserted = move(f'SELECT DISTINCT {names} FROM {staging_table}')
+            print(f'{table_name}: {dropped + staged - inserted} duplicated '
+                  f'rows dropped')
+            return inserted
+
+        # Counted before the move, as the replaced keys are then loaded
+        staged, distinct, changed_keys, other_keys, loaded_keys = \
+            connection.execute(text(
+                f'SELECT (SELECT count(*) FROM {staging_table}), count(*), '
+                f'count(DISTINCT "{key}") FILTER (WHERE changed_file), '
+                f'count(DISTINCT "{key}") FILTER (WHERE NOT changed_file), '
+                f'count(DISTINCT "{key}") FILTER (WHERE changed_file AND '
+                f'EXISTS (SELECT 1 FROM "{table_name}" loaded '
+                f'WHERE loaded."{key}" = distinct_rows."{key}")) '
+                f'FROM (SELECT DISTINCT {names}, changed_file '
+                f'FROM {staging_table}) distinct_rows')).one()
+
+        updates = ', '.join(f'"{column}" = EXCLUDED."{column}"'
+                            for column in columns if column != key)
+        replaced = move(
+            f'SELECT DISTINCT ON ("{key}") {names} FROM {staging_table} '
+            f'WHERE changed_file ORDER BY "{key}"',
+            f' ON CONFLICT ("{key}") DO UPDATE SET {updates}', 'true')
+        inserted = move(
+            f'SELECT DISTINCT {names} FROM {staging_table} '
+            f'WHERE NOT changed_file', ' ON CONFLICT DO NOTHING')
+
+        print(f'{table_name}: {dropped + staged - distinct} duplicated rows '
+              f'dropped')
+        repeated = distinct - changed_keys - other_keys
+        if repeated:
+            print(f'{table_name}: {repeated} rows with repeated keys dropped')
+        skipped = other_keys - inserted
+        if skipped:
+            print(f'{table_name}: {skipped} rows already loaded skipped')
+        if loaded_keys:
+            print(f'{table_name}: {loaded_keys} rows of changed files '
+                  f'replaced')
+        return replaced + inserted
+
+    def stage_moved_rows(self, moved_table: str, table_name: str):
+        """
+        Writes the rows moved into a table by the streaming mode to the
+        Parquet staging layer, streamed in chunks of `self.chunksize` rows
+        with the dtypes of the other loads of the table. The staged rows
+        with the keys of the rows of changed files are removed first.
+
+        :param moved_table: The qualified name of the table of the moved
+            rows.
+        :param table_name: The name of the destination table.
+
+        Returns
+        None
+        """
+        # The int64 columns of the schema are the keys converted to UUIDs
+        dtypes = {column: dtype for column, dtype in
+                  TableSchema.SCHEMAS[table_name].items() if dtype != 'int64'}
+        key = self.primary_keys.get((None, table_name))
+        with self.connection.engine.connect() as connection:
+            if key is not None:
+                self.parquet_staging.remove(
+                    table_name, key, connection.execute(text(
+                        f'SELECT "{key}"::text FROM {moved_table} '
+                        f'WHERE changed_file')).scalars().all())
+            for df in pd.read_sql(
+                    text(f'SELECT * FROM {moved_table}'),
+                    con=connection.execution_options(stream_results=True),
+                    chunksize=self.chunksize):
+                self.parquet_staging.write(
+                    df.drop(columns='changed_file').astype(dtypes),
+                    table_name)
+
+    def ingestion(self, df: DataFrame, table_name: str, schema: str = None):
 
         """
         Ingests data from a pandas DataFrame into a SQL database table.
 
+        With `self.integrity` the rows whose foreign keys are not in their
+        parent tables are first quarantined by the ReferentialIntegrity class,
+        and the keys of the loaded rows are then added to its indexes.
+        The rows are loaded with the `self.load` method, which skips the keys already loaded, unless the rows come
+        from files changed since they were ingested, which replace them. The load runs in a single transaction, together with the record of
+        the files registered for the table in the manifest table, so a failed
+        load leaves no rows behind and its files are retried in the next run.
+        With `self.monthly_balance` the accounts and months of the loaded
+        movements are marked for the refresh of the monthly balance in the
+        same transaction. Once committed, the appended and replaced rows are also written to the Parquet staging
+        layer when there is one, with the `self.stage_rows` method.
+
         :param df: The pandas DataFrame to be ingested.
         :param table_name: The name of the SQL database table to be ingested into.
+        :param schema: The schema of the table, if not the default one.
+
+        Returns
+        None
+        """
+
+        if schema is None and self.integrity is not None:
+            df = self.integrity.validate(df, table_name)
+
+        with self.connection.engine.begin() as connection:
+            df_appended, df_replaced = self.load(
+                df=df, table_name=table_name, connection=connection,
+                schema=schema, changed=self.changed_rows(df, table_name))
+
+            if schema is None:
+                self.record_files(connection, table_name)
+                if self.monthly_balance:
+                    MonthlyBalance.record(
+                        connection, pd.concat([df_appended, df_replaced]),
+                        table_name)
+
+        if schema is None and self.integrity is not None:
+            self.integrity.add(df, table_name)
+        if schema is None and self.parquet_staging is not None:
+            self.stage_rows(table_name, df_appended, df_replaced)
+
+    def stage_rows(self, table_name: str, df_appended: DataFrame,
+                   df_replaced: DataFrame):
+        """
+        Writes the rows loaded into a table to the Parquet staging layer,
+        removing first the staged rows with the keys of the replaced rows.
+
+        :param table_name: The name of the table.
+        :param df_appended: The rows appended to the table.
+        :param df_replaced: The rows that replaced rows of the table.
 
         Returns
         None
         """
+        key = self.primary_keys.get((None, table_name))
+        if key is not None and len(df_replaced):
+            self.parquet_staging.remove(table_name, key, df_replaced[key])
+        df = pd.concat([df_appended, df_replaced]) if len(df_replaced) else \
+            df_appended
+        if len(df):
+            self.parquet_staging.write(df, table_name)
+
+    def load(self, df: DataFrame, table_name: str, connection,
+             schema: str = None, changed=False):
+        """
+        Appends a dataframe to a table inside an open transaction.
+
+        When the table has a primary key, the rows repeating a key of the
+        dataframe are dropped, keeping the last one, and the keys are looked
+        up in the table first. The rows whose keys are not there yet are
+        appended. The other ones are skipped, unless they come from files
+        changed since they were ingested, in which case they replace the rows
+        with their keys through INSERT ... ON CONFLICT DO UPDATE.
+
+        Tables in `self.copy_tables` are appended with COPY FROM STDIN in
+        chunks of `self.chunksize` rows when the database is PostgreSQL
+        through psycopg2. The other tables fall back to the default inserts
+        of DataFrame.to_sql.
+
+        Parameters:
+            df (DataFrame): The dataframe to be loaded.
+            table_name (str): The name of the table.
+            connection (Connection): The SQLAlchemy connection of the
+                transaction.
+            schema (str): The schema of the table, if not the default one.
+            changed (bool or ndarray): Whether the rows come from changed
+                files, for all the rows or as a mask of the rows.
+
+        Returns:
+            tuple: The appended rows and the rows that replaced loaded rows.
+        """
+        with Instrumentation.phase('load', rows=len(df)):
+            key = self.primary_key(connection, table_name, schema)
+            df_update = df.iloc[:0]
+            if key is not None:
+                df, df_update = self.split_loaded_keys(
+                    df, table_name, key, connection, schema, changed)
+
+            if table_name in self.copy_tables and \
+                    self.connection.engine.dialect.driver == 'psycopg2':
+                df = self.integer_columns(df, table_name, connection, schema)
+                df.to_sql(table_name, con=connection,
+                          schema=schema,
+                          if_exists="append",
+                          index=False,
+                          chunksize=self.chunksize,
+                          method=ConnectionPostgres.copy_insert)
+            else:
+                df.to_sql(table_name, con=connection,
+                          schema=schema,
+                          if_exists="append",
+                          index=False)
+
+            if len(df_update):
+                df_update.to_sql(table_name, con=connection,
+                                 schema=schema,
+                                 if_exists="append",
+                                 index=False,
+                                 chunksize=self.chunksize,
+                                 method=ConnectionPostgres.upsert)
+        return df, df_update
+
+    def primary_key(self, connection, table_name: str, schema: str = None):
+        """
+        Returns the column of the primary key of a table, read once per
+        table.
+
+        Parameters:
+            connection (Connection): The SQLAlchemy connection.
+            table_name (str): The name of the table.
+            schema (str): The schema of the table, if not the default one.
+
+        Returns:
+            str: The column, or None when the table has no primary key or it
+                has more than one column.
+        """
+        if (schema, table_name) not in self.primary_keys:
+            columns = inspect(connection).get_pk_constraint(
+                table_name, schema=schema)['constrained_columns']
+            self.primary_keys[(schema, table_name)] = \
+                columns[0] if len(columns) == 1 else None
+        return self.primary_keys[(schema, table_name)]
+
+    def loaded_keys(self, connection, table_name: str, key: str, values,
+                    schema: str = None):
+        """
+        Looks up which keys are already in a table, in batches of
+        `self.KEY_BATCH` keys.
+
+        Parameters:
+            connection (Connection): The SQLAlchemy connection.
+            table_name (str): The name of the table.
+            key (str): The column of the primary key.
+            values (Series): The keys.
+            schema (str): The schema of the table, if not the default one.
+
+        Returns:
+            ndarray: The mask of the keys already in the table.
+        """
+        table = f'"{table_name}"' if not schema else \
+            f'"{schema}"."{table_name}"'
+        if connection.execute(text(
+                f'SELECT 1 FROM {table} LIMIT 1')).first() is None:
+            return np.zeros(len(values), dtype=bool)
+
+        # UUIDs are compared as text, as they are in the dataframes
+        as_text = values.dtype == object
+        unique = pd.unique(values.dropna().astype(str) if as_text else
+                           values.dropna()).tolist()
+        statement = text(
+            f'SELECT "{key}" FROM {table} WHERE "{key}" IN :keys').bindparams(
+            bindparam('keys', expanding=True))
+        found = []
+        for start in range(0, len(unique), self.KEY_BATCH):
+            found.extend(connection.execute(statement, {
+                'keys': unique[start:start + self.KEY_BATCH]}).scalars())
+        if as_text:
+            return values.astype(str).isin(
+                [str(value) for value in found]).to_numpy()
+        return values.isin(found).to_numpy()
+
+    def split_loaded_keys(self, df: DataFrame, table_name: str, key: str,
+                          connection, schema: str = None, changed=False):
+        """
+        Splits the rows to be loaded into a table with a primary key into the
+        rows to be appended and the rows of changed files that replace rows
+        already loaded. The rows repeating a key of the dataframe are
+        dropped first, keeping the last one, and the other rows whose keys
+        are already loaded are skipped. Both are reported.
+
+        Parameters:
+            df (DataFrame): The rows to be loaded.
+            table_name (str): The name of the table.
+            key (str): The column of the primary key.
+            connection (Connection): The SQLAlchemy connection of the
+                transaction.
+            schema (str): The schema of the table, if not the default one.
+            changed (bool or ndarray): Whether the rows come from changed
+                files, for all the rows or as a mask of the rows.
+
+        Returns:
+            tuple: The rows to be appended and the rows to be replaced.
+        """
+        changed = np.broadcast_to(np.asarray(changed, dtype=bool), len(df))
+        unique = ~df[key].duplicated(keep='last').to_numpy()
+        if not unique.all():
+            print(f'{table_name}: {len(df) - unique.sum()} rows with repeated '
+                  f'keys dropped')
+            df, changed = df[unique], changed[unique]
+
+        loaded = self.loaded_keys(connection, table_name, key, df[key],
+                                  schema)
+        skipped = (loaded & ~changed).sum()
+        if skipped:
+            print(f'{table_name}: {skipped} rows already loaded skipped')
+        replaced = loaded & changed
+        if replaced.any():
+            print(f'{table_name}: {replaced.sum()} rows of changed files '
+                  f'replaced')
+        return df[~loaded], df[replaced]
+
+    def changed_rows(self, df: DataFrame, table_name: str):
+        """
+        Returns the mask of the rows of a dataframe read from files changed
+        since they were ingested.
 
-        df.to_sql(table_name, con=self.connection.engine,
-                  if_exists="append",
-                  index=False)
+        The rows are located through their position in the concatenation of
+        the files registered for the table, which is kept in the index of the
+        dataframe.
+
+        Parameters:
+            df (DataFrame): The rows read from the registered files.
+            table_name (str): The name of the table.
+
+        Returns:
+            ndarray: The mask of the rows of changed files.
+        """
+        changed = self.changed_files.get(table_name)
+        if not changed or df.empty:
+            return np.zeros(len(df), dtype=bool)
+
+        files = self.registered_files.get(table_name, [])
+        flags = np.repeat([file in changed for file, _ in files],
+                          [row_count for _, row_count in files])
+        positions = df.index.to_numpy()
+        if not pd.api.types.is_integer_dtype(positions) or \
+                positions.max() >= len(flags):
+            return np.ones(len(df), dtype=bool)
+        return flags[positions]
+
+    @staticmethod
+    def integer_columns(df: DataFrame, table_name: str, connection,
+                        schema: str = None):
+        """
+        Casts the float columns of a dataframe that are integers in the table
+        to the nullable Int64 type, as COPY rejects values such as '1.0' for
+        integer columns while the inserts of DataFrame.to_sql accept them.
+
+        Parameters:
+            df (DataFrame): The dataframe to be loaded.
+            table_name (str): The name of the table.
+            connection (Connection): The SQLAlchemy connection of the
+                transaction.
+            schema (str): The schema of the table, if not the default one.
+
+        Returns:
+            DataFrame: The dataframe with the integer columns as Int64.
+        """
+        columns = [column['name'] for column in
+                   inspect(connection).get_columns(table_name, schema=schema)
+                   if isinstance(column['type'], Integer) and
+                   column['name'] in df.columns and
+                   pd.api.types.is_float_dtype(df[column['name']])]
+        if not columns:
+            return df
+        return df.astype({column: 'Int64' for column in columns})
+
+    @classmethod
+    def run_step(cls, connection, step: str, instrumentation: dict = None,
+                 **options):
+        """
+        Runs a single step of run_all_ingestions with its own instance of the
+        class, so it can be executed in a separate process.
+
+        Parameters:
+            connection (str): The URI to the database.
+            step (str): The name of the step, one of the keys of `STEPS`.
+            instrumentation (dict): Optional keyword arguments of the
+                Instrumentation class. Without them nothing is measured.
+            options: The keyword arguments of the class constructor.
+
+        Returns:
+            list: The instrumentation records of the step.
+        """
+        metrics = Instrumentation(**(instrumentation or {'enabled': False}))
+        with metrics.stage('setup'):
+            run = cls(connection=connection, **options)
+        with metrics.stage(step):
+            getattr(run, step)()
+        return metrics.records
 
     @classmethod
-    def run_all_ingestions(cls, connection):
-        run = cls(connection=connection)
-        run.read_and_process_country()
-        run.read_and_process_state()
-        run.read_and_process_city()
-        run.read_and_process_accounts()
-        run.read_and_process_customers()
-        run.read_and_process_dimension_year()
-        run.read_and_process_dimension_month()
-        run.read_and_process_dimension_week()
-        run.read_and_process_dimension_weekday()
-        run.read_and_process_dimension_time()
-        run.read_and_process_investiments()
-        run.read_and_process_pix_movements()
-        run.read_and_process_transfer_ins()
-        run.read_and_process_transfer_out()
+    def run_all_ingestions(cls, connection, workers: int = 1,
+                           metrics_format: str = None,
+                           metrics_file: str = None,
+                           profile_dir: str = None,
+                           trace_memory: bool = False,
+                           rebuild_monthly_balance: bool = False, **options):
+        """
+        Runs every step of `STEPS`.
+
+        With a single worker the steps run in sequence. With more than one
+        worker the steps run in a process pool, each one as soon as the
+        steps it depends on are finished, so independent tables are read,
+        transformed and loaded concurrently, each process with its own
+        connection pool. The manifest table is created beforehand, so the
+        steps do not race to create it.
+
+        With a metrics format, every step and its phases (glob, hash, read,
+        clean, transform, dedup, load and parquet) are measured with the
+        Instrumentation class and the records of all the processes are
+        written at the end.
+
+        With the `monthly_balance` option the tables and indexes of
+        monthly_balance.sql are created beforehand and the balance of the
+        accounts and months touched by the loaded movements is refreshed
+        once every step is finished, or of every account when the table is
+        empty or with `rebuild_monthly_balance`.
+
+        Parameters:
+            connection (str): The URI to the database.
+            workers (int): The number of processes.
+            metrics_format (str): Optional format of the metrics, 'jsonl' or
+                'prometheus'.
+            metrics_file (str): The file of the metrics, or None for the
+                standard output.
+            profile_dir (str): Optional directory of the cProfile statistics
+                of each step, and of its tracemalloc report with
+                `trace_memory`.
+            trace_memory (bool): Whether the Python allocations of each step
+                are traced with tracemalloc.
+            rebuild_monthly_balance (bool): Whether the balance of every
+                account is recomputed with the `monthly_balance` option.
+            options: The keyword arguments of the class constructor.
+
+        Returns:
+        None
+        """
+        instrumentation = {
+            'enabled': metrics_format is not None,
+            'profile_dir': profile_dir, 'trace_memory': trace_memory}
+        records = []
+
+        if options.get('use_manifest', True):
+            cls.create_manifest(connection)
+        if options.get('monthly_balance', False):
+            MonthlyBalance.create(connection)
+
+        if workers <= 1:
+            metrics = Instrumentation(**instrumentation)
+            with metrics.stage('setup'):
+                run = cls(connection=connection, **options)
+            for step in cls.STEPS:
+                with metrics.stage(step):
+                    getattr(run, step)()
+            records = metrics.records
+        else:
+            records = cls._run_parallel(connection, workers, instrumentation,
+                                        options)
+
+        if options.get('monthly_balance', False):
+            refreshed = MonthlyBalance.refresh(
+                connection, rebuild=rebuild_monthly_balance)
+            print(f'{MonthlyBalance.TABLE_NAME}: {refreshed} account months '
+                  f'refreshed')
+
+        if metrics_format is not None:
+            Instrumentation.write(records, path=metrics_file,
+                                  format=metrics_format)
+
+    @classmethod
+    def _run_parallel(cls, connection, workers: int, instrumentation: dict,
+                      options: dict):
+        """
+        Runs the steps of `STEPS` in a process pool, each one as soon as its
+        dependencies are finished.
+
+        Returns:
+            list: The instrumentation records of all the steps.
+        """
+        records = []
+
+        pending = dict(cls.STEPS)
+        finished = set()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            while pending or running:
+                for step, dependencies in list(pending.items()):
+                    if finished.issuperset(dependencies):
+                        future = executor.submit(
+                            cls.run_step, connection, step,
+                            instrumentation=instrumentation, **options)
+                        running[future] = step
+                        del pending[step]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    records.extend(future.result())
+                    finished.add(running.pop(future))
+        return records
@@ -0,0 +1,188 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy import inspect, text
+
+from utils.instrumentation import Instrumentation
+
+
+class ReferentialIntegrity:
+    """
+    Class to check the foreign keys declared in sql.sql before a dataframe
+    is loaded, so orphan rows are set aside instead of failing the load.
+
+    The keys of each parent table are kept in a hash index, read from the
+    database the first time they are needed and extended in memory with the
+    rows loaded afterwards by the same process. The foreign key columns of a
+    child dataframe are then looked up with vectorized index lookups. As in
+    the database, missing values are not orphans.
+
+    The orphan rows are appended to a csv file per table in the quarantine
+    directory, with the 'orphan_columns' column naming the foreign keys that
+    failed, and only the other rows are loaded.
+
+    Attributes:
+        connection (ConnectionPostgres): The database connection.
+        quarantine_dir (str): The directory of the files of orphan rows.
+    """
+
+    # Foreign keys of each child table, as (column, parent table, parent
+    # column), following sql.sql
+    FOREIGN_KEYS = {
+        'state': (('country_id', 'country', 'country_id'),),
+        'city': (('state_id', 'state', 'state_id'),),
+        'customers': (('customer_city', 'city', 'city_id'),
+                      ('customer_id', 'accounts', 'customer_id')),
+        'transfer_ins': (
+            ('account_id', 'accounts', 'account_id'),
+            ('transaction_requested_at', 'd_time', 'time_id'),
+            ('transaction_completed_at', 'd_time', 'time_id')),
+        'transfer_outs': (
+            ('account_id', 'accounts', 'account_id'),
+            ('transaction_requested_at', 'd_time', 'time_id'),
+            ('transaction_completed_at', 'd_time', 'time_id')),
+        'pix_movements': (
+            ('account_id', 'accounts', 'account_id'),
+            ('pix_requested_at', 'd_time', 'time_id'),
+            ('pix_completed_at', 'd_time', 'time_id')),
+        'investments': (
+            ('account_id', 'accounts', 'account_id'),
+            ('investment_requested_at', 'd_time', 'time_id'),
+            ('investment_completed_at', 'd_time', 'time_id')),
+        'd_time': (('week_id', 'd_week', 'week_id'),
+                   ('month_id', 'd_month', 'month_id'),
+                   ('year_id', 'd_year', 'year_id'),
+                   ('weekday_id', 'd_weekday', 'weekday_id')),
+    }
+
+    # Default directory of the files of orphan rows
+    QUARANTINE_DIR = 'quarantine'
+
+    def __init__(self, connection, quarantine_dir: str = QUARANTINE_DIR):
+        self.connection = connection
+        self.quarantine_dir = quarantine_dir
+        self._keys = {}
+
+    def keys(self, table_name: str, column: str):
+        """
+        Returns the index of the keys of a parent table, reading them from the
+        database the first time.
+
+        Parameters:
+            table_name (str): The name of the parent table.
+            column (str): The referenced column.
+
+        Returns:
+            Index: The keys. UUIDs are kept as text, as in the dataframes.
+        """
+        index = self._keys.get((table_name, column))
+        if index is None:
+            values = []
+            if inspect(self.connection.engine).has_table(table_name):
+                with self.connection.engine.connect() as connection:
+                    values = connection.execute(text(
+                        f'SELECT DISTINCT "{column}" FROM "{table_name}" '
+                        f'WHERE "{column}" IS NOT NULL')).scalars().all()
+            index = self._index(values)
+            self._keys[(table_name, column)] = index
+        return index
+
+    def add(self, df: DataFrame, table_name: str):
+        """
+        Adds the keys of a loaded dataframe to the indexes of its table that
+        were already read, so the next children see them without reading the
+        database again.
+
+        Parameters:
+            df (DataFrame): The loaded rows.
+            table_name (str): The name of the table.
+
+        Returns:
+            None
+        """
+        for (parent, column), index in list(self._keys.items()):
+            if parent == table_name and column in df.columns:
+                added = self._index(df[column].dropna())
+                self._keys[(parent, column)] = index.append(
+                    added[~added.isin(index)]).unique()
+
+    def validate(self, df: DataFrame, table_name: str):
+        """
+        Splits a dataframe into the rows whose foreign keys exist in their
+        parent tables and the orphan rows, which are quarantined.
+
+        Parameters:
+            df (DataFrame): The rows to be loaded.
+            table_name (str): The name of the table.
+
+        Returns:
+            DataFrame: The rows without orphan foreign keys.
+        """
+        foreign_keys = [foreign_key for foreign_key in
+                        self.FOREIGN_KEYS.get(table_name, ())
+                        if foreign_key[0] in df.columns]
+        if not foreign_keys or df.empty:
+            return df
+
+        with Instrumentation.phase('integrity', rows=len(df)):
+            failed = []
+            for column, parent, parent_column in foreign_keys:
+                failed.append((column, self._orphans(
+                    df[column], self.keys(parent, parent_column))))
+
+            orphan = np.logical_or.reduce([mask for _, mask in failed])
+            if not orphan.any():
+                return df
+
+            df_orphans = df[orphan].assign(orphan_columns=[
+                ','.join(column for column, mask in failed if mask[row])
+                for row in np.flatnonzero(orphan)])
+            path = self.quarantine(df_orphans, table_name)
+        print(f'{table_name}: {len(df_orphans)} orphan rows quarantined to '
+              f'{path}')
+        return df[~orphan]
+
+    def quarantine(self, df_orphans: DataFrame, table_name: str):
+        """
+        Appends orphan rows to the quarantine file of a table.
+
+        Parameters:
+            df_orphans (DataFrame): The orphan rows.
+            table_name (str): The name of the table.
+
+        Returns:
+            str: The path of the file.
+        """
+        os.makedirs(self.quarantine_dir, exist_ok=True)
+        path = os.path.join(self.quarantine_dir, f'{table_name}.csv')
+        df_orphans.to_csv(path, mode='a', index=False,
+                          header=not os.path.exists(path))
+        return path
+
+    @staticmethod
+    def _index(values):
+        """
+        Builds the index of a set of keys, with UUIDs and other objects as
+        text.
+        """
+        index = pd.Index(values)
+        if index.dtype == object:
+            index = index.astype(str)
+        return index.unique()
+
+    @staticmethod
+    def _orphans(values, keys):
+        """
+        Returns the mask of the values that are not missing and are not in
+        the keys.
+        """
+        present = values.notna().to_numpy()
+        orphan = np.zeros(len(values), dtype=bool)
+        if present.any():
+            found = values[present]
+            found = found.astype(str) if keys.dtype == object else \
+                found.to_numpy(dtype=keys.dtype)
+            orphan[present] = keys.get_indexer(found) < 0
+        return orphan
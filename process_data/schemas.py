@@ -0,0 +1,319 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pandas as pd
+from pandas import DataFrame
+from pandas.api.types import is_numeric_dtype
+
+from utils.instrumentation import Instrumentation
+from utils.utils import Utils
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+
+
+class TableSchema:
+    """
+    Class with the dtypes of the input files of each table, following the DDL
+    in sql.sql, and methods to read the files with them.
+
+    Id columns are read as integers, since they are converted to UUID later,
+    nullable time keys as Int64 and low-cardinality text columns as
+    categoricals. Timestamps are kept as text and parsed by the database.
+    """
+
+    SCHEMAS = {
+        'country': {'country_id': 'int64', 'country': 'str'},
+        'state': {'state_id': 'int64', 'state': 'str',
+                  'country_id': 'int64'},
+        'city': {'city_id': 'int64', 'city': 'str', 'state_id': 'int64'},
+        'customers': {'customer_id': 'int64', 'first_name': 'str',
+                      'last_name': 'str', 'customer_city': 'int64',
+                      'country_name': 'category', 'cpf': 'str'},
+        'accounts': {'account_id': 'int64', 'customer_id': 'int64',
+                     'created_at': 'str', 'status': 'category',
+                     'account_branch': 'str', 'account_check_digit': 'str',
+                     'account_number': 'str'},
+        'transfer_ins': {'id': 'int64', 'account_id': 'int64',
+                         'amount': 'float64',
+                         'transaction_requested_at': 'Int64',
+                         'transaction_completed_at': 'Int64',
+                         'status': 'category'},
+        'transfer_outs': {'id': 'int64', 'account_id': 'int64',
+                          'amount': 'float64',
+                          'transaction_requested_at': 'Int64',
+                          'transaction_completed_at': 'Int64',
+                          'status': 'category'},
+        'pix_movements': {'id': 'int64', 'account_id': 'int64',
+                          'in_or_out': 'category', 'pix_amount': 'float64',
+                          'pix_requested_at': 'Int64',
+                          'pix_completed_at': 'Int64',
+                          'status': 'category'},
+        'investments': {'transaction_id': 'int64', 'account_id': 'int64',
+                        'type': 'category', 'amount': 'float64',
+                        'investment_requested_at': 'Int64',
+                        'investment_completed_at': 'Int64',
+                        'status': 'category'},
+        'd_month': {'month_id': 'int64', 'action_month': 'int64'},
+        'd_year': {'year_id': 'int64', 'action_year': 'int64'},
+        'd_time': {'time_id': 'int64', 'action_timestamp': 'str',
+                   'week_id': 'int64', 'month_id': 'int64',
+                   'year_id': 'int64', 'weekday_id': 'int64'},
+        'd_week': {'week_id': 'int64', 'action_week': 'int64'},
+        'd_weekday': {'weekday_id': 'int64', 'action_weekday': 'str'},
+    }
+
+    # Directory of the cache of parsed Excel files
+    EXCEL_CACHE_DIR = os.path.join('.cache', 'excel')
+
+    @classmethod
+    def read_csv(cls, file: str, table_name: str, **kwargs):
+        """
+        Reads a csv file of a table with the dtypes of its schema, using the
+        pyarrow csv reader when it is installed.
+
+        The text columns are declared to pyarrow as strings, so values such as
+        the 'cpf' keep their leading zeros.
+
+        Parameters:
+            file (str): The path of the file.
+            table_name (str): The name of the table.
+            kwargs: Additional keyword arguments of pandas.read_csv. When
+                given, the file is read by pandas.
+
+        Returns:
+            DataFrame: The data of the file, or an iterator of DataFrames
+                when `chunksize` is given.
+        """
+        schema = cls.SCHEMAS[table_name]
+        if pyarrow is None or kwargs:
+            with Instrumentation.phase('read') as phase:
+                df = pd.read_csv(file, dtype=schema,
+                                 na_values=Utils.NONE_VALUES, **kwargs)
+                if 'chunksize' not in kwargs:
+                    phase['rows'] = len(df)
+                    phase['bytes_read'] = os.path.getsize(file)
+            return df
+
+        with Instrumentation.phase('read',
+                                   bytes_read=os.path.getsize(file)) as phase:
+            table = pyarrow_csv.read_csv(
+                file, convert_options=pyarrow_csv.ConvertOptions(
+                    column_types={column: pyarrow.string()
+                                  for column, dtype in schema.items()
+                                  if dtype in ('str', 'category')},
+                    null_values=Utils.NONE_VALUES + [''],
+                    strings_can_be_null=True))
+            df = cls.apply(table.to_pandas(), table_name)
+            phase['rows'] = len(df)
+        return df
+
+    @classmethod
+    def read_excel(cls, file: str, table_name: str,
+                   cache_dir: str = EXCEL_CACHE_DIR):
+        """
+        Reads an Excel file of a table with the dtypes of its schema.
+
+        The parsed data is cached in `cache_dir`, as Parquet when pyarrow is
+        installed or as pickle otherwise, keyed by the path, size and
+        modification time of the file and by the schema of the table, so an
+        unchanged workbook is parsed only once. The entries of a file that
+        was changed are removed when it is cached again, so the cache keeps a
+        single entry per file.
+
+        Parameters:
+            file (str): The path of the file.
+            table_name (str): The name of the table.
+            cache_dir (str): The cache directory, or None to disable the
+                cache.
+
+        Returns:
+            DataFrame: The data of the file.
+        """
+        with Instrumentation.phase(
+                'read', bytes_read=os.path.getsize(file)) as phase:
+            df = cls._read_excel(file, table_name, cache_dir)
+            phase['rows'] = len(df)
+        return df
+
+    @classmethod
+    def _read_excel(cls, file: str, table_name: str, cache_dir: str):
+        """
+        Reads an Excel file of a table through its cache.
+        """
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = cls._excel_cache_file(file, table_name, cache_dir)
+            if os.path.exists(cache_file):
+                if pyarrow is None:
+                    return pd.read_pickle(cache_file)
+                return pd.read_parquet(cache_file)
+
+        df = pd.read_excel(file, dtype=cls.SCHEMAS[table_name],
+                           na_values=Utils.NONE_VALUES)
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            temporary_file = f'{cache_file}.{os.getpid()}.tmp'
+            if pyarrow is None:
+                df.to_pickle(temporary_file)
+            else:
+                df.to_parquet(temporary_file, index=False)
+            os.replace(temporary_file, cache_file)
+            cls._evict_excel_cache(cache_file)
+        return df
+
+    @classmethod
+    def _excel_cache_file(cls, file: str, table_name: str, cache_dir: str):
+        """
+        Returns the path of the cache of an Excel file, named by the hash of
+        the path and table followed by the hash of the version of the file
+        and of the schema.
+        """
+        stat = os.stat(file)
+        file_key = json.dumps([os.path.abspath(file), table_name])
+        version_key = json.dumps([stat.st_size, stat.st_mtime_ns,
+                                  cls.SCHEMAS[table_name]])
+        extension = 'pkl' if pyarrow is None else 'parquet'
+        return os.path.join(
+            cache_dir,
+            f'{hashlib.sha1(file_key.encode()).hexdigest()}-'
+            f'{hashlib.sha1(version_key.encode()).hexdigest()}.{extension}')
+
+    @staticmethod
+    def _evict_excel_cache(cache_file: str):
+        """
+        Removes the other entries of the file of a cache entry, cached
+        before the file or the schema of its table changed.
+        """
+        cache_dir, name = os.path.split(cache_file)
+        prefix = name.split('-')[0] + '-'
+        for entry in os.listdir(cache_dir):
+            if entry.startswith(prefix) and entry != name:
+                try:
+                    os.remove(os.path.join(cache_dir, entry))
+                except FileNotFoundError:
+                    pass
+
+    @classmethod
+    def read_files(cls, files: list, table_name: str, workers: int = 1):
+        """
+        Reads a set of csv and Excel files of a table. With more than one
+        worker the Excel files, which are much slower to parse, are read in a
+        process pool.
+
+        Parameters:
+            files (list): The paths of the files.
+            table_name (str): The name of the table.
+            workers (int): The number of processes used for the Excel files.
+
+        Returns:
+            dict: The DataFrames of the csv and Excel files, keyed by their
+                paths, in the order of `files`.
+        """
+        excel_files = [file for file in files
+                       if os.path.splitext(file)[1] == '.xlsx']
+        excel_frames = {}
+        if workers > 1 and len(excel_files) > 1:
+            with Instrumentation.phase('read', bytes_read=sum(
+                    os.path.getsize(file) for file in excel_files)) as phase, \
+                    ProcessPoolExecutor(max_workers=min(
+                        workers, len(excel_files))) as executor:
+                excel_frames = dict(zip(excel_files, executor.map(
+                    cls.read_excel, excel_files, repeat(table_name))))
+                phase['rows'] = sum(len(df) for df in excel_frames.values())
+
+        frames = {}
+        for file in files:
+            df = excel_frames[file] if file in excel_frames else \
+                cls.read_file(file, table_name)
+            if df is not None:
+                frames[file] = df
+        return frames
+
+    @classmethod
+    def read_file(cls, file: str, table_name: str):
+        """
+        Reads a csv or Excel file of a table, according to its extension.
+
+        Parameters:
+            file (str): The path of the file.
+            table_name (str): The name of the table.
+
+        Returns:
+            DataFrame: The data of the file, or None for other extensions.
+        """
+        name, ext = os.path.splitext(file)
+        if ext == '.xlsx':
+            return cls.read_excel(file, table_name)
+        if ext == '.csv':
+            return cls.read_csv(file, table_name)
+        return None
+
+    @classmethod
+    def read_file_chunks(cls, file: str, table_name: str, chunksize: int):
+        """
+        Reads a csv or Excel file of a table in chunks of rows. Csv files are
+        parsed incrementally, while Excel files are parsed at once and then
+        split.
+
+        Parameters:
+            file (str): The path of the file.
+            table_name (str): The name of the table.
+            chunksize (int): The number of rows of each chunk.
+
+        Yields:
+            DataFrame: The chunks of the file. Nothing is yielded for other
+                extensions.
+        """
+        name, ext = os.path.splitext(file)
+        if ext == '.csv':
+            with cls.read_csv(file, table_name,
+                              chunksize=chunksize) as reader:
+                while True:
+                    with Instrumentation.phase('read') as phase:
+                        df = next(reader, None)
+                        if df is not None:
+                            phase['rows'] = len(df)
+                    if df is None:
+                        break
+                    yield df
+        if ext == '.xlsx':
+            df = cls.read_excel(file, table_name)
+            for start in range(0, len(df), chunksize):
+                yield df.iloc[start:start + chunksize]
+
+    @classmethod
+    def apply(cls, df: DataFrame, table_name: str):
+        """
+        Converts the columns of an already loaded dataframe to the dtypes of
+        the schema of a table. Numeric columns are parsed from text when
+        needed, and missing values of text columns are kept missing.
+
+        Parameters:
+            df (DataFrame): The dataframe to be converted.
+            table_name (str): The name of the table.
+
+        Returns:
+            DataFrame: The converted dataframe.
+        """
+        for column, dtype in cls.SCHEMAS[table_name].items():
+            if column not in df.columns:
+                continue
+            if dtype in ('int64', 'Int64', 'float64') and \
+                    not is_numeric_dtype(df[column]):
+                df[column] = pd.to_numeric(df[column])
+            if dtype == 'str':
+                # As in read_csv, the missing values stay missing instead of
+                # becoming the text 'None' or 'nan'
+                df[column] = df[column].astype(dtype).where(
+                    df[column].notna())
+            else:
+                df[column] = df[column].astype(dtype)
+        return df
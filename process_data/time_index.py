@@ -0,0 +1,186 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from utils.instrumentation import Instrumentation
+
+
+class DTimeIndex:
+    """
+    Class with an in-memory index of the 'd_time' dimension, to resolve
+    whole columns of 'time_id' keys into their date, month and year without
+    joining the dimension tables.
+
+    The index is a set of dense arrays positioned by 'time_id' minus the
+    first key, so a column of keys is resolved with a single array
+    indexing operation. Keys outside the dimension, and missing keys, are
+    resolved to missing values. The month and the year are the ones of
+    'action_timestamp', as in query_calculate_balance.sql.
+
+    The index is saved into a NumPy archive by the ingestion of 'd_time',
+    so the other steps and the balance calculation can load it instead of
+    reading the dimension again.
+
+    Attributes:
+        first_id (int): The first 'time_id' of the arrays.
+        days (ndarray): The dates as days since the epoch (int32).
+        months (ndarray): The months, from 1 to 12, or 0 for the gaps in the
+            keys (int8).
+        years (ndarray): The years (int16).
+    """
+
+    # Default path of the saved index
+    CACHE_FILE = os.path.join('.cache', 'd_time.npz')
+
+    def __init__(self, first_id: int, days, months, years):
+        self.first_id = int(first_id)
+        self.days = np.asarray(days, dtype='int32')
+        self.months = np.asarray(months, dtype='int8')
+        self.years = np.asarray(years, dtype='int16')
+
+    @classmethod
+    def from_frame(cls, df_time: DataFrame):
+        """
+        Builds the index from the rows of 'd_time'.
+
+        Parameters:
+            df_time (DataFrame): The dimension, with the columns 'time_id'
+                and 'action_timestamp'.
+
+        Returns:
+            DTimeIndex: The index.
+        """
+        time_ids = df_time['time_id'].to_numpy(dtype='int64')
+        timestamps = pd.DatetimeIndex(pd.to_datetime(
+            df_time['action_timestamp']))
+
+        first_id = time_ids.min() if len(time_ids) else 0
+        size = time_ids.max() - first_id + 1 if len(time_ids) else 0
+        positions = time_ids - first_id
+
+        days = np.zeros(size, dtype='int32')
+        months = np.zeros(size, dtype='int8')
+        years = np.zeros(size, dtype='int16')
+        days[positions] = timestamps.to_numpy().astype(
+            'datetime64[D]').astype('int64')
+        months[positions] = timestamps.month
+        years[positions] = timestamps.year
+        return cls(first_id, days, months, years)
+
+    @classmethod
+    def from_database(cls, connection):
+        """
+        Builds the index from the 'd_time' table.
+
+        Parameters:
+            connection (ConnectionPostgres): The database connection.
+
+        Returns:
+            DTimeIndex: The index.
+        """
+        return cls.from_frame(pd.read_sql_table(
+            'd_time', con=connection.engine,
+            columns=['time_id', 'action_timestamp']))
+
+    @classmethod
+    def load(cls, path: str = CACHE_FILE):
+        """
+        Loads a saved index.
+
+        Parameters:
+            path (str): The path of the archive.
+
+        Returns:
+            DTimeIndex: The index, or None if it was not saved yet.
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as archive:
+            return cls(archive['first_id'], archive['days'],
+                       archive['months'], archive['years'])
+
+    def save(self, path: str = CACHE_FILE):
+        """
+        Saves the index into a NumPy archive, replacing it atomically.
+
+        Parameters:
+            path (str): The path of the archive.
+
+        Returns:
+            None
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_file = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_file, 'wb') as file_write:
+            np.savez(file_write, first_id=self.first_id, days=self.days,
+                     months=self.months, years=self.years)
+        os.replace(temporary_file, path)
+
+    def positions(self, time_ids):
+        """
+        Resolves a column of keys into positions of the arrays.
+
+        Parameters:
+            time_ids (array-like): The keys, possibly with missing values.
+
+        Returns:
+            tuple: The positions (int64) and a mask of the keys found. The
+                positions of the keys not found are 0.
+        """
+        values = pd.Series(time_ids).to_numpy(dtype='float64',
+                                               na_value=np.nan)
+        positions = values - self.first_id
+        found = (positions >= 0) & (positions < len(self.months))
+        positions = np.where(found, positions, 0).astype('int64')
+        found &= self.months[positions] > 0
+        return positions, found
+
+    @Instrumentation.measure('time_index')
+    def lookup(self, time_ids):
+        """
+        Resolves a column of keys into their date, month and year.
+
+        Parameters:
+            time_ids (array-like): The keys, possibly with missing values.
+
+        Returns:
+            DataFrame: The columns 'date' (datetime64, NaT when not found),
+                'month' and 'year' (Int64, missing when not found), with the
+                index of `time_ids` when it is a Series.
+        """
+        positions, found = self.positions(time_ids)
+        index = time_ids.index if isinstance(time_ids, pd.Series) else None
+
+        dates = self.days[positions].astype('datetime64[D]').astype(
+            'datetime64[ns]')
+        dates[~found] = np.datetime64('NaT')
+        return DataFrame({
+            'date': dates,
+            'month': pd.arrays.IntegerArray(
+                self.months[positions].astype('int64'), ~found),
+            'year': pd.arrays.IntegerArray(
+                self.years[positions].astype('int64'), ~found),
+        }, index=index)
+
+    def month_keys(self, time_ids):
+        """
+        Resolves a column of keys into 'YYYY-MM' month labels.
+
+        Parameters:
+            time_ids (array-like): The keys, possibly with missing values.
+
+        Returns:
+            ndarray: The labels, or None when the key is not found.
+        """
+        positions, found = self.positions(time_ids)
+        keys = np.where(found, self.years[positions].astype('int64') * 12 +
+                        self.months[positions] - 1, -1)
+        codes, uniques = pd.factorize(keys)
+        labels = np.array([None if key < 0 else
+                           f'{key // 12:04d}-{key % 12 + 1:02d}'
+                           for key in uniques], dtype=object)
+        return labels[codes]
@@ -0,0 +1,121 @@
+import unittest
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from balance.investment_balance import InvestmentBalance
+
+
+class TestInvestmentBalance(unittest.TestCase):
+    """
+    Regression of the vectorized calculation against the loop over the
+    accounts that it replaced, on deposits, withdrawals and income across
+    month boundaries.
+    """
+
+    COLUMNS = ['account_id', 'action_timestamp', 'action_month', 'deposit',
+               'withdrawal', 'balance', 'income']
+
+    @staticmethod
+    def investments():
+        rows = [
+            # Deposits and withdrawals on the same day, a withdrawal larger
+            # than the balance and movements across three months
+            ('a', 'investment_transfer_in', 100.0, date(2020, 1, 30)),
+            ('a', 'investment_transfer_in', 50.0, date(2020, 1, 30)),
+            ('a', 'investment_transfer_out', 20.0, date(2020, 1, 30)),
+            ('a', 'investment_transfer_out', 500.0, date(2020, 2, 3)),
+            ('a', 'investment_transfer_in', 10.0, date(2020, 2, 29)),
+            ('a', 'investment_transfer_out', 40.0, date(2020, 3, 1)),
+            ('a', 'investment_transfer_in', 25.0, date(2020, 3, 31)),
+            # Only deposits, listed out of order
+            ('b', 'investment_transfer_in', 300.0, date(2020, 2, 1)),
+            ('b', 'investment_transfer_in', 200.0, date(2020, 1, 31)),
+            ('b', 'investment_transfer_in', 1.5, date(2020, 4, 1)),
+            # A single day with a withdrawal only
+            ('c', 'investment_transfer_out', 5.0, date(2020, 1, 1)),
+            # Withdrawals paid with the income
+            ('d', 'investment_transfer_in', 1000.0, date(2020, 1, 1)),
+            ('d', 'investment_transfer_out', 1000.0, date(2020, 1, 31)),
+            ('d', 'investment_transfer_out', 0.1, date(2020, 2, 1)),
+            ('d', 'investment_transfer_in', 0.01, date(2020, 3, 2)),
+        ]
+        df = DataFrame(rows, columns=['account_id', 'type', 'amount',
+                                      'action_timestamp'])
+        df['action_month'] = [day.month for day in df['action_timestamp']]
+        return df
+
+    @classmethod
+    def baseline(cls, df: DataFrame):
+        """
+        The loop over the accounts and days that calculated the balance
+        before the vectorized engine.
+        """
+        results = []
+        for account_id in df['account_id'].unique():
+            df_temp = df[df['account_id'] == account_id].groupby(
+                ['account_id', 'action_timestamp', 'action_month', 'type'])[
+                'amount'].sum().reset_index().pivot_table(
+                index=['account_id', 'action_timestamp', 'action_month'],
+                columns='type', values='amount').reset_index()
+            df_temp = df_temp.replace(np.nan, 0).rename(columns={
+                'investment_transfer_in': 'deposit',
+                'investment_transfer_out': 'withdrawal'}).rename_axis(
+                columns=None)
+            for column in ['deposit', 'withdrawal']:
+                if column not in df_temp.columns:
+                    df_temp[column] = 0.0
+            df_temp = df_temp.sort_values(by=['action_timestamp']) \
+                .reset_index(drop=True)
+
+            deposit = df_temp['deposit'].tolist()
+            withdrawal = df_temp['withdrawal'].tolist()
+            dates = df_temp['action_timestamp'].tolist()
+            balance = [(deposit[0] - withdrawal[0]) * (1 + 0.0001 * 1)]
+            income = [(deposit[0] - withdrawal[0]) * (0.01 / 100)]
+            for i in range(1, len(df_temp)):
+                days = (dates[i] - dates[i - 1]).days
+                calculate = balance[i - 1] * (1 + 0.0001 * days) + \
+                    deposit[i] - withdrawal[i]
+                if calculate < 0:
+                    balance.append(balance[i - 1] * (1 + 0.0001 * days) +
+                                   deposit[i])
+                    income.append(0)
+                else:
+                    balance.append(calculate)
+                    income.append(((deposit[0] - withdrawal[0]) +
+                                   income[i - 1]) * (0.01 / 100 * days))
+            df_temp['balance'] = balance
+            df_temp['income'] = income
+            results.append(df_temp)
+        return pd.concat(results, ignore_index=True)
+
+    @classmethod
+    def sorted_result(cls, df_result: DataFrame):
+        return df_result[cls.COLUMNS].astype({
+            'action_month': 'int64', 'deposit': 'float64',
+            'withdrawal': 'float64', 'balance': 'float64',
+            'income': 'float64'}).sort_values(
+            ['account_id', 'action_timestamp']).reset_index(drop=True)
+
+    def test_matches_baseline(self):
+        df = self.investments()
+        pd.testing.assert_frame_equal(
+            self.sorted_result(InvestmentBalance.calculate(df)),
+            self.sorted_result(self.baseline(df)), rtol=1e-12)
+
+    def test_state_carried_across_months(self):
+        df = self.investments()
+        first = df['action_timestamp'] < date(2020, 2, 1)
+        df_first = InvestmentBalance.calculate(df[first])
+        df_next = InvestmentBalance.calculate(
+            df[~first], state=InvestmentBalance.last_state(df_first))
+        pd.testing.assert_frame_equal(
+            self.sorted_result(pd.concat([df_first, df_next])),
+            self.sorted_result(self.baseline(df)), rtol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
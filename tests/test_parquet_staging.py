@@ -0,0 +1,82 @@
+import tempfile
+import unittest
+
+import pandas as pd
+from pandas import DataFrame
+
+from process_data.parquet_staging import ParquetStaging
+from process_data.time_index import DTimeIndex
+
+
+class TestParquetStaging(unittest.TestCase):
+    """
+    Round trips of the Parquet staging layer, with the categorical columns
+    and the missing time keys of the cleaned tables.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.staging = ParquetStaging(
+            self.directory.name, time_index=DTimeIndex.from_frame(DataFrame({
+                'time_id': [1, 2, 3],
+                'action_timestamp': ['2020-01-15', '2020-02-01',
+                                     '2020-02-20']})))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @staticmethod
+    def transfers(ids, completed_at, status):
+        return DataFrame({
+            'id': ids,
+            'account_id': ['a'] * len(ids),
+            'amount': [10.0] * len(ids),
+            'transaction_requested_at': pd.array([1] * len(ids),
+                                                 dtype='Int64'),
+            'transaction_completed_at': pd.array(completed_at,
+                                                 dtype='Int64'),
+            'status': pd.Categorical(status)})
+
+    def test_read_without_filters(self):
+        self.staging.write(self.transfers(
+            ['1', '2', '3'], [1, None, 3], ['completed', 'failed', None]),
+            'transfer_ins')
+        self.staging.write(self.transfers(
+            ['4', '5'], [2, 99], ['completed', 'completed']), 'transfer_ins')
+
+        df = self.staging.read('transfer_ins').sort_values('id')
+
+        self.assertEqual(df['id'].tolist(), ['1', '2', '3', '4', '5'])
+        self.assertEqual(df['month'].astype(str).tolist(),
+                         ['2020-01', '0000-00', '2020-02', '2020-02',
+                          '0000-00'])
+        self.assertEqual(df['status'].tolist()[:2], ['completed', 'failed'])
+        self.assertTrue(pd.isna(df['status'].tolist()[2]))
+        self.assertEqual(
+            df['transaction_completed_date'].tolist()[:2],
+            [pd.Timestamp('2020-01-15'), pd.NaT])
+
+    def test_read_with_month_filter(self):
+        self.staging.write(self.transfers(
+            ['1', '2', '3'], [1, None, 3], ['completed'] * 3), 'transfer_ins')
+
+        df = self.staging.read('transfer_ins',
+                               filters=[('month', '>=', '2020-02')])
+
+        self.assertEqual(df['id'].tolist(), ['3'])
+
+    def test_remove(self):
+        self.staging.write(self.transfers(
+            ['1', '2', '3'], [1, 1, 3], ['completed'] * 3), 'transfer_ins')
+        self.staging.remove('transfer_ins', 'id', ['1', '3'])
+        self.staging.write(self.transfers(
+            ['3'], [1], ['failed']), 'transfer_ins')
+
+        df = self.staging.read('transfer_ins').sort_values('id')
+
+        self.assertEqual(df['id'].tolist(), ['2', '3'])
+        self.assertEqual(df['status'].tolist(), ['completed', 'failed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
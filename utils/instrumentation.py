@@ -0,0 +1,323 @@
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Instrumentation:
+    """
+    Class to measure the stages of a run and the phases inside them, such as
+    reading, cleaning, transforming and loading a table.
+
+    A stage is opened by the caller with `stage`, which makes the instance
+    the active one of the process. Any code can then measure a phase with
+    the `Instrumentation.phase` class method, which does nothing when no
+    stage is active, so the readers and helpers do not need to receive the
+    instance. Phases with the same name inside a stage, such as the batches
+    of a file, are summed into a single record.
+
+    Each record holds the duration, the rows, the bytes read and the peak
+    resident memory of its stage or phase. The peak is reset at the start of
+    each stage and phase where Linux allows it and is the peak of the
+    process otherwise.
+
+    Attributes:
+        enabled (bool): Whether the stages are measured.
+        profile_dir (str): Optional directory of the cProfile statistics and
+            tracemalloc reports of each stage.
+        trace_memory (bool): Whether the Python allocations of each stage are
+            traced with tracemalloc.
+        records (list): The records of the finished stages and phases.
+    """
+
+    _active = None
+
+    # Metrics written in the Prometheus text format, with their description
+    PROMETHEUS_METRICS = {
+        'duration_seconds': 'Duration of the ingestion stages and phases.',
+        'rows': 'Rows handled by the ingestion stages and phases.',
+        'bytes_read': 'Bytes read by the ingestion stages and phases.',
+        'peak_rss_bytes': 'Peak resident memory of the ingestion stages and '
+                          'phases.',
+        'traced_peak_bytes': 'Peak memory allocated by Python in the '
+                             'ingestion stages.',
+    }
+
+    def __init__(self, enabled: bool = True, profile_dir: str = None,
+                 trace_memory: bool = False):
+        self.enabled = enabled or profile_dir is not None or trace_memory
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.records = []
+        self._stage = None
+        self._phases = {}
+        self._open = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Measures a stage, such as an ingestion step.
+
+        Parameters:
+            name (str): The name of the stage.
+
+        Yields:
+            dict: The record of the stage, whose 'rows' and 'bytes_read' can
+                be set by the caller.
+        """
+        record = self._record(name, None)
+        if not self.enabled:
+            yield record
+            return
+
+        profiler = None
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler = cProfile.Profile()
+        if self.trace_memory:
+            tracemalloc.start()
+
+        previous = Instrumentation._active
+        Instrumentation._active = self
+        self._stage = name
+        self._phases = {}
+        self._open = [record]
+        self._reset_peak()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir,
+                                                 f'{name}.prof'))
+            record['duration_seconds'] += time.perf_counter() - start
+            record['calls'] += 1
+            self._update_peak()
+            if self.trace_memory:
+                _, record['traced_peak_bytes'] = \
+                    tracemalloc.get_traced_memory()
+                if self.profile_dir is not None:
+                    self._write_tracemalloc(name)
+                tracemalloc.stop()
+
+            Instrumentation._active = previous
+            self.records.extend(self._phases.values())
+            self.records.append(record)
+            self._stage = None
+            self._phases = {}
+            self._open = []
+
+    @classmethod
+    @contextlib.contextmanager
+    def phase(cls, name: str, rows: int = None, bytes_read: int = None):
+        """
+        Measures a phase of the active stage. Without an active stage the
+        phase is not measured.
+
+        Parameters:
+            name (str): The name of the phase, such as 'read' or 'load'.
+            rows (int): Optional number of rows handled by the phase.
+            bytes_read (int): Optional number of bytes read by the phase.
+
+        Yields:
+            dict: The fields of the phase, whose 'rows' and 'bytes_read' can
+                be set inside the block.
+        """
+        fields = {'rows': rows, 'bytes_read': bytes_read}
+        instance = cls._active
+        if instance is None:
+            yield fields
+            return
+
+        record = instance._phases.get(name)
+        if record is None:
+            record = instance._record(instance._stage, name)
+            instance._phases[name] = record
+
+        instance._update_peak()
+        instance._open.append(record)
+        instance._reset_peak()
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            record['duration_seconds'] += time.perf_counter() - start
+            record['calls'] += 1
+            for field in ('rows', 'bytes_read'):
+                if fields[field] is not None:
+                    record[field] = (record[field] or 0) + int(fields[field])
+            instance._update_peak()
+            instance._open.remove(record)
+
+    @classmethod
+    def measure(cls, name: str):
+        """
+        Decorator that measures every call of a function as a phase. The rows
+        are taken from the first argument when it is a table, such as a
+        DataFrame changed in place, or from the result otherwise.
+
+        Parameters:
+            name (str): The name of the phase.
+
+        Returns:
+            function: The decorator.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with cls.phase(name) as fields:
+                    result = function(*args, **kwargs)
+                    table = args[0] if args and hasattr(args[0], 'shape') \
+                        else result
+                    shape = getattr(table, 'shape', None)
+                    if shape:
+                        fields['rows'] = shape[0]
+                    return result
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _record(stage: str, phase):
+        return {'stage': stage, 'phase': phase, 'pid': os.getpid(),
+                'started_at': datetime.datetime.now().isoformat(),
+                'duration_seconds': 0.0, 'calls': 0, 'rows': None,
+                'bytes_read': None, 'peak_rss_bytes': None}
+
+    def _update_peak(self):
+        """
+        Folds the current peak of the process into the open records.
+        """
+        peak = self._peak_rss()
+        if peak is None:
+            return
+        for record in self._open:
+            record['peak_rss_bytes'] = max(record['peak_rss_bytes'] or 0,
+                                           peak)
+
+    @staticmethod
+    def _reset_peak():
+        """
+        Resets the peak resident memory of the process, on Linux.
+        """
+        try:
+            with open('/proc/self/clear_refs', 'w') as file_write:
+                file_write.write('5')
+        except OSError:
+            pass
+
+    @staticmethod
+    def _peak_rss():
+        """
+        Returns the peak resident memory of the process in bytes, or None
+        where it is not available.
+        """
+        try:
+            with open('/proc/self/status') as file_read:
+                for line in file_read:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        if resource is None:
+            return None
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def _write_tracemalloc(self, name: str, limit: int = 25):
+        """
+        Writes the lines that allocated the most memory in a stage.
+        """
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+        with open(os.path.join(self.profile_dir, f'{name}.tracemalloc.txt'),
+                  'w') as file_write:
+            for statistic in statistics[:limit]:
+                file_write.write(f'{statistic}\n')
+
+    @classmethod
+    def to_json_lines(cls, records: list):
+        """
+        Formats records as JSON lines, one record per line.
+        """
+        return ''.join(json.dumps(record) + '\n' for record in records)
+
+    @classmethod
+    def to_prometheus(cls, records: list, prefix: str = 'ingestion'):
+        """
+        Formats records in the Prometheus text format, with one gauge per
+        metric labelled by stage and phase. Stages get the 'total' phase.
+        Records of the same stage and phase from different processes are
+        summed, and their peaks are the maximum.
+        """
+        totals = {}
+        for record in records:
+            key = (record['stage'], record['phase'] or 'total')
+            total = totals.setdefault(key, {})
+            for metric in cls.PROMETHEUS_METRICS:
+                value = record.get(metric)
+                if value is None:
+                    continue
+                if metric.startswith(('peak', 'traced')):
+                    total[metric] = max(total.get(metric, 0), value)
+                else:
+                    total[metric] = total.get(metric, 0) + value
+
+        lines = []
+        for metric, description in cls.PROMETHEUS_METRICS.items():
+            samples = [(key, total[metric]) for key, total in totals.items()
+                       if metric in total]
+            if not samples:
+                continue
+            lines.append(f'# HELP {prefix}_{metric} {description}')
+            lines.append(f'# TYPE {prefix}_{metric} gauge')
+            for (stage, phase), value in samples:
+                lines.append(f'{prefix}_{metric}{{stage="{stage}",'
+                             f'phase="{phase}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def write(cls, records: list, path: str = None, format: str = 'jsonl'):
+        """
+        Writes records as JSON lines or in the Prometheus text format.
+
+        Parameters:
+            records (list): The records, as in `records`.
+            path (str): The output file, or None for the standard output.
+                JSON lines are appended, while Prometheus files are replaced,
+                as expected by the textfile collector.
+            format (str): 'jsonl' or 'prometheus'.
+
+        Returns:
+            None
+        """
+        if format == 'prometheus':
+            content = cls.to_prometheus(records)
+        elif format == 'jsonl':
+            content = cls.to_json_lines(records)
+        else:
+            raise ValueError(f'Unknown metrics format: {format}')
+
+        if path is None:
+            sys.stdout.write(content)
+            return
+        if format == 'jsonl':
+            with open(path, 'a') as file_write:
+                file_write.write(content)
+            return
+        temporary_file = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_file, 'w') as file_write:
+            file_write.write(content)
+        os.replace(temporary_file, path)
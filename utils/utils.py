@@ -1,5 +1,10 @@
 import uuid
-from pandas import DataFrame
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+from utils.instrumentation import Instrumentation
 
 
 class Utils:
@@ -7,6 +12,15 @@ class Utils:
     Class with static methods to perform general utilitary operations.
     """
 
+    # Values used for missing data in the input files
+    NONE_VALUES = ['None']
+
+    # ASCII codes of the hexadecimal digits and of the text of a version 4
+    # UUID built from an integer lower than 2 ** 64
+    HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+    UUID_VERSION_4_PREFIX = np.frombuffer(b'00000000-0000-4000-',
+                                          dtype=np.uint8)
+
     @staticmethod
     def convert_int_to_uuid_version_4(value: int):
         """
@@ -21,16 +35,93 @@ class Utils:
         return uuid.UUID(int=value, version=4)
 
     @staticmethod
+    @Instrumentation.measure('transform')
+    def convert_int_series_to_uuid_version_4(values):
+        """
+        Converts a column of integers to the text of version 4 UUIDs, the same
+        text as str(Utils.convert_int_to_uuid_version_4(value)).
+
+        The integers fit in the lower 64 bits of the UUID, so the upper half
+        of the text is constant and the lower half is built with array
+        operations: the variant bits are set on the integers and their bytes
+        are mapped to hexadecimal digits. Floats must be integral, and the
+        integers must be lower than 2**64.
+
+        Parameters:
+            values (Series): The integers to be converted. Integer, float and
+                object (numeric strings) columns are accepted.
+
+        Returns:
+            Series: The UUIDs as text, with the same index as `values`.
+        """
+        series = pd.Series(values)
+        numbers = pd.to_numeric(series)
+        if numbers.isna().any() or (numbers < 0).any():
+            raise ValueError('Only non-negative integers can be converted '
+                             'to UUID.')
+        if numbers.dtype.kind == 'f' and (numbers % 1 != 0).any():
+            raise ValueError('Only integral values can be converted to '
+                             'UUID.')
+        if numbers.dtype.kind not in 'iu' and (numbers >= 2 ** 64).any():
+            raise ValueError('Only integers lower than 2**64 can be '
+                             'converted to UUID.')
+
+        low = numbers.to_numpy().astype(np.uint64)
+        low = (low & np.uint64(0x3fffffffffffffff)) | \
+            np.uint64(0x8000000000000000)
+
+        digits = low.astype('>u8').view(np.uint8).reshape(-1, 8)
+        nibbles = np.empty((len(low), 16), dtype=np.uint8)
+        nibbles[:, 0::2] = digits >> 4
+        nibbles[:, 1::2] = digits & 0x0f
+
+        text = np.empty((len(low), 36), dtype=np.uint8)
+        text[:, :19] = Utils.UUID_VERSION_4_PREFIX
+        text[:, 19:23] = Utils.HEX_DIGITS[nibbles[:, :4]]
+        text[:, 23] = ord('-')
+        text[:, 24:] = Utils.HEX_DIGITS[nibbles[:, 4:]]
+
+        return Series(text.view('S36').ravel().astype(str),
+                      index=series.index)
+
+    @staticmethod
+    @Instrumentation.measure('clean')
     def convert_none_values(df: DataFrame):
         """
         Replaces 'None' values in the dataframe with None.
 
+        Only object columns can hold the 'None' text, so the other columns are
+        left untouched and keep their dtypes. Files read with
+        `na_values=Utils.NONE_VALUES` do not need this conversion.
+
         Parameters:
             df (DataFrame): The dataframe to be processed.
 
         Returns:
             DataFrame: The processed dataframe with the 'None' values converted to None.
         """
-        for col in df.columns:
-            df[col] = df[col].apply(lambda x: None if x == 'None' else x)
+        for col in df.select_dtypes(include='object').columns:
+            df[col] = df[col].mask(df[col].isin(Utils.NONE_VALUES), None)
         return df
+
+    @staticmethod
+    @Instrumentation.measure('dedup')
+    def drop_duplicate_rows(df: DataFrame, subset: list = None):
+        """
+        Drops the duplicated rows of the dataframe in place, keeping the last
+        occurrence.
+
+        The rows are compared through hash tables of their values, in linear
+        time, so the dataframe does not need to be sorted first.
+
+        Parameters:
+            df (DataFrame): The dataframe to be processed.
+            subset (list): The columns that identify a row. All the columns
+                by default.
+
+        Returns:
+            int: The number of dropped rows.
+        """
+        rows = len(df)
+        df.drop_duplicates(subset=subset, keep='last', inplace=True)
+        return rows - len(df)